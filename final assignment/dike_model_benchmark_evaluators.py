@@ -0,0 +1,85 @@
+from ema_workbench import MultiprocessingEvaluator
+from ema_workbench.em_framework.samplers import sample_levers, sample_uncertainties
+from ema_workbench.util import ema_logging
+import argparse
+import time
+import pandas as pd
+from problem_formulation_project_final import get_model_for_problem_formulation
+from funs_dispatch import ChunkedEvaluator
+from funs_threads import ThreadPoolEvaluator
+
+"""
+
+This Python file compares the throughput of the evaluators on the workloads of the simulation drivers: problem
+formulation 7 (open exploration, many scenarios) and problem formulation 8 (policies of the directed search).
+
+For every problem formulation and every number of workers the same experiments are run with the
+ThreadPoolEvaluator (threads sharing one DikeNetwork), the MultiprocessingEvaluator of the workbench and the
+ChunkedEvaluator. The start-up time of the evaluator and the time of the experiments are measured separately. The
+process based evaluators never start more processes than there are cores, the number of workers they actually used
+is reported as well.
+
+The results are saved in evaluator_benchmark.csv, e.g.
+
+    python dike_model_benchmark_evaluators.py --workers 1 2 4 8 16 24 32 48 --scenarios 200 --policies 4
+
+"""
+
+EVALUATORS = {
+    "threads": lambda model, n: ThreadPoolEvaluator(model, n_threads=n),
+    "processes": lambda model, n: MultiprocessingEvaluator(model, n_processes=n),
+    "chunked processes": lambda model, n: ChunkedEvaluator(model, n_processes=n),
+}
+
+if __name__ == "__main__":
+    ema_logging.log_to_stderr(ema_logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--formulations", type=int, nargs="+", default=[7, 8])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16, 24, 32, 48])
+    parser.add_argument("--scenarios", type=int, default=200)
+    parser.add_argument("--policies", type=int, default=4)
+    parser.add_argument("--evaluators", nargs="+", default=list(EVALUATORS), choices=list(EVALUATORS))
+    parser.add_argument("--output", default="evaluator_benchmark.csv")
+    args = parser.parse_args()
+
+    records = []
+    for formulation in args.formulations:
+        dike_model, planning_steps = get_model_for_problem_formulation(formulation)
+        scenarios = list(sample_uncertainties(dike_model, args.scenarios))
+        policies = list(sample_levers(dike_model, args.policies))
+        n_experiments = len(scenarios) * len(policies)
+
+        for n_workers in args.workers:
+            for name in args.evaluators:
+                start = time.perf_counter()
+                with EVALUATORS[name](dike_model, n_workers) as evaluator:
+                    started = time.perf_counter()
+                    evaluator.perform_experiments(scenarios=scenarios, policies=policies)
+                    finished = time.perf_counter()
+                    used = evaluator.n_processes
+
+                records.append(
+                    {
+                        "formulation": formulation,
+                        "evaluator": name,
+                        "workers": n_workers,
+                        "workers used": used,
+                        "experiments": n_experiments,
+                        "start-up [s]": started - start,
+                        "run [s]": finished - started,
+                        "experiments per second": n_experiments / (finished - started),
+                    }
+                )
+                print(
+                    f"formulation {formulation}, {name}, {used} workers: "
+                    f"{records[-1]['experiments per second']:.1f} experiments per second"
+                )
+
+    results = pd.DataFrame(records)
+    results.to_csv(args.output, index=False)
+    print(
+        results.pivot_table(
+            index=["formulation", "workers"], columns="evaluator", values="experiments per second"
+        ).round(1)
+    )
@@ -0,0 +1,139 @@
+from ema_workbench.util import ema_logging
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from dike_model_function import DikeNetwork
+from funs_synthetic_network import write_network
+
+"""
+
+This Python file measures how the evaluation time and memory of the DikeNetwork scale with the size of the problem,
+on synthetic networks written by funs_synthetic_network.
+
+Starting from a baseline network, one dimension at a time is scaled while the others stay at the baseline:
+
+    dikes       number of dike nodes (a single chain unless branches is larger than one)
+    branches    number of parallel branches the dikes are spread over
+    timesteps   length of the flood waves in days
+    events      number of flood events per planning step
+
+For every network the time to load it, the median time of an evaluation with random uncertainties and levers, and
+the peak memory allocated during an evaluation (as traced by tracemalloc, in a separate run) are recorded. The
+exponent of a power law fitted to time and memory against every dimension is reported; exponents well above one
+flag super-linear behaviour.
+
+The results are saved in scaling_benchmark.csv, e.g.
+
+    python dike_model_benchmark_scaling.py --dikes 5 10 20 40 80 --timesteps 31 62 124 248 --events 15 30 60 120
+
+"""
+
+DIMENSIONS = ["dikes", "branches", "timesteps", "events"]
+
+
+def sample_inputs(network, n_shapes, rng):
+    """Random uncertainties and levers for a DikeNetwork, in the ranges of the
+    problem formulations"""
+    inputs = {"A.0_ID flood wave shape": int(rng.integers(n_shapes)), "EWS_DaysToThreat": int(rng.integers(5))}
+    for s in network.planning_steps:
+        inputs[f"discount rate {s}"] = rng.choice([1.5, 2.5, 3.5, 4.5])
+        for project in range(5):
+            inputs[f"{project}_RfR {s}"] = int(rng.integers(2))
+    for dike in network.dikelist:
+        inputs[f"{dike}_Bmax"] = rng.uniform(30, 350)
+        inputs[f"{dike}_pfail"] = rng.uniform(0, 1)
+        inputs[f"{dike}_Brate"] = rng.choice([1.0, 1.5, 10])
+        for s in network.planning_steps:
+            inputs[f"{dike}_DikeIncrease {s}"] = int(rng.integers(11))
+    return inputs
+
+
+if __name__ == "__main__":
+    ema_logging.log_to_stderr(ema_logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dikes", type=int, nargs="+", default=[5, 10, 20, 40, 80])
+    parser.add_argument("--branches", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--timesteps", type=int, nargs="+", default=[31, 62, 124, 248])
+    parser.add_argument("--events", type=int, nargs="+", default=[15, 30, 60, 120])
+    parser.add_argument(
+        "--baseline",
+        type=int,
+        nargs=4,
+        default=[8, 1, 31, 30],
+        metavar=("DIKES", "BRANCHES", "TIMESTEPS", "EVENTS"),
+    )
+    parser.add_argument("--shapes", type=int, default=133)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="exponent above 1 flagged as super-linear")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="scaling_benchmark.csv")
+    args = parser.parse_args()
+
+    baseline = dict(zip(DIMENSIONS, args.baseline))
+    records = []
+    with tempfile.TemporaryDirectory() as directory:
+        for dimension in DIMENSIONS:
+            for value in getattr(args, dimension):
+                size = baseline | {dimension: value}
+                data_dir = os.path.join(directory, "_".join(str(size[d]) for d in DIMENSIONS))
+                if not os.path.exists(data_dir):
+                    write_network(
+                        data_dir, size["dikes"], size["branches"], size["timesteps"], args.shapes, seed=args.seed
+                    )
+
+                np.random.seed(args.seed)
+                start = time.perf_counter()
+                network = DikeNetwork(data_dir=data_dir, num_events=size["events"])
+                loaded = time.perf_counter()
+
+                rng = np.random.default_rng(args.seed)
+                times = []
+                for _ in range(args.repeats):
+                    inputs = sample_inputs(network, args.shapes, rng)
+                    run_start = time.perf_counter()
+                    network(**inputs)
+                    times.append(time.perf_counter() - run_start)
+
+                tracemalloc.start()
+                network(**inputs)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+                records.append(
+                    {
+                        "dimension": dimension,
+                        "value": value,
+                        **size,
+                        "depth": network.schedule.depth,
+                        "load [s]": loaded - start,
+                        "run [s]": float(np.median(times)),
+                        "peak memory [MB]": peak / 2**20,
+                        "breaches": network.run_stats["breaches"],
+                    }
+                )
+                print(
+                    f"{dimension} {value}: {records[-1]['run [s]']:.3f} s per evaluation, "
+                    f"{records[-1]['peak memory [MB]']:.1f} MB"
+                )
+
+    results = pd.DataFrame(records)
+    results.to_csv(args.output, index=False)
+
+    # exponent of a power law fitted per dimension
+    exponents = []
+    for dimension, group in results.groupby("dimension", sort=False):
+        if group["value"].nunique() < 2:
+            continue
+        x = np.log(group["value"])
+        row = {"dimension": dimension}
+        for column in ["run [s]", "peak memory [MB]"]:
+            row[column] = np.polyfit(x, np.log(group[column]), 1)[0]
+        row["super-linear"] = max(row["run [s]"], row["peak memory [MB]"]) > 1 + args.tolerance
+        exponents.append(row)
+    print("\nscaling exponents (time or memory ~ dimension ** exponent)")
+    print(pd.DataFrame(exponents).round(2).to_string(index=False))
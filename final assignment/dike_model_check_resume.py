@@ -0,0 +1,119 @@
+from ema_workbench import Scenario, SequentialEvaluator
+from ema_workbench.em_framework.optimization import AbstractConvergenceMetric, EpsilonProgress
+from ema_workbench.util import ema_logging
+import argparse
+import os
+import random
+import shutil
+import numpy as np
+import pandas as pd
+from problem_formulation_project_final import get_model_for_problem_formulation
+from funs_archive import DeltaArchiveLogger, load_archives
+from funs_checkpoint import CampaignInterrupted, OptimizationCheckpoint, PreemptionHandler
+from funs_optimization import run_optimization
+
+"""
+
+This Python file checks that an interrupted direct search on problem formulation 8 continues where it stopped when it
+is resumed from its checkpoint.
+
+The same short optimization is run twice with the same seed: once without interruption and once interrupted halfway
+(as if SLURM signalled the end of the job) and then resumed from the checkpoint, like
+dike_model_optimization_project_final.py --resume does. The final archives and every archive snapshot stored by the
+DeltaArchiveLogger of both runs have to be identical, e.g.
+
+    python dike_model_check_resume.py --nfe 400 --stop-nfe 200
+
+"""
+
+
+class InterruptAt(AbstractConvergenceMetric):
+    """Convergence metric that sets the preemption flag once nfe is reached"""
+
+    def __init__(self, preemption, nfe):
+        super().__init__("interrupt")
+        self.preemption = preemption
+        self.nfe = nfe
+
+    def __call__(self, optimizer):
+        if self.nfe is not None and optimizer.nfe >= self.nfe:
+            self.preemption.stop_requested = True
+
+
+def optimize(model, scenario, directory, name, nfe, preemption=None, stop_nfe=None):
+    model_levers = [l.name for l in model.levers]
+    model_outcomes = [o.name for o in model.outcomes]
+    convergence_metrics = [
+        DeltaArchiveLogger(directory, model_levers, model_outcomes, base_filename=f"{name}.darc"),
+        EpsilonProgress(),
+        InterruptAt(preemption, stop_nfe),
+    ]
+    checkpoint = OptimizationCheckpoint(
+        os.path.join(directory, f"{name}.pkl"), every_nfe=100, preemption=preemption
+    )
+    with SequentialEvaluator(model) as evaluator:
+        result, convergence = run_optimization(
+            model,
+            evaluator,
+            nfe=nfe,
+            searchover="levers",
+            epsilons=[0.1] * len(model.outcomes),
+            convergence=convergence_metrics,
+            convergence_freq=100,
+            reference=scenario,
+            checkpoint=checkpoint,
+            population_size=20,
+        )
+    checkpoint.mark_done()
+    return result, load_archives(os.path.join(directory, f"{name}.darc"))
+
+
+def compare(expected, actual):
+    columns = list(expected.columns)
+    expected = expected.sort_values(columns).reset_index(drop=True)
+    actual = actual[columns].sort_values(columns).reset_index(drop=True)
+    pd.testing.assert_frame_equal(expected, actual, check_dtype=False)
+
+
+if __name__ == "__main__":
+    ema_logging.log_to_stderr(ema_logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nfe", type=int, default=400)
+    parser.add_argument("--stop-nfe", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--directory", default="./checkpoints/resume_check")
+    args = parser.parse_args()
+
+    shutil.rmtree(args.directory, ignore_errors=True)
+    model, steps = get_model_for_problem_formulation(8)
+    experiment = pd.read_csv("data/final_scenarios_final.xls").iloc[0]
+    scenario = Scenario("experiment_based", **{u.name: experiment[u.name] for u in model.uncertainties})
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    expected_result, expected_archives = optimize(
+        model, scenario, args.directory, "uninterrupted", args.nfe, PreemptionHandler()
+    )
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    preemption = PreemptionHandler()
+    try:
+        optimize(model, scenario, args.directory, "resumed", args.nfe, preemption, args.stop_nfe)
+    except CampaignInterrupted as e:
+        print(f"interrupted: {e}")
+    else:
+        raise SystemExit("the run was not interrupted, --stop-nfe should be below --nfe")
+
+    # a new job, the random state comes from the checkpoint
+    random.seed(args.seed + 1)
+    np.random.seed(args.seed + 1)
+    result, archives = optimize(model, scenario, args.directory, "resumed", args.nfe, PreemptionHandler())
+
+    compare(expected_result, result)
+    if list(archives) != list(expected_archives):
+        raise SystemExit(f"snapshots at nfe {list(archives)}, expected {list(expected_archives)}")
+    for nfe, archive in expected_archives.items():
+        compare(archive, archives[nfe])
+    print(f"resumed run matches the uninterrupted run: {len(result)} solutions, {len(archives)} snapshots")
@@ -4,16 +4,30 @@ Created on Tue Oct 31 13:18:05 2017
 @author: ciullo
 """
 import copy
+import os
+import threading
 import numpy as np
 import pandas as pd
 from collections import defaultdict
 
 from ema_workbench import ema_logging
+from ema_workbench.util import EMAError
 
 import funs_generate_network
-from funs_dikes import Lookuplin, dikefailure, init_node
+from funs_dikes import Lookuplin
 from funs_economy import cost_fun, discount, cost_evacuation
 from funs_hydrostat import werklijn_cdf, werklijn_inv
+from funs_routing import RoutingSchedule, route_events
+
+
+# Fidelity levels: routing time step in days and number of flood events.
+# Coarse levels are meant for screening, e.g. in early generations of the
+# direct search, and should be followed by a re-evaluation at "high".
+FIDELITY_LEVELS = {
+    "high": {"timestep": 1, "num_events": 30},
+    "medium": {"timestep": 2, "num_events": 15},
+    "low": {"timestep": 3, "num_events": 8},
+}
 
 
 def Muskingum(C1, C2, C3, Qn0_t1, Qn0_t0, Qn1_t0):
@@ -22,19 +36,45 @@ def Muskingum(C1, C2, C3, Qn0_t1, Qn0_t0, Qn1_t0):
     return Qn1_t1
 
 
+def muskingum_coefficients(K, X, dt):
+    """Muskingum routing coefficients for a time step dt, with K in days"""
+    denominator = 2 * K * (1 - X) + dt
+    C1 = (dt - 2 * K * X) / denominator
+    C2 = (dt + 2 * K * X) / denominator
+    C3 = (2 * K * (1 - X) - dt) / denominator
+    return C1, C2, C3
+
+
+def resolve_fidelity(timestep):
+    """Translate the timestep argument into a time step and number of events
+
+    timestep is either a number of days, in which case all flood events are
+    simulated, or the name of one of the FIDELITY_LEVELS.
+    """
+    if isinstance(timestep, str):
+        try:
+            level = FIDELITY_LEVELS[timestep]
+        except KeyError:
+            raise ValueError(
+                f"unknown fidelity level {timestep}, use one of {list(FIDELITY_LEVELS)}"
+            )
+        return level["timestep"], level["num_events"]
+    return int(timestep), None
+
+
 class DikeNetwork:
-    def __init__(self):
+    def __init__(self, network_file="dikeIjssel.xlsx", data_dir="./data", num_events=30):
         # planning steps
         self.num_planning_steps = 3
-        self.num_events = 30
+        self.num_events = num_events
 
         # load network
         G, dike_list, dike_branch, planning_steps = funs_generate_network.get_network(
-            self.num_planning_steps
+            self.num_planning_steps, network_file, data_dir
         )
 
         # Load hydrological statistics:
-        self.A = pd.read_excel("./data/hydrology/werklijn_params.xlsx")
+        self.A = pd.read_excel(os.path.join(data_dir, "hydrology", "werklijn_params.xlsx"))
 
         lowQ, highQ = werklijn_inv([0.992, 0.99992], self.A)
         self.Qpeaks = np.unique(
@@ -48,6 +88,8 @@ class DikeNetwork:
 
         self.G = G
         self.dikelist = dike_list
+        # Order in which the flood waves are routed through the network:
+        self.schedule = RoutingSchedule(G)
         self.dike_branch = dike_branch
         self.planning_steps = planning_steps
 
@@ -64,17 +106,56 @@ class DikeNetwork:
         # Time step correction: Q is a mean daily value expressed in m3/s
         self.timestepcorr = 24 * 60 * 60
 
+        # Work done in the last run of every thread, read by the telemetry of
+        # the evaluators, see run_stats
+        self._run_stats = {}
+
     #        ema_logging.info('model initialized')
 
-    # Initialize hydrology at each node:
-    def _initialize_hydroloads(self, node, time, Q_0):
-        node["cumVol"], node["wl"], node["Qpol"], node["hbas"] = (
-            init_node(0, time) for _ in range(4)
-        )
-        node["Qin"], node["Qout"] = (init_node(Q_0, time) for _ in range(2))
-        node["status"] = init_node(False, time)
-        node["tbreach"] = np.nan
-        return node
+    @property
+    def run_stats(self):
+        """Number of simulated events and breaches in the last run of the
+        current thread"""
+        return self._run_stats.get(threading.get_ident(), {})
+
+    def _routing_coefficients(self, G, dikenodes, timestep):
+        """Muskingum coefficients of each dike node for the given time step"""
+        coefficients = {}
+        for dike in dikenodes:
+            node = G.nodes[dike]
+            if timestep == 1:
+                coefficients[dike] = (node["C1"], node["C2"], node["C3"])
+            else:
+                coefficients[dike] = muskingum_coefficients(node["K"], node["X"], timestep)
+        return coefficients
+
+    def _select_events(self, num_events):
+        """Evenly spaced subset of the flood events, keeping the extremes"""
+        if num_events is None or num_events >= len(self.Qpeaks):
+            return self.Qpeaks, self.p_exc
+        index = np.unique(np.linspace(0, len(self.Qpeaks) - 1, num_events).round().astype(int))
+        return self.Qpeaks[index], self.p_exc[index]
+
+    def _source_flow(self, G, Qpeaks, timestep):
+        """Discharge of every upstream node for all events, and the time
+        steps of the simulation
+
+        All upstream nodes follow the flood wave shape of A.0, scaled by
+        their optional discharge share.
+        """
+        node = G.nodes["A.0"]
+        waveshape_id = node["ID flood wave shape"]
+
+        # Daily hydrograph sampled at the routing time step:
+        waveshape = node["Qevents_shape"].loc[waveshape_id].values
+        time = np.arange(0, waveshape.shape[0], timestep)
+        hydrograph = Qpeaks[:, np.newaxis] * waveshape[time]
+
+        source_flow = {}
+        for source in self.schedule.sources:
+            share = G.nodes[source].get("discharge share", 1)
+            source_flow[source] = hydrograph * (1 if pd.isna(share) else float(share))
+        return source_flow, time
 
     def _initialize_rfr_ooi(self, G, dikenodes, steps):
         for s in steps:
@@ -83,11 +164,6 @@ class DikeNetwork:
                 # Create a copy of the rating curve that will be used in the sim:
                 node["rnew"] = copy.deepcopy(node["r"])
 
-                # Initialize outcomes of interest (ooi):
-                node[f"losses {s}"] = []
-                node[f"deaths {s}"] = []
-                node[f"evacuation_costs {s}"] = []
-
             # Initialize room for the river
             G.nodes[f"RfR_projects {s}"]["cost"] = 0
         return G
@@ -122,20 +198,12 @@ class DikeNetwork:
                         node[f"DikeIncrease {s}"],
                     )
 
-    def __call__(self, timestep=1, **kwargs):
-
-        G = copy.deepcopy(self.G)
-        Qpeaks = self.Qpeaks
-        dikelist = self.dikelist
-
-        # Call RfR initialization:
-        self._initialize_rfr_ooi(G, dikelist, self.planning_steps)
-
-        # Load all kwargs into network. Kwargs are uncertainties and levers:
-        for item in kwargs:
+    def _load_inputs(self, G, inputs):
+        """Load uncertainties and levers into the network"""
+        for item in inputs:
             # when item is 'discount rate':
             if "discount rate" in item:
-                G.nodes[item]["value"] = kwargs[item]
+                G.nodes[item]["value"] = inputs[item]
             # the rest of the times you always get a string like {}_{}:
             else:
                 string1, string2 = item.split("_")
@@ -143,14 +211,14 @@ class DikeNetwork:
                 if "RfR" in string2:
                     # string1: projectID
                     # string2: rfr #step
-                    # Note: kwargs[item] in this case can be either 0
+                    # Note: inputs[item] in this case can be either 0
                     # (no project) or 1 (yes project)
                     temporal_step = string2.split(" ")[1]
 
                     proj_node = G.nodes[f"RfR_projects {temporal_step}"]
                     # Cost of RfR project
                     proj_node["cost"] += (
-                        kwargs[item] * proj_node[string1]["costs_1e6"] * 1e6
+                        inputs[item] * proj_node[string1]["costs_1e6"] * 1e6
                     )
 
                     # Iterate over the location affected by the project
@@ -158,165 +226,192 @@ class DikeNetwork:
                         if key != "costs_1e6":
                             # Change in rating curve due to the RfR project
                             G.nodes[key]["rnew"][:, 1] -= (
-                                kwargs[item] * proj_node[string1][key]
+                                inputs[item] * proj_node[string1][key]
                             )
                 else:
                     # string1: dikename or EWS
                     # string2: name of uncertainty or lever
-                    G.nodes[string1][string2] = kwargs[item]
+                    G.nodes[string1][string2] = inputs[item]
 
+    def lever_costs(self, **levers):
+        """The outcomes that only depend on the levers, the dike investment
+        costs and the room for the river costs, without simulating any
+        flood event"""
+        G = copy.deepcopy(self.G)
+        dikelist = self.dikelist
+        self._initialize_rfr_ooi(G, dikelist, self.planning_steps)
+        self._load_inputs(G, levers)
         self.progressive_height_and_costs(G, dikelist, self.planning_steps)
 
-        # Percentage of people who can be evacuated for a given warning
-        # time:
-        G.nodes["EWS"]["evacuation_percentage"] = G.nodes["EWS"]["evacuees"][
-            G.nodes["EWS"]["DaysToThreat"]
-        ]
-
-        # Dictionary storing outputs:
         data = defaultdict(list)
-
         for s in self.planning_steps:
-            for Qpeak in Qpeaks:
-                node = G.nodes["A.0"]
-                waveshape_id = node["ID flood wave shape"]
-
-                time = np.arange(
-                    0, node["Qevents_shape"].loc[waveshape_id].shape[0], timestep
-                )
-                node["Qout"] = Qpeak * node["Qevents_shape"].loc[waveshape_id]
-
-                # Initialize hydrological event:
-                for key in dikelist:
-                    node = G.nodes[key]
-
-                    Q_0 = int(G.nodes["A.0"]["Qout"][0])
-
-                    self._initialize_hydroloads(node, time, Q_0)
-                    # Calculate critical water level: water above which failure
-                    # occurs
-                    node["critWL"] = Lookuplin(node[f"fnew {s}"], 1, 0, node["pfail"])
-
-                # Run the simulation:
-                # Run over the discharge wave:
-                for t in range(1, len(time)):
-                    # Run over each node of the branch:
-                    for n in range(0, len(dikelist)):
-                        # Select current node:
-                        node = G.nodes[dikelist[n]]
-                        if node["type"] == "dike":
-
-                            # Muskingum parameters:
-                            C1 = node["C1"]
-                            C2 = node["C2"]
-                            C3 = node["C3"]
-
-                            prec_node = G.nodes[node["prec_node"]]
-                            # Evaluate Q coming in a given node at time t:
-                            node["Qin"][t] = Muskingum(
-                                C1,
-                                C2,
-                                C3,
-                                prec_node["Qout"][t],
-                                prec_node["Qout"][t - 1],
-                                node["Qin"][t - 1],
-                            )
-
-                            # Transform Q in water levels:
-                            node["wl"][t] = Lookuplin(
-                                node["rnew"], 0, 1, node["Qin"][t]
-                            )
+            for dike in dikelist:
+                data[f"{dike}_Dike Investment Costs"].append(G.nodes[dike][f"dikecosts {s}"])
+            data[f"RfR Total Costs"].append(G.nodes[f"RfR_projects {s}"]["cost"])
+        return data
 
-                            # Evaluate failure and, in case, Q in the floodplain and
-                            # Q left in the river:
-                            res = dikefailure(
-                                self.sb,
-                                node["Qin"][t],
-                                node["wl"][t],
-                                node["hbas"][t],
-                                node["hground"],
-                                node["status"][t - 1],
-                                node["Bmax"],
-                                node["Brate"],
-                                time[t],
-                                node["tbreach"],
-                                node["critWL"],
-                            )
+    def __call__(self, timestep=1, **kwargs):
+        """Run the model
+
+        Parameters
+        ----------
+        timestep : int or str, optional
+                   routing time step in days, or one of the FIDELITY_LEVELS,
+                   which also reduces the number of simulated flood events
+        kwargs : uncertainties and levers
+        """
+        return self.run_scenarios([{}], timestep, **kwargs)[0]
+
+    def run_scenarios(self, scenarios, timestep=1, **levers):
+        """Run the model for several scenarios under the same levers
+
+        The setup that depends on the levers (the rating curves after the
+        room for the river projects, the raised fragility curves and the
+        investment costs) is done once, and the flood events of all
+        scenarios are routed through the network together.
+
+        Parameters
+        ----------
+        scenarios : list of dict
+                    uncertainties of every scenario; room for the river
+                    projects and dike increases have to be passed as levers
+        timestep : int or str, optional
+                   see __call__
+        levers : levers, and uncertainties shared by all scenarios
+
+        Returns
+        -------
+        list of dict
+            the outcomes of every scenario, as returned by __call__
+
+        Raises
+        ------
+        EMAError if a scenario holds a lever that changes the setup
+        """
+        timestep, num_events = resolve_fidelity(timestep)
 
-                            node["Qout"][t] = res[0]
-                            node["Qpol"][t] = res[1]
-                            node["status"][t] = res[2]
-                            node["tbreach"] = res[3]
+        G = copy.deepcopy(self.G)
+        Qpeaks, p_exc = self._select_events(num_events)
+        dikelist = self.dikelist
+        routing = self._routing_coefficients(G, dikelist, timestep)
 
-                            # Evaluate the volume inside the floodplain as the integral
-                            # of Q in time up to time t.
-                            node["cumVol"][t] = (
-                                np.trapz(node["Qpol"]) * self.timestepcorr
-                            )
+        # Call RfR initialization:
+        self._initialize_rfr_ooi(G, dikelist, self.planning_steps)
 
-                            Area = Lookuplin(node["table"], 4, 0, node["wl"][t])
-                            node["hbas"][t] = node["cumVol"][t] / float(Area)
+        # Load all levers into network:
+        self._load_inputs(G, levers)
+        self.progressive_height_and_costs(G, dikelist, self.planning_steps)
 
-                        elif node["type"] == "downstream":
-                            node["Qin"] = G.nodes[dikelist[n - 1]]["Qout"]
+        schedule = self.schedule
+        dikes = schedule.dikes
+        tables = schedule.tables(G)
+        params = {
+            param: np.array([routing[dike][i] for dike in dikes])
+            for i, param in enumerate(["C1", "C2", "C3"])
+        }
+        params["hground"] = np.array([G.nodes[dike]["hground"] for dike in dikes], dtype=float)
+
+        # Load the uncertainties of every scenario, the flood events of the
+        # scenarios follow each other on the event axis
+        inputs = defaultdict(list)
+        for scenario in scenarios:
+            for item in scenario:
+                if "RfR" in item or "DikeIncrease" in item:
+                    raise EMAError(f"{item} is a lever, it cannot differ between scenarios")
+            self._load_inputs(G, scenario)
+
+            source_flow, time = self._source_flow(G, Qpeaks, timestep)
+            for source, flow in source_flow.items():
+                inputs[source].append(flow)
+            for param in ["Bmax", "Brate"]:
+                inputs[param].append([G.nodes[dike][param] for dike in dikes])
+            # Critical water level: water above which failure occurs
+            for s in self.planning_steps:
+                inputs[f"critWL {s}"].append(
+                    [Lookuplin(G.nodes[dike][f"fnew {s}"], 1, 0, G.nodes[dike]["pfail"]) for dike in dikes]
+                )
+                inputs[f"discount rate {s}"].append(G.nodes[f"discount rate {s}"]["value"])
+
+            # Percentage of people who can be evacuated for a given warning
+            # time:
+            days_to_threat = G.nodes["EWS"]["DaysToThreat"]
+            inputs["DaysToThreat"].append(days_to_threat)
+            inputs["evacuation_percentage"].append(G.nodes["EWS"]["evacuees"][days_to_threat])
+
+        n_events = len(Qpeaks)
+        source_flow = {source: np.concatenate(inputs[source]) for source in schedule.sources}
+        for param in ["Bmax", "Brate"]:
+            params[param] = np.repeat(np.array(inputs[param], dtype=float), n_events, axis=0)
+        # Discharge at the dikes at the start of an event:
+        initial = np.trunc(np.column_stack([source_flow[n][:, 0] for n in schedule.sources]))
+        initial = initial @ schedule.reach
+
+        # Dictionary storing outputs per scenario:
+        data = [defaultdict(list) for _ in scenarios]
+        breaches = 0
 
-                # Iterate over the network and store outcomes of interest for a
-                # given event
-                for dike in self.dikelist:
+        for s in self.planning_steps:
+            params["critWL"] = np.repeat(np.array(inputs[f"critWL {s}"]), n_events, axis=0)
+
+            # Route all events through the network at once. The breach flow
+            # is driven by the river level above the ground level, with the
+            # water depth in the floodplain taken as zero, so the volume in
+            # the floodplain is not tracked.
+            wl_max, status = route_events(schedule, tables, source_flow, time, initial, params, self.sb)
+            breaches += int(status.sum())
+
+            for k, outcomes in enumerate(data):
+                events = slice(k * n_events, (k + 1) * n_events)
+                evacuation_percentage = inputs["evacuation_percentage"][k]
+
+                EECosts = []
+                # Iterate over the network,compute and store ooi over all events
+                for dike in dikelist:
                     node = G.nodes[dike]
+                    i = schedule.dike_index[dike]
+                    # Outcomes of interest per event, only where breaches
+                    # occurred:
+                    failed = status[events, i]
+                    wl = wl_max[events, i]
+                    table = node["table"]
+
+                    losses = np.where(failed, Lookuplin(table, 6, 4, wl), 0)
+                    deaths = np.where(failed, Lookuplin(table, 6, 3, wl) * (1 - evacuation_percentage), 0)
+                    evacuation_costs = np.where(
+                        failed,
+                        cost_evacuation(
+                            Lookuplin(table, 6, 5, wl) * evacuation_percentage, inputs["DaysToThreat"][k]
+                        ),
+                        0,
+                    )
 
-                    # If breaches occured:
-                    if node["status"][-1] == True:
-                        # Losses per event:
-                        node[f"losses {s}"].append(
-                            Lookuplin(node["table"], 6, 4, np.max(node["wl"]))
-                        )
-
-                        node[f"deaths {s}"].append(
-                            Lookuplin(node["table"], 6, 3, np.max(node["wl"]))
-                            * (1 - G.nodes["EWS"]["evacuation_percentage"])
-                        )
-
-                        node[f"evacuation_costs {s}"].append(
-                            cost_evacuation(
-                                Lookuplin(node["table"], 6, 5, np.max(node["wl"]))
-                                * G.nodes["EWS"]["evacuation_percentage"],
-                                G.nodes["EWS"]["DaysToThreat"],
-                            )
-                        )
-                    else:
-                        node[f"losses {s}"].append(0)
-                        node[f"deaths {s}"].append(0)
-                        node[f"evacuation_costs {s}"].append(0)
-
-            EECosts = []
-            # Iterate over the network,compute and store ooi over all events
-            for dike in dikelist:
-                node = G.nodes[dike]
-
-                # Expected Annual Damage:
-                EAD = np.trapz(node[f"losses {s}"], self.p_exc)
-                # Discounted annual risk per dike ring:
-                disc_EAD = np.sum(
-                    discount(
-                        EAD, rate=G.nodes[f"discount rate {s}"]["value"], n=self.y_step
+                    # Expected Annual Damage:
+                    EAD = np.trapz(losses, p_exc)
+                    # Discounted annual risk per dike ring:
+                    disc_EAD = np.sum(
+                        discount(EAD, rate=inputs[f"discount rate {s}"][k], n=self.y_step)
                     )
-                )
 
-                # Expected Annual number of deaths:
-                END = np.trapz(node[f"deaths {s}"], self.p_exc)
+                    # Expected Annual number of deaths:
+                    END = np.trapz(deaths, p_exc)
 
-                # Expected Evacuation costs: depend on the event, the higher
-                # the event, the more people you have got to evacuate:
-                EECosts.append(np.trapz(node[f"evacuation_costs {s}"], self.p_exc))
+                    # Expected Evacuation costs: depend on the event, the higher
+                    # the event, the more people you have got to evacuate:
+                    EECosts.append(np.trapz(evacuation_costs, p_exc))
 
-                data[f"{dike}_Expected Annual Damage"].append(disc_EAD)
-                data[f"{dike}_Expected Number of Deaths"].append(END)
-                data[f"{dike}_Dike Investment Costs"].append(node[f"dikecosts {s}"])
+                    outcomes[f"{dike}_Expected Annual Damage"].append(disc_EAD)
+                    outcomes[f"{dike}_Expected Number of Deaths"].append(END)
+                    outcomes[f"{dike}_Dike Investment Costs"].append(node[f"dikecosts {s}"])
 
-            data[f"RfR Total Costs"].append(G.nodes[f"RfR_projects {s}"]["cost"])
-            data[f"Expected Evacuation Costs"].append(np.sum(EECosts))
+                outcomes[f"RfR Total Costs"].append(G.nodes[f"RfR_projects {s}"]["cost"])
+                outcomes[f"Expected Evacuation Costs"].append(np.sum(EECosts))
 
+        # the network is only read, so several threads can run the model at
+        # once; only the statistics are kept per thread
+        self._run_stats[threading.get_ident()] = {
+            "events simulated": len(scenarios) * len(self.planning_steps) * n_events,
+            "breaches": breaches,
+        }
         return data
 
 # Initialize the DikeNetwork object
@@ -1,22 +1,34 @@
 from ema_workbench import (
     Model,
-    MultiprocessingEvaluator,
     ScalarOutcome,
     IntegerParameter,
     optimize,
     Scenario,
-    HypervolumeMetric,
-    GenerationalDistanceMetric,
-    EpsilonIndicatorMetric,
-    InvertedGenerationalDistanceMetric,
-    SpacingMetric,
 )
-from ema_workbench.em_framework.optimization import EpsilonProgress, to_problem, epsilon_nondominated, ArchiveLogger
+from ema_workbench.em_framework.optimization import EpsilonProgress, to_problem
 from ema_workbench.util import ema_logging
-from problem_formulation_project_final import get_model_for_problem_formulation
+from problem_formulation_project_final import get_model_for_problem_formulation, with_fidelity
+from funs_archive import DeltaArchiveLogger, DeltaArchiveReader
+from funs_checkpoint import OptimizationCheckpoint, PreemptionHandler
+from funs_async import run_async_optimization
+from funs_cost_screening import CostScreen
+from funs_convergence import (
+    ArchiveMetrics,
+    ArchiveMetricsLogger,
+    ConvergenceStop,
+    compute_metrics,
+    score_snapshots,
+)
+from funs_pareto import epsilon_nondominated
+from funs_mpi import get_evaluator, start_workers
+from funs_optimization import load_stored_policies, run_optimization
+from funs_surrogate import Surrogate
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pandas as pd
+import argparse
+import contextlib
+import glob
 import os
 import shutil
 
@@ -28,15 +40,77 @@ The five scenarios identified in the open exploration step are used here to gene
 a function is created to generate possible policies for a given scenario and seed. This function is then used in the 
 code below to iterate over the five scenarios.
 
-The last part of the code is designed to plot convergence metrics needed to check if an NFE
- (Number of Function Evaluations) of 20000 is sufficient to converge to a set of policies.
+The last part of the code is designed to compute the convergence metrics needed to check if an NFE
+ (Number of Function Evaluations) of 20000 is sufficient to converge to a set of policies. The archive of every run 
+is kept in memory at every convergence check. Once all runs are done, the reference set is built from their results 
+and the metrics of all runs are computed in parallel and written to metrics_seed_{seed}.csv, with one block of rows 
+per scenario. With --metrics-reference the reference set is taken from earlier results instead, the metrics are then 
+computed while the search is running and every metrics_seed_{seed}.csv is written as soon as the runs of that seed are 
+done.
+
+The archive snapshots of every run are also written to ./archives/seed_{seed}_scenario_{index}.darc, which only stores 
+the changes between snapshots (see funs_archive). Runs that are skipped with --resume read their snapshots from there.
 
 The code uses problem formulation 8. This formulation is specifically designed for optimization, aiming to minimize 
 all outcomes and focusing only on the outcomes that are critical for Water Board 3.
 
+Every optimization run writes a checkpoint to ./checkpoints/optimization at least every 1000 NFE and when SLURM 
+signals the end of the job. Run the script again with --resume to skip the seed x scenario combinations whose 
+results are already stored and to continue the interrupted run from its last checkpoint.
+dike_model_check_resume.py checks that a run that is interrupted and resumed ends with the same archive snapshots as an 
+uninterrupted run.
+
+With --screening-nfe the first part of the search is done with a cheaper version of the dike model (coarser time 
+step and fewer flood events, see --screening-fidelity). After the screening NFE the population and archive are 
+re-evaluated with the full model and the rest of the search runs at full fidelity.
+
+With --surrogate an emulator trained on the stored results of the reference scenario in ./data is used to pre-screen 
+the offspring, so only the most promising lever combinations are evaluated with the dike model. The prediction error of the emulator during the 
+search is written to surrogate_error_seed_{seed}_scenario_{index}.csv.
+
+Start the script with mpirun (or srun) and --mpi to evaluate the candidates on all MPI ranks, possibly spread over 
+several nodes, e.g. mpirun -n 4 python dike_model_optimization_project_final.py --mpi
+
+With --async the generational search is replaced by a steady-state search in which every worker gets a new candidate 
+as soon as it finishes one, so workers do not wait for the slowest evaluation of a generation. The worker utilization 
+of every run is written to utilization_seed_{seed}_scenario_{index}.csv.
+
+With --warm-start half of the initial population is taken from the policies found before (5_best_policies.csv, 
+857_policies_optimization.csv and the stored optimization results), restricted to the levers of the current problem 
+formulation and without duplicates.
+
+With --stop-window a run stops before 20000 NFE once the epsilon progress and the hypervolume of the archive improved 
+less than --stop-min-progress and --stop-threshold over the last --stop-window NFE. Why and at which NFE every run 
+stopped is written to stopping_seed_{seed}_scenario_{index}.csv, next to its convergence data.
+
+With --cost-screening the offspring are first checked on the investment costs, which only depend on the levers. 
+Offspring that would be epsilon-dominated by the archive even without any flood damage are not evaluated. With 
+--budget a maximum is set on a cost objective, e.g. --budget "Dike Investment Costs=2e8" --budget total=5e8 where total 
+is the sum of the cost objectives. Offspring over budget are not evaluated and policies over budget are infeasible. 
+The number of rejected offspring is logged at the end of every run.
+
 """
 
-def run_optimization_with_scenario(experiment_values, seed):
+CHECKPOINT_DIR = "./checkpoints/optimization"
+
+
+def run_optimization_with_scenario(
+    experiment_values,
+    seed,
+    index=0,
+    resume=False,
+    preemption=None,
+    screening_nfe=0,
+    screening_fidelity="low",
+    use_surrogate=False,
+    mpi=False,
+    asynchronous=False,
+    warm_start=None,
+    stopping_rule=None,
+    metrics_logger=None,
+    cost_screening=False,
+    budgets=None,
+):
     ema_logging.log_to_stderr(ema_logging.INFO)
 
     # Use problem formulation 8
@@ -53,107 +127,251 @@ def run_optimization_with_scenario(experiment_values, seed):
 
     # Set convergence metrics, epsilon values and nfe for optimization over levers and outcomes
     convergence_metrics = [
-        ArchiveLogger(
+        DeltaArchiveLogger(
             archives_dir,
             [l.name for l in model.levers],
             [o.name for o in model.outcomes],
-            base_filename=f"{seed}.tar.gz",
+            base_filename=f"seed_{seed}_scenario_{index}.darc",
         ),
         EpsilonProgress(),
     ]
+    if metrics_logger is not None:
+        convergence_metrics.append(metrics_logger)
     epsilon = [0.1] * len(model.outcomes) # For each outcome the epsilon is set to 0.1
     nfe = 20000  # The number of function evaluations is here set to 20000
 
-    # Run the optimization
-    with MultiprocessingEvaluator(model) as evaluator:
-        result, convergence = evaluator.optimize(
-            nfe=nfe,
-            searchover="levers",
-            epsilons=epsilon,
-            convergence=convergence_metrics,
-            reference=scenario,
-        )
+    checkpoint = OptimizationCheckpoint(
+        os.path.join(CHECKPOINT_DIR, f"seed_{seed}_scenario_{index}.pkl"),
+        every_nfe=1000,
+        preemption=preemption,
+    )
+    if not resume:
+        checkpoint.mark_done()
+
+    surrogate = None
+    if use_surrogate:
+        surrogate = Surrogate.from_results(model, reference=scenario, random_state=seed)
+
+    cost_screen = None
+    if cost_screening or budgets:
+        cost_screen = CostScreen(model, budgets)
+
+    # Run the optimization, the cheap screening model only gets a worker pool when it is used
+    with contextlib.ExitStack() as stack:
+        evaluator = stack.enter_context(get_evaluator(model, mpi=mpi))
+        screening_evaluator = None
+        if screening_nfe > 0:
+            screening_model = with_fidelity(model, screening_fidelity)
+            screening_evaluator = stack.enter_context(get_evaluator(screening_model, mpi=mpi))
+
+        if asynchronous:
+            result, convergence, utilization = run_async_optimization(
+                model,
+                evaluator,
+                nfe=nfe,
+                epsilons=epsilon,
+                convergence=convergence_metrics,
+                reference=scenario,
+                checkpoint=checkpoint,
+                warm_start=warm_start,
+                stopping_rule=stopping_rule,
+            )
+            pd.DataFrame([utilization]).to_csv(f"utilization_seed_{seed}_scenario_{index}.csv", index=False)
+        else:
+            result, convergence = run_optimization(
+                model,
+                evaluator,
+                nfe=nfe,
+                searchover="levers",
+                epsilons=epsilon,
+                convergence=convergence_metrics,
+                reference=scenario,
+                checkpoint=checkpoint,
+                screening_evaluator=screening_evaluator,
+                screening_nfe=screening_nfe,
+                surrogate=surrogate,
+                cost_screen=cost_screen,
+                warm_start=warm_start,
+                stopping_rule=stopping_rule,
+            )
+    checkpoint.mark_done()
+
+    if stopping_rule is not None:
+        summary = stopping_rule.summary(int(convergence["nfe"].iloc[-1]))
+        pd.DataFrame([summary]).to_csv(f"stopping_seed_{seed}_scenario_{index}.csv", index=False)
+
+    if surrogate is not None:
+        surrogate.error_dataframe().to_csv(f"surrogate_error_seed_{seed}_scenario_{index}.csv", index=False)
     print("exited optimizer")
 
     return result, convergence
 
+def write_seed_metrics(seed, scores):
+    """Write the convergence metrics of all scenarios of a seed to metrics_seed_{seed}.csv"""
+    frames = [metrics.assign(scenario=index) for (_, index), metrics in sorted(scores.items())]
+    if frames:
+        pd.concat(frames, ignore_index=True).to_csv(f'metrics_seed_{seed}.csv', index=False)
+
+
 if __name__ == "__main__":
 
 # This code iterates over the five scenarios and optimizes for each seed x scenario combination.
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", action="store_true", help="continue from stored results and checkpoints")
+    parser.add_argument(
+        "--screening-nfe", type=int, default=0, help="number of function evaluations done with the cheap model"
+    )
+    parser.add_argument(
+        "--screening-fidelity",
+        default="low",
+        choices=["medium", "low"],
+        help="fidelity of the dike model during screening",
+    )
+    parser.add_argument("--surrogate", action="store_true", help="pre-screen offspring with an emulator")
+    parser.add_argument("--mpi", action="store_true", help="evaluate on the MPI ranks")
+    parser.add_argument("--warm-start", action="store_true", help="seed the search with stored policies")
+    parser.add_argument(
+        "--async", dest="asynchronous", action="store_true", help="steady-state search with asynchronous evaluation"
+    )
+    parser.add_argument(
+        "--stop-window", type=int, default=0, help="stop when the search did not improve over this many NFE"
+    )
+    parser.add_argument(
+        "--stop-threshold", type=float, default=1e-3, help="minimum relative hypervolume gain over the window"
+    )
+    parser.add_argument(
+        "--stop-min-progress", type=int, default=5, help="minimum epsilon progress over the window"
+    )
+    parser.add_argument(
+        "--cost-screening", action="store_true", help="reject offspring on their costs before evaluating them"
+    )
+    parser.add_argument(
+        "--budget",
+        action="append",
+        default=[],
+        metavar="OUTCOME=MAXIMUM",
+        help="maximum of a cost objective, or of their total, can be repeated",
+    )
+    parser.add_argument(
+        "--metrics-reference",
+        nargs="+",
+        help="result files (glob patterns) to build the reference set of the convergence metrics from",
+    )
+    args = parser.parse_args()
+    if args.asynchronous and (args.screening_nfe or args.surrogate or args.cost_screening or args.budget):
+        parser.error("--async cannot be combined with --screening-nfe, --surrogate, --cost-screening or --budget")
+    budgets = {}
+    for budget in args.budget:
+        name, _, value = budget.rpartition("=")
+        try:
+            budgets[name] = float(value)
+        except ValueError:
+            name = ""
+        if not name:
+            parser.error(f"invalid budget {budget}, expected OUTCOME=MAXIMUM")
+
+    # under MPI all ranks except rank 0 become workers and stay in start_workers
+    if args.mpi:
+        start_workers()
+    preemption = PreemptionHandler().install()
+
     # Load the dataframe with the five scenarios found during open exploration
     experiments_df = pd.read_csv('data/final_scenarios_final.xls')
 
     model, steps = get_model_for_problem_formulation(8)
+    stored_policies = load_stored_policies(model) if args.warm_start else None
+
+    problem = to_problem(model, searchover="levers")
+    epsilon = [0.05] * len(model.outcomes)
+    outcome_names = [o.name for o in model.outcomes]
+
+    # With a known reference set the convergence metrics are computed during the search
+    live_metrics = None
+    if args.metrics_reference:
+        reference_results = [
+            pd.read_csv(file_name)[outcome_names]
+            for pattern in args.metrics_reference
+            for file_name in sorted(glob.glob(pattern))
+        ]
+        reference_set = epsilon_nondominated(reference_results, epsilon, problem)
+        live_metrics = ArchiveMetrics.from_dataframe(reference_set, problem)
 
     # Iterate over each experiment and perform the optimization, we do this for 5 seeds.
     results = []
     convergences = []
+    snapshots = {}
+    live_scores = {}
 
     for seed in range(5):  # run for 5 seeds
         for index, experiment in experiments_df.iterrows():
+            result_file_name = f'optimization_results_seed_{seed}_scenario_{index}.csv'
+            convergence_file_name = f'convergence_data_seed_{seed}_scenario_{index}.csv'
+            snapshot_file_name = f'./archives/seed_{seed}_scenario_{index}.darc'
+
+            # In resume mode, runs that already stored their results are skipped
+            if args.resume and os.path.exists(result_file_name) and os.path.exists(convergence_file_name):
+                print(f"skipping seed {seed} scenario {index}, results already stored")
+                results.append(pd.read_csv(result_file_name))
+                convergences.append(pd.read_csv(convergence_file_name))
+                if os.path.exists(snapshot_file_name):
+                    snapshots[seed, index] = list(DeltaArchiveReader(snapshot_file_name).iter_columns(outcome_names))
+                continue
+
             experiment_values = experiment.to_dict()
-            result, convergence = run_optimization_with_scenario(experiment_values, seed)
+            metrics_logger = ArchiveMetricsLogger(live_metrics)
+            stopping_rule = None
+            if args.stop_window > 0:
+                stopping_rule = ConvergenceStop(
+                    window=args.stop_window,
+                    min_epsilon_progress=args.stop_min_progress,
+                    min_hypervolume_gain=args.stop_threshold,
+                )
+            result, convergence = run_optimization_with_scenario(
+                experiment_values,
+                seed,
+                index=index,
+                resume=args.resume,
+                preemption=preemption,
+                screening_nfe=args.screening_nfe,
+                screening_fidelity=args.screening_fidelity,
+                use_surrogate=args.surrogate,
+                mpi=args.mpi,
+                asynchronous=args.asynchronous,
+                warm_start=stored_policies,
+                stopping_rule=stopping_rule,
+                metrics_logger=metrics_logger,
+                cost_screening=args.cost_screening,
+                budgets=budgets,
+            )
+            snapshots[seed, index] = metrics_logger.results
+            if live_metrics is not None:
+                live_scores[seed, index] = metrics_logger.to_dataframe()
 
             result_df = pd.DataFrame(result)
             #result_df['seed'] = seed
-            result_file_name = f'optimization_results_seed_{seed}_scenario_{index}.csv'
             result_df.to_csv(result_file_name, index=False)
 
             convergence_df = pd.DataFrame(convergence.epsilon_progress)
             #convergence_df['seed'] = seed
-            convergence_file_name = f'convergence_data_seed_{seed}_scenario_{index}.csv'
             convergence_df.to_csv(convergence_file_name, index=False)
 
             results.append(result_df)
             convergences.append(convergence_df)
 
-# Here starts the code for the convergence metrics.
-
-    # Load the archives into memory
-    all_archives = []
-    for i in range(5):
-        archives = ArchiveLogger.load_archives(f"./archives/{i}.tar.gz")
-        for key in archives:
-            if 'Unnamed: 0' in archives[key].columns:
-                archives[key].drop(columns=['Unnamed: 0'], inplace=True)
-        all_archives.append(archives)
-
-    problem = to_problem(model, searchover="levers")
-
-    # Define metrics
-    epsilon = [0.05] * len(model.outcomes)
-    reference_set = epsilon_nondominated(results, epsilon, problem)
-
-    hv = HypervolumeMetric(reference_set, problem)
-    gd = GenerationalDistanceMetric(reference_set, problem, d=1)
-    ei = EpsilonIndicatorMetric(reference_set, problem)
-    ig = InvertedGenerationalDistanceMetric(reference_set, problem, d=1)
-    sm = SpacingMetric(problem)
-
-    # Calculate metrics for each archive and store results
-    metrics_by_seed = []
-    for archives in all_archives:
-        metrics = []
-        for nfe, archive in archives.items():
-            scores = {
-                "generational_distance": gd.calculate(archive),
-                "hypervolume": hv.calculate(archive),
-                "epsilon_indicator": ei.calculate(archive),
-                "inverted_gd": ig.calculate(archive),
-                "spacing": sm.calculate(archive),
-                "nfe": int(nfe),
-            }
-            metrics.append(scores)
-        metrics = pd.DataFrame.from_dict(metrics)
-
-        # Sort metrics by number of function evaluations
-        metrics.sort_values(by="nfe", inplace=True)
-        metrics_by_seed.append(metrics)
-
-    # Save the metrics
-    for seed, metrics in enumerate(metrics_by_seed):
-        metrics_file_name = f'metrics_seed_{seed}.csv'
-        metrics.to_csv(metrics_file_name, index=False)
+        # With live metrics every seed is written as soon as its runs are done
+        if live_metrics is not None:
+            for key, run_snapshots in snapshots.items():
+                if key not in live_scores:
+                    live_scores[key] = score_snapshots(live_metrics, run_snapshots)
+            write_seed_metrics(seed, {key: value for key, value in live_scores.items() if key[0] == seed})
 
+# Here starts the code for the convergence metrics.
 
+    if live_metrics is None:
+        # The reference set is built from the results of all runs, after that all runs are scored in parallel
+        reference_set = epsilon_nondominated(results, epsilon, problem)
+        metrics = ArchiveMetrics.from_dataframe(reference_set, problem)
+        scores = compute_metrics(snapshots, metrics)
+        for seed in range(5):
+            write_seed_metrics(seed, {key: value for key, value in scores.items() if key[0] == seed})
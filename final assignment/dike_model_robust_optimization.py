@@ -0,0 +1,110 @@
+from ema_workbench.em_framework.optimization import EpsilonProgress
+from ema_workbench.util import ema_logging
+from problem_formulation_project_final import get_model_for_problem_formulation
+from funs_archive import DeltaArchiveLogger
+from funs_checkpoint import OptimizationCheckpoint, PreemptionHandler
+from funs_mpi import get_evaluator, start_workers
+from funs_optimization import load_stored_policies, run_optimization
+from funs_robust_optimization import best_from_results, robust_model
+import pandas as pd
+import argparse
+import os
+
+"""
+
+This script is used for robust direct search, as a replacement of the two stage workflow of
+dike_model_optimization_project_final.py (an optimization per scenario and seed, followed by the re-evaluation of
+all resulting policies on all scenarios).
+
+Every candidate policy is evaluated on all five scenarios identified in the open exploration at once (see
+funs_robust_optimization), and the objectives are robustness statistics of the outcomes of problem formulation 8
+over these scenarios, by default their mean and their worst value (max). The investment costs do not depend on the 
+scenario and are single objectives. Other statistics are percentiles, e.g. --statistics mean p90, and the maximum 
+regret. The regret of a scenario is taken with respect to the best outcomes of the stored re-evaluation of the 857 
+policies (--regret-reference, data/dike_model_combined_results.csv). In that file the best expected annual damage is 
+zero in every scenario, so there the max regret is the same as the max.
+
+A run is done for every seed, its results are written to robust_optimization_results_seed_{seed}.csv, its epsilon
+progress to robust_convergence_data_seed_{seed}.csv and its archive snapshots to
+./archives/robust_seed_{seed}.darc. Checkpoints are written to ./checkpoints/robust_optimization, run the script
+again with --resume to skip the seeds whose results are stored and to continue an interrupted run.
+
+Start the script with mpirun (or srun) and --mpi to evaluate the candidates on all MPI ranks, e.g.
+mpirun -n 4 python dike_model_robust_optimization.py --mpi
+
+"""
+
+CHECKPOINT_DIR = "./checkpoints/robust_optimization"
+
+if __name__ == "__main__":
+    ema_logging.log_to_stderr(ema_logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seeds", type=int, default=5, help="number of seeds")
+    parser.add_argument("--nfe", type=int, default=20000)
+    parser.add_argument("--statistics", nargs="+", default=["mean", "max"])
+    parser.add_argument("--scenarios", default="data/final_scenarios_final.xls")
+    parser.add_argument(
+        "--regret-reference",
+        default="data/dike_model_combined_results.csv",
+        help="re-evaluation results with the best outcomes per scenario, labelled scenario_1, scenario_2, ...",
+    )
+    parser.add_argument("--epsilon", type=float, default=0.1)
+    parser.add_argument("--resume", action="store_true", help="continue from stored results and checkpoints")
+    parser.add_argument("--mpi", action="store_true", help="evaluate on the MPI ranks")
+    parser.add_argument("--warm-start", action="store_true", help="seed the search with stored policies")
+    args = parser.parse_args()
+
+    # under MPI all ranks except rank 0 become workers and stay in start_workers
+    if args.mpi:
+        start_workers()
+    preemption = PreemptionHandler().install()
+
+    # Problem formulation 8, evaluated on the five scenarios found during open exploration
+    model, steps = get_model_for_problem_formulation(8)
+    scenarios = pd.read_csv(args.scenarios)
+
+    best = None
+    if "max regret" in args.statistics:
+        best = best_from_results(args.regret_reference, [o.name for o in model.outcomes])
+        best = best.loc[[f"scenario_{index + 1}" for index in range(len(scenarios))]]
+    robust = robust_model(model, scenarios, args.statistics, best)
+    stored_policies = load_stored_policies(robust) if args.warm_start else None
+
+    for seed in range(args.seeds):
+        result_file_name = f"robust_optimization_results_seed_{seed}.csv"
+        convergence_file_name = f"robust_convergence_data_seed_{seed}.csv"
+        if args.resume and os.path.exists(result_file_name) and os.path.exists(convergence_file_name):
+            print(f"skipping seed {seed}, results already stored")
+            continue
+
+        convergence_metrics = [
+            DeltaArchiveLogger(
+                "./archives",
+                [l.name for l in robust.levers],
+                [o.name for o in robust.outcomes],
+                base_filename=f"robust_seed_{seed}.darc",
+            ),
+            EpsilonProgress(),
+        ]
+        checkpoint = OptimizationCheckpoint(
+            os.path.join(CHECKPOINT_DIR, f"seed_{seed}.pkl"), every_nfe=1000, preemption=preemption
+        )
+        if not args.resume:
+            checkpoint.mark_done()
+
+        with get_evaluator(robust, mpi=args.mpi) as evaluator:
+            result, convergence = run_optimization(
+                robust,
+                evaluator,
+                nfe=args.nfe,
+                searchover="levers",
+                epsilons=[args.epsilon] * len(robust.outcomes),
+                convergence=convergence_metrics,
+                checkpoint=checkpoint,
+                warm_start=stored_policies,
+            )
+        checkpoint.mark_done()
+
+        pd.DataFrame(result).to_csv(result_file_name, index=False)
+        pd.DataFrame(convergence.epsilon_progress).to_csv(convergence_file_name, index=False)
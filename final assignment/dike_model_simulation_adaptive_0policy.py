@@ -0,0 +1,90 @@
+from ema_workbench import Policy
+from ema_workbench.util import ema_logging, save_results
+import argparse
+from problem_formulation_project_final import get_model_for_problem_formulation
+from funs_adaptive import BoxStop, run_adaptive_sampling
+from funs_dispatch import ChunkedEvaluator
+from funs_mpi import get_evaluator, start_workers
+
+"""
+
+This Python file is used for scenario discovery for the zero policy with adaptive sampling, as an alternative to
+the 100000 uniformly sampled scenarios of dike_model_simulation_final_0policy.py.
+
+The cases of interest are the experiments in which both the expected annual damage and the expected number of
+deaths are in their top percentiles, as in the open exploration notebook (85th and 90th percentile by default).
+The percentiles are taken over a uniform initial batch. After that, a classifier of the cases of interest is fitted
+after every batch and the next batch is placed where the classifier is least certain, i.e. near the boundary of
+the region of interest. A PRIM box is estimated on a uniform pool of scenarios labelled by the classifier, and the
+sampling stops once the box limits no longer change (--tolerance) or the budget (--max-experiments) is spent.
+
+The results are saved in dike_model_results_adaptive_0policy.tar.gz, the box estimates after every batch in
+adaptive_sampling_history.csv.
+
+Start the script with mpirun (or srun) and --mpi to run the experiments on all MPI ranks.
+
+"""
+
+if __name__ == "__main__":
+    ema_logging.log_to_stderr(ema_logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--initial", type=int, default=2000, help="size of the uniform initial batch")
+    parser.add_argument("--batch", type=int, default=1000, help="experiments per adaptive batch")
+    parser.add_argument("--max-experiments", type=int, default=30000, help="budget of experiments")
+    parser.add_argument("--damage-percentile", type=float, default=85)
+    parser.add_argument("--deaths-percentile", type=float, default=90)
+    parser.add_argument("--threshold", type=float, default=0.65, help="PRIM density threshold")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.02, help="change of the box limits that counts as stable"
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--mpi", action="store_true", help="run the experiments on the MPI ranks")
+    args = parser.parse_args()
+
+    # under MPI all ranks except rank 0 become workers and stay in start_workers
+    if args.mpi:
+        start_workers()
+
+    # Use problem formulation 7
+    dike_model, planning_steps = get_model_for_problem_formulation(7)
+
+    # This is the zero policy where no policy measures are implemented,
+    # in other words no dike increase, no warning, none of the rfr.
+    zero_policy = {"DaysToThreat": 0}
+    zero_policy.update({f"DikeIncrease {n}": 0 for n in planning_steps})
+    zero_policy.update({f"RfR {n}": 0 for n in planning_steps})
+    pol0 = {}
+
+    for key in dike_model.levers:
+        s1, s2 = key.name.split("_")
+        pol0.update({key.name: zero_policy[s2]})
+
+    policy0 = Policy("Policy 0", **pol0)
+
+    conditions = [
+        ("Expected Annual Damage", ">", args.damage_percentile),
+        ("Expected Number of Deaths", ">", args.deaths_percentile),
+    ]
+
+    with get_evaluator(dike_model, mpi=args.mpi, fallback=ChunkedEvaluator) as evaluator:
+        experiments, outcomes, history, box = run_adaptive_sampling(
+            dike_model,
+            evaluator,
+            conditions,
+            policy=policy0,
+            initial_size=args.initial,
+            batch_size=args.batch,
+            max_experiments=args.max_experiments,
+            prim_threshold=args.threshold,
+            stopping_rule=BoxStop(tolerance=args.tolerance, window=2),
+            seed=args.seed,
+        )
+
+    # Save results to a file
+    save_results((experiments, outcomes), "dike_model_results_adaptive_0policy.tar.gz")
+    history.to_csv("adaptive_sampling_history.csv", index=False)
+    if box is None:
+        print("no box found, the classifier labelled no part of the scenario space as cases of interest")
+    else:
+        print(box.box_lim)
@@ -1,10 +1,14 @@
 from ema_workbench import Model, MultiprocessingEvaluator, Policy, Scenario
 
-from ema_workbench.em_framework.evaluators import perform_experiments
-from ema_workbench.em_framework.samplers import sample_uncertainties
 from ema_workbench.util import ema_logging, save_results
+import argparse
 import time
 from problem_formulation_project_final import get_model_for_problem_formulation
+from funs_checkpoint import ExperimentCheckpoint, PreemptionHandler
+from funs_dispatch import ChunkedEvaluator
+from funs_memory import MemoryBudget, flush_batch_size
+from funs_mpi import get_evaluator, start_workers
+from funs_telemetry import Telemetry, TelemetryCallback
 
 """
 
@@ -14,11 +18,38 @@ and no prior warnings are given.
 
 This results in a total of 100000 experiments used for scenario discovery. 
 
+The experiments are run in batches of 2000 and every finished batch is stored in ./checkpoints/0policy. Run the 
+script again with --resume to reuse the stored scenarios and only run the batches that are still missing.
+
+Start the script with mpirun (or srun) and --mpi to run the experiments on all MPI ranks, possibly spread over 
+several nodes, e.g. mpirun -n 4 python dike_model_simulation_final_0policy.py --mpi
+Without --mpi the experiments run on the cores of the current machine, in chunks of about equal run time.
+The number of processes and the size of the batches are chosen to stay within the memory of the SLURM allocation
+(or --memory-budget), based on the memory of a worker measured at start-up; the memory model is logged.
+With --telemetry <directory> the wall time, number of simulated events and number of breaches of every experiment
+are stored as extra outcome columns, and the timeline of the workers and the straggler experiments are written to
+the directory, see funs_telemetry.py.
+
 """
 
 if __name__ == "__main__":
     ema_logging.log_to_stderr(ema_logging.INFO)
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", action="store_true", help="continue from the stored batches")
+    parser.add_argument("--mpi", action="store_true", help="run the experiments on the MPI ranks")
+    parser.add_argument(
+        "--memory-budget", type=int, default=None, help="memory in MB, by default the SLURM allocation"
+    )
+    parser.add_argument(
+        "--telemetry", default=None, help="directory for the run time telemetry of the experiments and workers"
+    )
+    args = parser.parse_args()
+
+    # under MPI all ranks except rank 0 become workers and stay in start_workers
+    if args.mpi:
+        start_workers()
+
     # Use problem formulation 7
     dike_model, planning_steps = get_model_for_problem_formulation(7)
 
@@ -57,11 +88,29 @@ if __name__ == "__main__":
 
     policy0 = Policy("Policy 0", **pol0)
 
-    # Call random 100.000 scenarios and policies:
-    scenarios = sample_uncertainties(dike_model, 100000)
-
-    # Generate 100.000 experiments
-    results = perform_experiments(dike_model, scenarios=scenarios, policies=policy0)
+    # Call random 100.000 scenarios and generate 100.000 experiments, the scenarios are only sampled when there
+    # is no stored design to resume from
+    checkpoint = ExperimentCheckpoint(
+        "./checkpoints/0policy", batch_size=2000, preemption=PreemptionHandler().install()
+    )
+    telemetry = Telemetry() if args.telemetry else None
+    memory_budget = MemoryBudget(None if args.memory_budget is None else args.memory_budget * 2**20)
+    with get_evaluator(
+        dike_model, mpi=args.mpi, fallback=ChunkedEvaluator, memory_budget=memory_budget, telemetry=telemetry
+    ) as evaluator:
+        checkpoint.batch_size = flush_batch_size(evaluator, checkpoint.batch_size)
+        try:
+            results = checkpoint.perform_experiments(
+                dike_model,
+                scenarios=100000,
+                policies=policy0,
+                evaluator=evaluator,
+                resume=args.resume,
+                callback=TelemetryCallback if telemetry else None,
+            )
+        finally:
+            if telemetry is not None:
+                telemetry.save(args.telemetry)
 
     # Save results to a file
     save_results(results, "dike_model_results_100k_experiments_id_7_plus_casualties.tar.gz")
\ No newline at end of file
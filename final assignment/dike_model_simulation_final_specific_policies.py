@@ -1,11 +1,16 @@
 import pandas as pd
 from ema_workbench import Model, MultiprocessingEvaluator, Policy, Scenario
 
-from ema_workbench.em_framework.evaluators import perform_experiments
-from ema_workbench.em_framework.samplers import sample_uncertainties
 from ema_workbench.util import ema_logging, save_results
+import argparse
+import os
 import time
 from problem_formulation_project_final import get_model_for_problem_formulation
+from funs_checkpoint import ExperimentCheckpoint, PreemptionHandler
+from funs_dispatch import ChunkedEvaluator
+from funs_memory import MemoryBudget, flush_batch_size
+from funs_mpi import get_evaluator, start_workers
+from funs_telemetry import Telemetry, TelemetryCallback
 
 """
 
@@ -18,11 +23,39 @@ policies. This approach ensures that no critical outcomes are overlooked, simila
 
 Ultimately, this script runs a total of 100000 experiments (5 policies * 20000 scenarios) for scenario discovery.
 
+The 20000 scenarios are stored in ./checkpoints/specific_policies together with every finished batch of
+experiments. Run the script again with --resume to skip the policies whose results file already exists and to
+continue the interrupted policy from its stored batches, using the same scenarios.
+Start the script with mpirun (or srun) and --mpi to run the experiments on all MPI ranks, possibly spread over 
+several nodes, e.g. mpirun -n 4 python dike_model_simulation_final_specific_policies.py --mpi
+Without --mpi the experiments run on the cores of the current machine, in chunks of about equal run time.
+The number of processes and the size of the batches are chosen to stay within the memory of the SLURM allocation
+(or --memory-budget), based on the memory of a worker measured at start-up; the memory model is logged.
+With --telemetry <directory> the wall time, number of simulated events and number of breaches of every experiment
+are stored as extra outcome columns, and the timeline of the workers and the straggler experiments are written to
+the directory, see funs_telemetry.py.
+
 """
 
 if __name__ == "__main__":
     ema_logging.log_to_stderr(ema_logging.INFO)
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", action="store_true", help="continue from stored results and batches")
+    parser.add_argument("--mpi", action="store_true", help="run the experiments on the MPI ranks")
+    parser.add_argument(
+        "--memory-budget", type=int, default=None, help="memory in MB, by default the SLURM allocation"
+    )
+    parser.add_argument(
+        "--telemetry", default=None, help="directory for the run time telemetry of the experiments and workers"
+    )
+    args = parser.parse_args()
+
+    # under MPI all ranks except rank 0 become workers and stay in start_workers
+    if args.mpi:
+        start_workers()
+    preemption = PreemptionHandler().install()
+
     # Load the five policies from a CSV file
     policies_df = pd.read_csv("data/5_best_policies.csv")
 
@@ -56,13 +89,41 @@ if __name__ == "__main__":
         policy_name = policy_dict.pop('policy_name')
         policies.append(Policy(policy_name, **policy_dict))
 
-    # Sample 20000 scenarios randomly
-    scenarios = sample_uncertainties(dike_model, 20000)
+    # Sample 20000 scenarios randomly, or reuse the scenarios of the previous job
+    checkpoint_dir = "./checkpoints/specific_policies"
+    scenario_checkpoint = ExperimentCheckpoint(checkpoint_dir)
+    scenarios, _ = scenario_checkpoint.setup_design(dike_model, 20000, policies, resume=args.resume)
 
     # Run experiments for each policy
     # Separate csv files are generated for each policy. We will use these files for scenario discovery.
     all_results = []
-    for policy in policies:
-        results = perform_experiments(dike_model, scenarios=scenarios, policies=policy)
-        all_results.append(results)
-        save_results(results, f"dike_model_results_policy_{policy.name}.tar.gz")
\ No newline at end of file
+    telemetry = Telemetry() if args.telemetry else None
+    memory_budget = MemoryBudget(None if args.memory_budget is None else args.memory_budget * 2**20)
+    with get_evaluator(
+        dike_model, mpi=args.mpi, fallback=ChunkedEvaluator, memory_budget=memory_budget, telemetry=telemetry
+    ) as evaluator:
+        try:
+            for policy in policies:
+                file_name = f"dike_model_results_policy_{policy.name}.tar.gz"
+                if args.resume and os.path.exists(file_name):
+                    print(f"skipping {policy.name}, results already stored")
+                    continue
+
+                checkpoint = ExperimentCheckpoint(
+                    os.path.join(checkpoint_dir, policy.name),
+                    batch_size=flush_batch_size(evaluator, 2000),
+                    preemption=preemption,
+                )
+                results = checkpoint.perform_experiments(
+                    dike_model,
+                    scenarios=scenarios,
+                    policies=policy,
+                    evaluator=evaluator,
+                    resume=args.resume,
+                    callback=TelemetryCallback if telemetry else None,
+                )
+                all_results.append(results)
+                save_results(results, file_name)
+        finally:
+            if telemetry is not None:
+                telemetry.save(args.telemetry)
\ No newline at end of file
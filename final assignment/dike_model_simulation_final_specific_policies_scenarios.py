@@ -1,11 +1,16 @@
 import pandas as pd
 from ema_workbench import Model, MultiprocessingEvaluator, Policy, Scenario
 
-from ema_workbench.em_framework.evaluators import perform_experiments
 from ema_workbench.em_framework.samplers import sample_uncertainties
 from ema_workbench.util import ema_logging, save_results
+import argparse
 import time
 from problem_formulation_project_final import get_model_for_problem_formulation
+from funs_checkpoint import ExperimentCheckpoint, PreemptionHandler
+from funs_dispatch import ChunkedEvaluator
+from funs_memory import MemoryBudget, flush_batch_size
+from funs_mpi import get_evaluator, start_workers
+from funs_telemetry import Telemetry, TelemetryCallback
 
 """
 
@@ -21,11 +26,38 @@ will be robust across all scenarios.
 For this analysis, we use problem formulation 8 as we are still refining the optimisation process and want to focus 
 on the specific outcomes that are critical for Water Board 3.
 
+The policies are evaluated in batches of 50 policies and every finished batch is stored in 
+./checkpoints/specific_policies_scenarios. Run the script again with --resume to only run the missing batches.
+
+Start the script with mpirun (or srun) and --mpi to run the experiments on all MPI ranks, possibly spread over 
+several nodes, e.g. mpirun -n 4 python dike_model_simulation_final_specific_policies_scenarios.py --mpi
+Without --mpi the experiments run on the cores of the current machine, in chunks of about equal run time.
+The number of processes and the size of the batches are chosen to stay within the memory of the SLURM allocation
+(or --memory-budget), based on the memory of a worker measured at start-up; the memory model is logged.
+With --telemetry <directory> the wall time, number of simulated events and number of breaches of every experiment
+are stored as extra outcome columns, and the timeline of the workers and the straggler experiments are written to
+the directory, see funs_telemetry.py.
+
 """
 
 if __name__ == "__main__":
     ema_logging.log_to_stderr(ema_logging.INFO)
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", action="store_true", help="continue from the stored batches")
+    parser.add_argument("--mpi", action="store_true", help="run the experiments on the MPI ranks")
+    parser.add_argument(
+        "--memory-budget", type=int, default=None, help="memory in MB, by default the SLURM allocation"
+    )
+    parser.add_argument(
+        "--telemetry", default=None, help="directory for the run time telemetry of the experiments and workers"
+    )
+    args = parser.parse_args()
+
+    # under MPI all ranks except rank 0 become workers and stay in start_workers
+    if args.mpi:
+        start_workers()
+
     # Load the 857 policies from a CSV file
     policies_df = pd.read_csv("data/857_policies_optimization.csv")
 
@@ -49,19 +81,39 @@ if __name__ == "__main__":
         policy_dict['policy_name'] = policy_name  # Add policy name to the dictionary
         policies.append(Policy(policy_name, **policy_dict))
 
-    # Run experiments for each policy on the five specific scenarios
-    all_results = []
-    for policy in policies:
-        results = perform_experiments(dike_model, scenarios=scenarios, policies=[policy])
-        experiments, outcomes = results
-        experiments_df = pd.DataFrame.from_dict(experiments)
-        outcomes_df = pd.DataFrame.from_dict(outcomes)
-        combined_df = pd.concat([experiments_df, outcomes_df], axis=1)
-        combined_df['policy_name'] = policy.name
-        all_results.append(combined_df)
-
-    # Concatenate all results into a single DataFrame
-    final_results_df = pd.concat(all_results, ignore_index=True)
+    # Run experiments for each policy on the five specific scenarios, in checkpointed batches of policies
+    checkpoint = ExperimentCheckpoint(
+        "./checkpoints/specific_policies_scenarios", batch_size=50, preemption=PreemptionHandler().install()
+    )
+    telemetry = Telemetry() if args.telemetry else None
+    memory_budget = MemoryBudget(None if args.memory_budget is None else args.memory_budget * 2**20)
+    with get_evaluator(
+        dike_model, mpi=args.mpi, fallback=ChunkedEvaluator, memory_budget=memory_budget, telemetry=telemetry
+    ) as evaluator:
+        # a batch of policies is run on all scenarios
+        checkpoint.batch_size = flush_batch_size(evaluator, checkpoint.batch_size, len(scenarios))
+        try:
+            experiments, outcomes = checkpoint.perform_experiments(
+                dike_model,
+                scenarios=scenarios,
+                policies=policies,
+                evaluator=evaluator,
+                resume=args.resume,
+                callback=TelemetryCallback if telemetry else None,
+            )
+        finally:
+            if telemetry is not None:
+                telemetry.save(args.telemetry)
+    experiments_df = pd.DataFrame.from_dict(experiments)
+    outcomes_df = pd.DataFrame.from_dict(outcomes)
+    final_results_df = pd.concat([experiments_df, outcomes_df], axis=1)
+    final_results_df['policy_name'] = final_results_df['policy']
+
+    # Keep the policy by policy ordering of the results
+    policy_order = {policy.name: i for i, policy in enumerate(policies)}
+    final_results_df = final_results_df.sort_values(
+        by='policy_name', key=lambda names: names.map(policy_order), kind='stable'
+    ).reset_index(drop=True)
 
     # Save the combined results to a single CSV file
     final_results_df.to_csv("dike_model_combined_results.csv", index=False)
@@ -0,0 +1,323 @@
+"""
+Active learning for scenario discovery.
+
+The open exploration samples 100,000 scenarios uniformly, while PRIM only
+needs to locate the edge of a small region of interest. run_adaptive_sampling
+spends the model runs near that edge instead:
+
+1. a uniform initial batch is evaluated, which also fixes the thresholds of
+   the condition that defines the cases of interest (percentiles of the
+   outcomes, as in the notebook),
+2. a classifier of the condition is fitted on all evaluated experiments,
+3. a large set of candidate scenarios is sampled and the next batch takes
+   the candidates for which the classifier is least certain, plus a share of
+   random candidates so regions the classifier deems certain are still
+   checked,
+4. PRIM is run on a uniform pool of scenarios labelled by the classifier,
+   which estimates the box, its coverage and its density as a uniform sample
+   would; the evaluated experiments themselves are concentrated around the
+   edge of the region and would bias both. The cases of interest are rare,
+   so the classifier seldom predicts them with a probability above 0.5.
+   Instead the pool points with the highest probability are labelled as
+   cases, as many as the share of cases in the uniform initial batch.
+
+Steps 2 to 4 repeat until a BoxStop rule finds that the box limits no longer
+move, or the budget of model runs is spent.
+"""
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import ExtraTreesClassifier
+
+import ema_workbench.analysis.prim as prim
+from ema_workbench import Scenario
+from ema_workbench.em_framework.parameters import CategoricalParameter
+from ema_workbench.em_framework.samplers import LHSSampler, sample_uncertainties
+from ema_workbench.util import EMAError, ema_logging
+
+from funs_results import _operators
+
+_logger = ema_logging.get_module_logger(__name__)
+
+
+def _categories(parameter):
+    return [category.value for category in parameter.categories]
+
+
+def encode(experiments, uncertainties):
+    """Uncertainty values as a float matrix, categories as their index"""
+    columns = []
+    for parameter in uncertainties:
+        values = experiments[parameter.name]
+        if isinstance(parameter, CategoricalParameter):
+            values = pd.Categorical(np.asarray(values), categories=_categories(parameter)).codes
+        columns.append(np.asarray(values, dtype=float))
+    return np.column_stack(columns)
+
+
+class SeededLHSSampler(LHSSampler):
+    """LHSSampler drawing from a numpy Generator instead of the global
+    random state"""
+
+    def __init__(self, rng):
+        super().__init__()
+        self.rng = rng
+
+    def sample(self, distribution, size):
+        perc = self.rng.permutation(size) / size
+        samples = distribution.ppf(perc + self.rng.random(size) / size)
+        return samples[~np.isnan(samples)]
+
+
+def _sample(model, uncertainties, n, rng):
+    """n uniformly sampled scenarios as a DataFrame, categorical columns
+    with a categorical dtype as in the experiments of the workbench"""
+    points = sample_uncertainties(model, n, sampler=SeededLHSSampler(rng))
+    points = pd.DataFrame([dict(point) for point in points])
+    for parameter in uncertainties:
+        if isinstance(parameter, CategoricalParameter):
+            points[parameter.name] = pd.Categorical(
+                points[parameter.name], categories=_categories(parameter)
+            )
+    return points[[parameter.name for parameter in uncertainties]]
+
+
+def thresholds_from_percentiles(outcomes, conditions):
+    """Absolute thresholds of conditions given as (outcome, operator,
+    percentile) tuples"""
+    return [
+        (outcome, op, np.percentile(outcomes[outcome], percentile))
+        for outcome, op, percentile in conditions
+    ]
+
+
+def label(outcomes, thresholds):
+    """Boolean array of the experiments that meet all thresholds"""
+    y = None
+    for outcome, op, value in thresholds:
+        met = _operators[op](np.asarray(outcomes[outcome]), value)
+        y = met if y is None else y & met
+    return y
+
+
+def label_pool(p, base_rate):
+    """Label the share base_rate of the pool with the highest probability p
+    as cases of interest, points with a probability of 0 never are"""
+    n_cases = int(round(base_rate * len(p)))
+    labels = np.zeros(len(p), dtype=bool)
+    labels[np.argsort(-p, kind="stable")[:n_cases]] = True
+    return labels & (p > 0)
+
+
+def select_box(box, threshold):
+    """Select the box with the highest coverage among those with a density
+    of at least threshold, or the densest box"""
+    trajectory = box.peeling_trajectory
+    candidates = trajectory[trajectory["density"] >= threshold]
+    if candidates.empty:
+        index = trajectory["density"].idxmax()
+    else:
+        index = candidates["coverage"].idxmax()
+    box.select(int(index))
+    return trajectory.loc[index]
+
+
+def box_distance(lims, other, uncertainties):
+    """Largest change between two sets of box limits
+
+    Real and integer limits are compared relative to the range of the
+    uncertainty, categorical limits as one minus the Jaccard similarity of
+    the categories in the box.
+    """
+    distance = 0.0
+    for parameter in uncertainties:
+        name = parameter.name
+        if isinstance(parameter, CategoricalParameter):
+            a = set(lims[name].iloc[0]) if name in lims else set(_categories(parameter))
+            b = set(other[name].iloc[0]) if name in other else set(_categories(parameter))
+            distance = max(distance, 1 - len(a & b) / len(a | b))
+        else:
+            span = parameter.upper_bound - parameter.lower_bound
+            a = lims[name] if name in lims else [parameter.lower_bound, parameter.upper_bound]
+            b = other[name] if name in other else [parameter.lower_bound, parameter.upper_bound]
+            change = np.max(np.abs(np.asarray(a, dtype=float) - np.asarray(b, dtype=float)))
+            distance = max(distance, change / span)
+    return distance
+
+
+class BoxStop:
+    """Stopping rule for run_adaptive_sampling
+
+    Parameters
+    ----------
+    tolerance : float, optional
+                largest change of the box limits, relative to the range of
+                the uncertainties, that counts as stable
+    window : int, optional
+             number of consecutive batches over which the box has to be
+             stable
+    min_experiments : int, optional
+                      never stop before this number of model runs
+    """
+
+    def __init__(self, tolerance=0.05, window=2, min_experiments=0):
+        self.tolerance = tolerance
+        self.window = window
+        self.min_experiments = min_experiments
+        self.reason = None
+
+    def __call__(self, history):
+        if len(history) <= self.window or history[-1]["n_experiments"] < self.min_experiments:
+            return False
+        changes = [entry["box_change"] for entry in history[-self.window :]]
+        # a batch without a box is never stable
+        if not np.isnan(changes).any() and max(changes) <= self.tolerance:
+            self.reason = (
+                f"box limits changed less than {self.tolerance} over {self.window} batches "
+                f"after {history[-1]['n_experiments']} experiments"
+            )
+            return True
+        return False
+
+
+def run_adaptive_sampling(
+    model,
+    evaluator,
+    conditions,
+    policy=None,
+    initial_size=1000,
+    batch_size=500,
+    max_experiments=20000,
+    n_candidates=None,
+    pool_size=20000,
+    exploration=0.2,
+    prim_threshold=0.6,
+    stopping_rule=None,
+    seed=None,
+):
+    """Scenario discovery with adaptive sampling
+
+    Parameters
+    ----------
+    model : Model instance
+    evaluator : evaluator instance
+    conditions : list of (outcome, operator, percentile) tuples
+                 the cases of interest meet all conditions; the percentiles
+                 are taken over the uniform initial batch
+    policy : Policy instance, optional
+    initial_size : int, optional
+    batch_size : int, optional
+    max_experiments : int, optional
+    n_candidates : int, optional
+                   candidates sampled for every batch, 20 times the batch
+                   size by default
+    pool_size : int, optional
+                size of the uniform pool labelled by the classifier for PRIM
+    exploration : float, optional
+                  share of every batch taken at random from the candidates
+    prim_threshold : float, optional
+    stopping_rule : callable, optional
+                    called with the history after every batch, e.g. BoxStop
+    seed : int, optional
+           seed of the sampled scenarios and of the classifier
+
+    Returns
+    -------
+    tuple
+        experiments DataFrame, outcomes dict, history DataFrame with one row
+        per batch, and the last PrimBox that was found, or None
+
+    As long as the labelled pool holds only cases or no cases at all, no box
+    is found and the sampling continues.
+    """
+    if initial_size > max_experiments:
+        raise EMAError("the initial batch is larger than the budget of experiments")
+    uncertainties = list(model.uncertainties)
+    names = [parameter.name for parameter in uncertainties]
+    rng = np.random.default_rng(seed)
+    if n_candidates is None:
+        n_candidates = 20 * batch_size
+    scenario_ids = iter(range(max_experiments))
+
+    def evaluate(points):
+        scenarios = [
+            Scenario(f"adaptive {next(scenario_ids)}", **dict(zip(names, row)))
+            for row in points.itertuples(index=False)
+        ]
+        kwargs = {} if policy is None else {"policies": policy}
+        return evaluator.perform_experiments(scenarios=scenarios, **kwargs)
+
+    experiments, outcomes = evaluate(_sample(model, uncertainties, initial_size, rng))
+    thresholds = thresholds_from_percentiles(outcomes, conditions)
+    base_rate = label(outcomes, thresholds).mean()
+    _logger.info(f"cases of interest: {thresholds}, {base_rate:.1%} of the initial batch")
+
+    pool = _sample(model, uncertainties, pool_size, rng)
+    pool_x = encode(pool, uncertainties)
+    history = []
+    previous = None
+    box = None
+    while True:
+        x = encode(experiments, uncertainties)
+        y = label(outcomes, thresholds)
+        classifier = ExtraTreesClassifier(
+            n_estimators=200, min_samples_leaf=2, random_state=int(rng.integers(2**31 - 1))
+        )
+        classifier.fit(x, y)
+
+        def probability(data):
+            proba = classifier.predict_proba(data)
+            if proba.shape[1] == 1:
+                return np.full(len(data), float(classifier.classes_[0]))
+            return proba[:, list(classifier.classes_).index(True)]
+
+        entry = {
+            "n_experiments": len(experiments),
+            "n_cases": int(y.sum()),
+            "coverage": np.nan,
+            "density": np.nan,
+            "res_dim": np.nan,
+            "box_change": np.nan,
+        }
+        pool_y = label_pool(probability(pool_x), base_rate)
+        if pool_y.any() and not pool_y.all():
+            box = prim.Prim(pool, pool_y, threshold=prim_threshold).find_box()
+            selected = select_box(box, prim_threshold)
+            lims = box.box_lim
+            entry.update(
+                coverage=selected["coverage"],
+                density=selected["density"],
+                res_dim=int(selected["res_dim"]),
+                box_change=np.nan if previous is None else box_distance(lims, previous, uncertainties),
+            )
+            previous = lims
+        else:
+            _logger.info("the labelled pool has a single class, no box for this batch")
+        history.append(entry)
+        _logger.info(
+            f"{entry['n_experiments']} experiments, {entry['n_cases']} cases of interest, "
+            f"box coverage {entry['coverage']:.2f}, density {entry['density']:.2f}, "
+            f"change {entry['box_change']:.3f}"
+        )
+
+        if stopping_rule is not None and stopping_rule(history):
+            _logger.info(f"stopping the adaptive sampling, {stopping_rule.reason}")
+            break
+        n_batch = min(batch_size, max_experiments - len(experiments))
+        if n_batch <= 0:
+            _logger.info(f"budget of {max_experiments} experiments spent")
+            break
+
+        # the most uncertain candidates lie closest to the estimated boundary
+        candidates = _sample(model, uncertainties, n_candidates, rng)
+        p = probability(encode(candidates, uncertainties))
+        n_random = int(round(exploration * n_batch))
+        order = np.argsort(-p * (1 - p), kind="stable")
+        chosen = order[: n_batch - n_random]
+        rest = order[n_batch - n_random :]
+        chosen = np.concatenate([chosen, rng.choice(rest, size=n_random, replace=False)])
+
+        batch_experiments, batch_outcomes = evaluate(candidates.iloc[chosen])
+        experiments = pd.concat([experiments, batch_experiments], ignore_index=True)
+        outcomes = {k: np.concatenate([v, batch_outcomes[k]]) for k, v in outcomes.items()}
+
+    return experiments, outcomes, pd.DataFrame(history), box
@@ -0,0 +1,314 @@
+"""
+Delta encoded store for the archive snapshots of the direct search.
+
+The workbench ArchiveLogger writes a full CSV copy of the archive at every
+convergence check and packs all copies into a tar.gz at the end of the run.
+Consecutive snapshots are almost identical, so most of that I/O repeats rows
+that were already written.
+
+DeltaArchiveLogger writes a single binary file per run instead. A snapshot
+is stored as the rows that entered the archive and the ids of the rows that
+left it since the previous snapshot, with the new rows stored column by
+column in the dtype of the column. The file only grows by these deltas and
+never has to be packed.
+
+DeltaArchiveReader replays the deltas to rebuild any snapshot and iterates
+over all snapshots in order, e.g. for the convergence metrics of
+funs_convergence. load_archives returns the same dict of DataFrames as
+ArchiveLogger.load_archives.
+
+File layout: the magic bytes, the length of a JSON header with the column
+names and dtypes and the header itself, followed by one record per snapshot.
+A record holds the nfe, the number of removed and of added rows, the ids of
+the removed rows and every column of the added rows. Rows get consecutive
+ids in the order in which they are added.
+
+Only numeric columns can be stored. The outcomes are stored as float64, the
+levers as int64 or float64 depending on the values in the first non-empty
+snapshot. The first snapshots of a run are taken before anything has been
+evaluated, so the header is only written once the archive holds a solution.
+"""
+import json
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+
+from ema_workbench.em_framework.optimization import AbstractConvergenceMetric, to_dataframe
+from ema_workbench.util import EMAError, ema_logging
+
+_logger = ema_logging.get_module_logger(__name__)
+
+MAGIC = b"DARCHIVE"
+VERSION = 1
+
+_LENGTH = struct.Struct("<i")
+_RECORD = struct.Struct("<qii")
+
+
+def _row_keys(data):
+    """Hash of every row, used to match rows between snapshots"""
+    return pd.util.hash_pandas_object(data, index=False).to_numpy()
+
+
+def _column_dtypes(archive, outcome_varnames):
+    """int64 or float64 for every column of a non-empty archive
+
+    Raises
+    ------
+    EMAError if a column does not hold numbers, e.g. a categorical lever
+    """
+    dtypes = []
+    for column in archive.columns:
+        values = archive[column]
+        if column in outcome_varnames:
+            dtypes.append(np.dtype("<f8"))
+            continue
+        if values.dtype == object:
+            try:
+                values = pd.to_numeric(values)
+            except (TypeError, ValueError):
+                raise EMAError(f"column {column} is not numeric and cannot be stored in a delta archive")
+        if values.dtype.kind in "biu":
+            dtypes.append(np.dtype("<i8"))
+        elif values.dtype.kind == "f":
+            dtypes.append(np.dtype("<f8"))
+        else:
+            raise EMAError(f"column {column} has dtype {values.dtype} and cannot be stored in a delta archive")
+    return dtypes
+
+
+def _write_header(fh, columns, dtypes):
+    header = json.dumps(
+        {"version": VERSION, "columns": list(columns), "dtypes": [np.dtype(d).str for d in dtypes]}
+    ).encode()
+    fh.write(MAGIC)
+    fh.write(_LENGTH.pack(len(header)))
+    fh.write(header)
+
+
+def _write_record(fh, nfe, removed, added, dtypes):
+    fh.write(_RECORD.pack(nfe, len(removed), len(added)))
+    fh.write(np.asarray(removed, dtype="<i8").tobytes())
+    for column, dtype in zip(added.columns, dtypes):
+        fh.write(np.ascontiguousarray(added[column].to_numpy(dtype=dtype)).tobytes())
+
+
+class DeltaArchiveReader:
+    """Read a file written by DeltaArchiveLogger
+
+    Parameters
+    ----------
+    filename : str
+
+    Raises
+    ------
+    EMAError if the file is not a delta archive
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise EMAError(f"{filename} is not a delta archive")
+            (length,) = _LENGTH.unpack(fh.read(_LENGTH.size))
+            header = json.loads(fh.read(length))
+            self.data_offset = fh.tell()
+
+        if header["version"] != VERSION:
+            raise EMAError(f"unsupported delta archive version {header['version']}")
+        self.columns = header["columns"]
+        self.dtypes = [np.dtype(d) for d in header["dtypes"]]
+
+    def records(self):
+        """Iterate over the raw records
+
+        Yields
+        ------
+        tuple
+            nfe, ids of the removed rows, dict with the columns of the added
+            rows, and the file offset of the end of the record
+        """
+        with open(self.filename, "rb") as fh:
+            fh.seek(self.data_offset)
+            while True:
+                raw = fh.read(_RECORD.size)
+                if len(raw) < _RECORD.size:
+                    # a record cut off by a killed job is ignored
+                    return
+                nfe, n_removed, n_added = _RECORD.unpack(raw)
+                removed = np.frombuffer(fh.read(8 * n_removed), dtype="<i8")
+                added = {}
+                for column, dtype in zip(self.columns, self.dtypes):
+                    buffer = fh.read(dtype.itemsize * n_added)
+                    if len(buffer) < dtype.itemsize * n_added:
+                        return
+                    added[column] = np.frombuffer(buffer, dtype=dtype)
+                yield nfe, removed, added, fh.tell()
+
+    def _replay(self):
+        """Yield nfe, the row ids and the rows of every snapshot, and the file
+        offset and the next row id after it"""
+        rows = {column: np.empty(0, dtype=dtype) for column, dtype in zip(self.columns, self.dtypes)}
+        ids = np.empty(0, dtype=np.int64)
+        next_id = 0
+        for nfe, removed, added, end in self.records():
+            keep = ~np.isin(ids, removed)
+            n_added = len(next(iter(added.values()))) if added else 0
+            ids = np.concatenate([ids[keep], np.arange(next_id, next_id + n_added)])
+            next_id += n_added
+            rows = {c: np.concatenate([rows[c][keep], added[c]]) for c in self.columns}
+            yield nfe, ids, rows, end, next_id
+
+    def __iter__(self):
+        """Iterate over the snapshots in order, yields nfe and DataFrame"""
+        for nfe, _, rows, _, _ in self._replay():
+            yield nfe, pd.DataFrame(rows, columns=self.columns)
+
+    def iter_columns(self, columns):
+        """Iterate over the snapshots, yields nfe and a 2d array with the
+        values of columns, which is all the convergence metrics need"""
+        for nfe, _, rows, _, _ in self._replay():
+            yield nfe, np.column_stack([rows[c] for c in columns]).astype(float)
+
+    @property
+    def nfes(self):
+        return [nfe for nfe, _, _, _ in self.records()]
+
+    def snapshot(self, nfe):
+        """The archive as it was at nfe, or at the last snapshot before it
+
+        Raises
+        ------
+        EMAError if there is no snapshot at or before nfe
+        """
+        result = None
+        for snapshot_nfe, archive in self:
+            if snapshot_nfe > nfe:
+                break
+            result = archive
+        if result is None:
+            raise EMAError(f"no snapshot at or before nfe {nfe} in {self.filename}")
+        return result
+
+
+def load_archives(filename):
+    """All snapshots of a delta archive, as a dict with nfe as key and a
+    DataFrame as value, like ArchiveLogger.load_archives"""
+    return dict(iter(DeltaArchiveReader(filename)))
+
+
+class DeltaArchiveLogger(AbstractConvergenceMetric):
+    """Convergence metric that appends the changes of the archive to a delta
+    archive file
+
+    Parameters
+    ----------
+    directory : str
+    decision_varnames : list of str
+    outcome_varnames : list of str
+    base_filename : str, optional
+
+    The file offset after every snapshot is kept in results, so the results
+    stored with a checkpoint of funs_checkpoint tell a resumed run where to
+    continue the file; snapshots written after the checkpoint are dropped.
+    Snapshots of the still empty archive have no offset until the header is
+    written with the first solution.
+    """
+
+    def __init__(self, directory, decision_varnames, outcome_varnames, base_filename="archive.darc"):
+        super().__init__("archive_logger")
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.decision_varnames = decision_varnames
+        self.outcome_varnames = outcome_varnames
+        self.filename = os.path.join(self.directory, base_filename)
+
+        self._fh = None
+        self._dtypes = None
+        self._current = {}
+        self._next_id = 0
+
+    @property
+    def _started(self):
+        """True if the file of a resumed run already has a header"""
+        return bool(self.results) and self.results[-1][1] is not None and os.path.exists(self.filename)
+
+    def _open(self, archive):
+        if self._started:
+            # resumed run, continue after the last snapshot of the checkpoint
+            end = self.results[-1][1]
+            reader = DeltaArchiveReader(self.filename)
+            for _, ids, rows, offset, next_id in reader._replay():
+                if offset == end:
+                    data = pd.DataFrame(rows, columns=reader.columns)
+                    self._current = dict(zip(_row_keys(data), ids))
+                    self._next_id = next_id
+                    break
+            else:
+                raise EMAError(f"{self.filename} does not match the checkpoint")
+            self._dtypes = reader.dtypes
+            self._fh = open(self.filename, "r+b")
+            self._fh.truncate(end)
+            self._fh.seek(end)
+            _logger.info(f"continuing {self.filename} after nfe {self.results[-1][0]}")
+        else:
+            if archive.empty:
+                # nothing to take the lever dtypes from, only at the end of a run without solutions
+                self._dtypes = [np.dtype("<f8")] * len(archive.columns)
+            else:
+                self._dtypes = _column_dtypes(archive, self.outcome_varnames)
+            self._fh = open(self.filename, "wb")
+            _write_header(self._fh, archive.columns, self._dtypes)
+
+            # the empty snapshots taken before the first solution
+            for i, (nfe, _) in enumerate(self.results):
+                _write_record(self._fh, nfe, [], archive.iloc[:0], self._dtypes)
+                self.results[i] = (nfe, self._fh.tell())
+
+    def __call__(self, optimizer):
+        archive = to_dataframe(optimizer.result, self.decision_varnames, self.outcome_varnames)
+        if self._fh is None:
+            if archive.empty and not self._started:
+                self.results.append((optimizer.nfe, None))
+                return
+            self._open(archive)
+        # the row keys of a resumed run are hashed from the stored dtypes
+        archive = archive.astype(dict(zip(archive.columns, self._dtypes)))
+
+        # identical rows can only be told apart by position, only one is kept
+        keys = _row_keys(archive)
+        unique = ~pd.Series(keys).duplicated().to_numpy()
+        archive, keys = archive[unique], keys[unique]
+        new_keys = set(keys)
+        removed = [i for key, i in self._current.items() if key not in new_keys]
+        is_added = np.array([key not in self._current for key in keys], dtype=bool)
+
+        _write_record(self._fh, optimizer.nfe, removed, archive[is_added], self._dtypes)
+        self._fh.flush()
+
+        for key in [key for key in self._current if key not in new_keys]:
+            del self._current[key]
+        for key in keys[is_added]:
+            self._current[key] = self._next_id
+            self._next_id += 1
+        self.results.append((optimizer.nfe, self._fh.tell()))
+
+    def reset(self):
+        super().reset()
+        self.close()
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def get_results(self):
+        if self._fh is None and self.results and not self._started:
+            # the archive stayed empty, still write a readable file
+            columns = list(self.decision_varnames) + list(self.outcome_varnames)
+            self._open(pd.DataFrame(columns=columns))
+        self.close()
+        return None
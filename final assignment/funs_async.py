@@ -0,0 +1,342 @@
+"""
+Asynchronous, steady-state direct search.
+
+The generational loop of run_optimization evaluates a full generation and
+waits for its slowest member before the next generation is created. The run
+time of the dike model varies strongly between lever combinations (events
+with breaches are simulated with the stepwise dike failure branch), so most
+workers idle at every generation barrier.
+
+run_async_optimization keeps every worker busy instead: as soon as a worker
+returns a result, the solution is added to the epsilon archive and the
+population, a new offspring is bred from the current population and sent to
+the idle worker. The archive, and with it EpsilonProgress and the
+ArchiveLogger, is updated after every single evaluation. The convergence
+metrics are recorded at the usual convergence frequency.
+
+Besides the results and the convergence information, the run reports the
+utilization of the workers: the fraction of the available worker time that
+was spent evaluating.
+"""
+import collections
+import itertools
+import queue
+import time
+
+from platypus import (
+    EpsilonBoxArchive,
+    PlatypusConfig,
+    RandomGenerator,
+    TournamentSelector,
+    nondominated_sort,
+    nondominated_truncate,
+)
+
+from ema_workbench import MultiprocessingEvaluator, Policy
+from ema_workbench.em_framework import callbacks, evaluators
+from ema_workbench.em_framework.futures_multiprocessing import worker
+from ema_workbench.em_framework.optimization import (
+    Convergence,
+    to_dataframe,
+    to_problem,
+    transform_variables,
+)
+from ema_workbench.em_framework.points import experiment_generator
+from ema_workbench.util import EMAError, ema_logging
+from ema_workbench.util.ema_logging import INFO, temporary_filter
+
+from funs_checkpoint import CampaignInterrupted
+from funs_mpi import MPIClusterEvaluator
+from funs_optimization import _default_variator, warm_start_generator
+
+_logger = ema_logging.get_module_logger(__name__)
+
+
+class _PoolDispatcher:
+    """Submit single experiments to the pool of a MultiprocessingEvaluator"""
+
+    def __init__(self, evaluator):
+        self.pool = evaluator._pool
+        self.capacity = evaluator.n_processes
+        self.done = queue.Queue()
+
+    def submit(self, experiment):
+        self.pool.apply_async(
+            worker, (experiment,), callback=self.done.put, error_callback=self.done.put
+        )
+
+    def collect(self):
+        result = self.done.get()
+        if isinstance(result, BaseException):
+            raise EMAError("experiment failed") from result
+        return result
+
+
+class _MPIDispatcher:
+    """Submit single experiments to the workers of an MPIClusterEvaluator"""
+
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+        self.capacity = evaluator.n_processes
+
+    def submit(self, experiment):
+        self.evaluator.submit(experiment)
+
+    def collect(self):
+        return self.evaluator.collect()
+
+
+class _BlockingDispatcher:
+    """Fallback for other evaluators, runs every experiment on submission"""
+
+    capacity = 1
+
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+        self.done = collections.deque()
+
+    def submit(self, experiment):
+        self.evaluator.evaluate_experiments(
+            [experiment.scenario],
+            [experiment.policy],
+            lambda experiment, outcomes: self.done.append((experiment, outcomes)),
+        )
+
+    def collect(self):
+        return self.done.popleft()
+
+
+def get_dispatcher(evaluator):
+    if isinstance(evaluator, MultiprocessingEvaluator):
+        return _PoolDispatcher(evaluator)
+    if isinstance(evaluator, MPIClusterEvaluator):
+        return _MPIDispatcher(evaluator)
+    return _BlockingDispatcher(evaluator)
+
+
+class SteadyStateEpsNSGAII:
+    """Steady-state variant of epsilon NSGA-II
+
+    Parameters
+    ----------
+    problem : platypus Problem instance
+    epsilons : list of float
+    population_size : int, optional
+    variator : platypus Variator instance, optional
+    generator : platypus Generator instance, optional
+    selector : platypus Selector instance, optional
+
+    The attributes mirror those of the platypus algorithms (population,
+    archive, nfe, result), so the convergence metrics and the checkpoints
+    work unchanged.
+    """
+
+    def __init__(
+        self,
+        problem,
+        epsilons,
+        population_size=100,
+        variator=None,
+        generator=RandomGenerator(),
+        selector=TournamentSelector(2),
+    ):
+        self.problem = problem
+        self.population_size = population_size
+        self.variator = variator
+        self.generator = generator
+        self.selector = selector
+
+        self.population = []
+        self.archive = EpsilonBoxArchive(epsilons)
+        self.result = self.archive
+        self.nfe = 0
+        self.n_generated = 0
+        self._offspring = collections.deque()
+
+    def next_candidate(self):
+        """Random solutions until the initial population is generated,
+        offspring of the current population afterwards"""
+        if self.n_generated < self.population_size or len(self.population) < self.variator.arity:
+            candidate = self.generator.generate(self.problem)
+        else:
+            if not self._offspring:
+                parents = self.selector.select(self.variator.arity, self.population)
+                self._offspring.extend(self.variator.evolve(parents))
+            candidate = self._offspring.popleft()
+        self.n_generated += 1
+        return candidate
+
+    def add(self, solution):
+        """Add an evaluated solution to the archive and the population"""
+        self.nfe += 1
+        self.archive.add(solution)
+
+        self.population.append(solution)
+        if len(self.population) > self.population_size:
+            nondominated_sort(self.population)
+            self.population = nondominated_truncate(self.population, self.population_size)
+
+
+def _to_policy(solution, problem, name):
+    values = transform_variables(problem, solution.variables)
+    levers = {}
+    for parameter, value in zip(problem.parameters, values):
+        levers[parameter.name] = getattr(value, "value", value)
+    return Policy(name=name, **levers)
+
+
+def run_async_optimization(
+    model,
+    evaluator,
+    nfe,
+    epsilons,
+    reference=None,
+    convergence=None,
+    convergence_freq=1000,
+    logging_freq=5,
+    population_size=100,
+    variator=None,
+    checkpoint=None,
+    warm_start=None,
+    stopping_rule=None,
+):
+    """Steady-state optimization over the levers with asynchronous evaluation
+
+    Parameters
+    ----------
+    model : Model instance
+    evaluator : evaluator instance
+                MultiprocessingEvaluator or MPIClusterEvaluator, other
+                evaluators run one experiment at a time
+    nfe : int
+    epsilons : list of float
+    reference : Scenario instance, optional
+    convergence : list of convergence metrics, optional
+    convergence_freq : int, optional
+    logging_freq : int, optional
+                   number of population_size evaluations between logging
+    population_size : int, optional
+    variator : platypus Variator instance, optional
+    checkpoint : OptimizationCheckpoint instance, optional
+    warm_start : DataFrame, optional
+                 lever values of stored policies used to seed the initial
+                 population, see load_stored_policies
+    stopping_rule : callable, optional
+                    called with the optimizer every population_size
+                    evaluations, when it returns True no new candidates are
+                    submitted and the run ends once the running evaluations
+                    are collected
+
+    Returns
+    -------
+    tuple
+        DataFrame with the final archive, DataFrame with the convergence
+        information and a dict with the utilization of the workers
+    """
+    problem = to_problem(model, "levers", reference=reference)
+    if problem.ema_constraints:
+        raise EMAError("constraints are not supported by the asynchronous optimization")
+    if len(epsilons) != len(problem.outcome_names):
+        raise EMAError("Number of epsilon values does not match number of outcomes")
+
+    if variator is None:
+        variator = _default_variator(problem) or PlatypusConfig.default_variator(problem)
+
+    generator = RandomGenerator()
+    if warm_start is not None and len(warm_start):
+        generator = warm_start_generator(problem, warm_start, population_size=population_size)
+
+    optimizer = SteadyStateEpsNSGAII(
+        problem, epsilons, population_size=population_size, variator=variator, generator=generator
+    )
+    convergence = Convergence(
+        convergence, nfe, convergence_freq=convergence_freq, logging_freq=logging_freq
+    )
+    if checkpoint is not None and checkpoint.exists:
+        extra = checkpoint.restore(optimizer, convergence)
+        optimizer.n_generated = optimizer.nfe
+        if stopping_rule is not None and "stopping_rule" in extra:
+            stopping_rule.set_state(extra["stopping_rule"])
+
+    def save():
+        extra = {"stopping_rule": stopping_rule.get_state()} if stopping_rule is not None else None
+        checkpoint.save(optimizer, convergence, extra=extra)
+
+    dispatcher = get_dispatcher(evaluator)
+    scenario = problem.reference
+    names = itertools.count()
+    in_flight = {}
+
+    def submit():
+        solution = optimizer.next_candidate()
+        policy = _to_policy(solution, problem, str(next(names)))
+        experiment = next(experiment_generator([scenario], [model], [policy]))
+        in_flight[policy.name] = (solution, time.perf_counter())
+        dispatcher.submit(experiment)
+
+    busy_time = 0.0
+    durations = []
+    last_generation = optimizer.nfe
+    converged = False
+    start = time.perf_counter()
+
+    with temporary_filter(name=[callbacks.__name__, evaluators.__name__], level=INFO):
+        convergence(optimizer)
+        while optimizer.nfe + len(in_flight) < nfe and len(in_flight) < dispatcher.capacity:
+            submit()
+
+        while in_flight:
+            experiment, outcomes = dispatcher.collect()
+            solution, submitted = in_flight.pop(experiment.policy.name)
+            duration = time.perf_counter() - submitted
+            busy_time += duration
+            durations.append(duration)
+
+            solution.objectives[:] = [outcomes[name] for name in problem.outcome_names]
+            solution.constraint_violation = 0.0
+            solution.evaluated = True
+            optimizer.add(solution)
+
+            stopping = (
+                checkpoint is not None
+                and checkpoint.preemption is not None
+                and checkpoint.preemption.stop_requested
+            )
+            if optimizer.nfe + len(in_flight) < nfe and not stopping and not converged:
+                submit()
+
+            if optimizer.nfe - last_generation >= population_size:
+                last_generation = optimizer.nfe
+                convergence(optimizer)
+                if stopping_rule is not None and not converged and stopping_rule(optimizer):
+                    _logger.info(f"stopping at nfe {optimizer.nfe}, {stopping_rule.reason}")
+                    converged = True
+
+            if converged:
+                continue
+            if checkpoint is not None and not in_flight and stopping and optimizer.nfe < nfe:
+                save()
+                raise CampaignInterrupted(f"optimization stopped at nfe {optimizer.nfe}")
+            if checkpoint is not None and checkpoint.due(optimizer) and not stopping:
+                save()
+
+    wall_time = time.perf_counter() - start
+    if convergence.last_check != optimizer.nfe:
+        convergence(optimizer, force=True)
+
+    utilization = {
+        "n_workers": dispatcher.capacity,
+        "nfe": len(durations),
+        "wall_time": wall_time,
+        "busy_time": busy_time,
+        "utilization": busy_time / (dispatcher.capacity * wall_time) if wall_time else 0.0,
+        "mean_evaluation_time": busy_time / len(durations) if durations else 0.0,
+        "max_evaluation_time": max(durations, default=0.0),
+    }
+    _logger.info(
+        f"asynchronous optimization completed, found {len(optimizer.archive)} solutions, "
+        f"worker utilization {utilization['utilization']:.0%}"
+    )
+
+    results = to_dataframe(optimizer.result, problem.parameter_names, problem.outcome_names)
+    return results, convergence.to_dataframe(), utilization
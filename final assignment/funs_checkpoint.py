@@ -0,0 +1,454 @@
+"""
+Checkpoint and resume support for long experiment and optimization campaigns.
+
+A SLURM job that hits its wall time loses everything that is still in memory.
+The helpers in this module split a campaign into small units of work and write
+every finished unit to a checkpoint directory, so that the same driver can be
+started again with ``--resume`` and continues where the previous job stopped.
+
+* ExperimentCheckpoint stores the sampled design once and then runs the
+  experiments in batches, writing each completed batch to disk.
+* OptimizationCheckpoint periodically stores the population, the epsilon
+  archive, the convergence bookkeeping and the RNG state of an optimizer.
+"""
+import json
+import os
+import pickle
+import random
+import signal
+import time
+
+import numpy as np
+import pandas as pd
+
+from ema_workbench import Policy, Scenario
+from ema_workbench.em_framework.evaluators import perform_experiments
+from ema_workbench.em_framework.optimization import (
+    AbstractConvergenceMetric,
+    ArchiveLogger,
+)
+from ema_workbench.em_framework.samplers import sample_uncertainties
+from ema_workbench.util import ema_logging
+
+_logger = ema_logging.get_module_logger(__name__)
+
+
+def get_rng_state():
+    """Return the state of the python and numpy random number generators"""
+    return {"python": random.getstate(), "numpy": np.random.get_state()}
+
+
+def set_rng_state(state):
+    """Restore a state returned by get_rng_state"""
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+
+
+def atomic_pickle(obj, filename):
+    """Pickle obj to filename, replacing the file only once it is complete
+
+    A job that is killed while writing leaves the previous checkpoint intact.
+    """
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "wb") as fh:
+        pickle.dump(obj, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_filename, filename)
+
+
+def load_pickle(filename):
+    with open(filename, "rb") as fh:
+        return pickle.load(fh)
+
+
+class PreemptionHandler:
+    """Turn SIGTERM / SIGUSR1 into a flag that the campaign loops check
+
+    SLURM sends SIGTERM at the wall time, or the signal requested with
+    ``#SBATCH --signal`` some time before it. Instead of dying halfway through
+    a batch, the drivers finish the current unit of work, write a checkpoint
+    and exit, so that the next job can resume.
+    """
+
+    signals = ("SIGTERM", "SIGUSR1")
+
+    def __init__(self):
+        self.stop_requested = False
+
+    def install(self):
+        for name in self.signals:
+            signum = getattr(signal, name, None)
+            if signum is not None:
+                signal.signal(signum, self._handle)
+        return self
+
+    def _handle(self, signum, frame):
+        _logger.info(f"received signal {signum}, stopping after the current step")
+        self.stop_requested = True
+
+
+class CampaignInterrupted(Exception):
+    """Raised when a campaign stopped early after a preemption signal"""
+
+
+class ExperimentCheckpoint:
+    """Run perform_experiments in batches and store every finished batch
+
+    Parameters
+    ----------
+    directory : str
+                checkpoint directory for this campaign
+    batch_size : int, optional
+                 number of scenarios (or policies) per batch
+    preemption : PreemptionHandler instance, optional
+
+    The sampled scenarios and policies are stored in the checkpoint directory
+    the first time the campaign runs. A resumed campaign reuses this design,
+    so the experiments of the finished batches stay valid, and only runs the
+    batches that have no result file yet.
+    """
+
+    design_file = "design.pkl"
+    state_file = "state.json"
+
+    def __init__(self, directory, batch_size=1000, preemption=None):
+        self.directory = os.path.abspath(directory)
+        self.batch_size = batch_size
+        self.preemption = preemption
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _batch_file(self, i):
+        return self._path(f"batch_{i:05d}.pkl")
+
+    def setup_design(self, model, scenarios, policies, resume=True):
+        """Load the stored design, or sample and store a new one
+
+        Parameters
+        ----------
+        model : Model instance
+        scenarios : int or collection of Scenario instances
+        policies : Policy instance or collection of Policy instances
+        resume : bool, optional
+                 if False, any existing checkpoint is discarded
+
+        Returns
+        -------
+        list of Scenario, list of Policy
+        """
+        design_file = self._path(self.design_file)
+
+        if resume and os.path.exists(design_file):
+            design = load_pickle(design_file)
+            set_rng_state(design["rng_state"])
+            _logger.info(
+                f"resuming from {design_file}: {len(design['scenarios'])} scenarios, "
+                f"{len(design['policies'])} policies"
+            )
+            return design["scenarios"], design["policies"]
+
+        self.clear()
+        if isinstance(scenarios, int):
+            scenarios = sample_uncertainties(model, scenarios)
+        if isinstance(scenarios, Scenario):
+            scenarios = [scenarios]
+        if isinstance(policies, Policy):
+            policies = [policies]
+
+        design = {
+            "scenarios": list(scenarios),
+            "policies": list(policies),
+            "rng_state": get_rng_state(),
+        }
+        atomic_pickle(design, design_file)
+        return design["scenarios"], design["policies"]
+
+    def clear(self):
+        for entry in os.listdir(self.directory):
+            if entry.endswith((".pkl", ".json", ".tmp")):
+                os.remove(self._path(entry))
+
+    def batches(self, scenarios, policies):
+        """Split the factorial design over its longest axis
+
+        Returns
+        -------
+        list of (scenarios, policies) tuples
+        """
+        if len(scenarios) >= len(policies):
+            return [
+                (scenarios[i : i + self.batch_size], policies)
+                for i in range(0, len(scenarios), self.batch_size)
+            ]
+        return [
+            (scenarios, policies[i : i + self.batch_size])
+            for i in range(0, len(policies), self.batch_size)
+        ]
+
+    def completed_batches(self):
+        """Return the indices of the batches with a stored result
+
+        The batch size of a resumed campaign is taken from the checkpoint, so
+        that the batch indices keep pointing at the same experiments.
+        """
+        state_file = self._path(self.state_file)
+        if not os.path.exists(state_file):
+            return set()
+        with open(state_file) as fh:
+            state = json.load(fh)
+
+        if state["batch_size"] != self.batch_size:
+            _logger.info(f"using batch size {state['batch_size']} of the checkpoint")
+            self.batch_size = state["batch_size"]
+        return {i for i in state["completed"] if os.path.exists(self._batch_file(i))}
+
+    def _write_state(self, completed, n_batches):
+        state = {
+            "completed": sorted(completed),
+            "n_batches": n_batches,
+            "batch_size": self.batch_size,
+            "updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        tmp_filename = self._path(f"{self.state_file}.tmp")
+        with open(tmp_filename, "w") as fh:
+            json.dump(state, fh, indent=1)
+        os.replace(tmp_filename, self._path(self.state_file))
+
+    def perform_experiments(
+        self, model, scenarios, policies, evaluator=None, resume=True, **kwargs
+    ):
+        """Checkpointed equivalent of perform_experiments
+
+        Parameters
+        ----------
+        model : Model instance
+        scenarios : int or collection of Scenario instances
+        policies : Policy instance or collection of Policy instances
+        evaluator : Evaluator instance, optional
+        resume : bool, optional
+        kwargs : passed on to perform_experiments
+
+        Returns
+        -------
+        tuple
+            experiments DataFrame and outcomes dict, as perform_experiments
+
+        Raises
+        ------
+        CampaignInterrupted
+            if a preemption signal was received before all batches finished
+        """
+        scenarios, policies = self.setup_design(model, scenarios, policies, resume)
+        completed = self.completed_batches() if resume else set()
+        batches = self.batches(scenarios, policies)
+
+        _logger.info(f"{len(completed)} of {len(batches)} batches already completed")
+
+        for i, (batch_scenarios, batch_policies) in enumerate(batches):
+            if i in completed:
+                continue
+            if self.preemption is not None and self.preemption.stop_requested:
+                raise CampaignInterrupted(
+                    f"stopped after {len(completed)} of {len(batches)} batches"
+                )
+
+            results = perform_experiments(
+                model,
+                scenarios=batch_scenarios,
+                policies=batch_policies,
+                evaluator=evaluator,
+                **kwargs,
+            )
+            atomic_pickle(results, self._batch_file(i))
+            completed.add(i)
+            self._write_state(completed, len(batches))
+            _logger.info(f"batch {i + 1}/{len(batches)} stored")
+
+        return self.merge(len(batches))
+
+    def merge(self, n_batches):
+        """Concatenate the stored batches into a single results tuple
+
+        Outcomes that are missing from some batches, such as the telemetry
+        columns of batches run without telemetry, are NaN for those batches.
+        """
+        batches = [load_pickle(self._batch_file(i)) for i in range(n_batches)]
+        experiments = pd.concat([batch_experiments for batch_experiments, _ in batches], ignore_index=True)
+
+        outcomes = {}
+        for key in dict.fromkeys(key for _, batch_outcomes in batches for key in batch_outcomes):
+            values = []
+            for batch_experiments, batch_outcomes in batches:
+                if key in batch_outcomes:
+                    values.append(batch_outcomes[key])
+                else:
+                    values.append(np.full(len(batch_experiments), np.nan))
+            outcomes[key] = np.concatenate(values)
+        return experiments, outcomes
+
+
+class ResumableArchiveLogger(ArchiveLogger):
+    """ArchiveLogger that can be created again for a resumed run
+
+    The workbench ArchiveLogger refuses to start when its temporary directory
+    already exists. On a resumed run that directory holds the snapshots of
+    the previous job, which should be kept and completed.
+    """
+
+    def __init__(
+        self, directory, decision_varnames, outcome_varnames, base_filename="archives.tar.gz"
+    ):
+        AbstractConvergenceMetric.__init__(self, "archive_logger")
+
+        self.directory = os.path.abspath(directory)
+        self.temp = os.path.join(self.directory, "tmp")
+        os.makedirs(self.temp, exist_ok=True)
+
+        self.base = base_filename
+        self.decision_varnames = decision_varnames
+        self.outcome_varnames = outcome_varnames
+        self.tarfilename = os.path.join(self.directory, base_filename)
+
+
+class OptimizationCheckpoint:
+    """Periodically store the state of a platypus optimizer
+
+    Parameters
+    ----------
+    filename : str
+               pickle file holding the checkpoint of a single optimization run
+    every_nfe : int, optional
+                minimum number of function evaluations between checkpoints
+    every_seconds : float, optional
+                    minimum wall time between checkpoints; a checkpoint is
+                    written as soon as either condition is met
+    preemption : PreemptionHandler instance, optional
+
+    The state consists of the population, the contents of the epsilon archive
+    and its improvement counter, the number of function evaluations, the
+    results of the convergence metrics and the python and numpy RNG states.
+    Solutions are stored as plain lists of encoded variables and objectives,
+    because the problem instance carries the evaluation closure and cannot be
+    pickled.
+    """
+
+    def __init__(self, filename, every_nfe=1000, every_seconds=None, preemption=None):
+        self.filename = os.path.abspath(filename)
+        self.every_nfe = every_nfe
+        self.every_seconds = every_seconds
+        self.preemption = preemption
+        self.last_nfe = 0
+        self.last_time = time.time()
+
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+
+    @property
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    @staticmethod
+    def _dump_solutions(solutions):
+        return [
+            (
+                list(s.variables),
+                list(s.objectives),
+                list(s.constraints),
+                s.constraint_violation,
+                s.feasible,
+            )
+            for s in solutions
+        ]
+
+    @staticmethod
+    def _load_solutions(entries, problem):
+        from platypus import Solution
+
+        solutions = []
+        for variables, objectives, constraints, violation, feasible in entries:
+            solution = Solution(problem)
+            solution.variables[:] = variables
+            solution.objectives[:] = objectives
+            solution.constraints[:] = constraints
+            solution.constraint_violation = violation
+            solution.feasible = feasible
+            solution.evaluated = True
+            solutions.append(solution)
+        return solutions
+
+    def due(self, optimizer):
+        if optimizer.nfe - self.last_nfe >= self.every_nfe:
+            return True
+        if self.every_seconds and time.time() - self.last_time >= self.every_seconds:
+            return True
+        return self.preemption is not None and self.preemption.stop_requested
+
+    def save(self, optimizer, convergence, extra=None):
+        """Write the checkpoint
+
+        Parameters
+        ----------
+        optimizer : platypus Algorithm instance
+        convergence : Convergence instance
+        extra : dict, optional
+                additional picklable state, e.g. of a stopping rule
+        """
+        state = {
+            "nfe": optimizer.nfe,
+            "population": self._dump_solutions(optimizer.population),
+            "archive": self._dump_solutions(optimizer.archive),
+            "improvements": optimizer.archive.improvements,
+            "convergence": {
+                "index": convergence.index,
+                "generation": convergence.generation,
+                "last_check": convergence.last_check,
+                "i": convergence.i,
+                "metrics": [m.results for m in convergence.metrics],
+            },
+            "rng_state": get_rng_state(),
+            "extra": extra if extra is not None else {},
+        }
+        atomic_pickle(state, self.filename)
+        self.last_nfe = optimizer.nfe
+        self.last_time = time.time()
+        _logger.info(f"checkpoint written at nfe {optimizer.nfe}")
+
+    def restore(self, optimizer, convergence):
+        """Restore a stored checkpoint into a freshly created optimizer
+
+        Returns
+        -------
+        dict
+            the extra state that was stored with the checkpoint
+        """
+        from platypus import PlatypusConfig
+
+        state = load_pickle(self.filename)
+        problem = optimizer.problem
+
+        optimizer.population = self._load_solutions(state["population"], problem)
+        optimizer.archive += self._load_solutions(state["archive"], problem)
+        optimizer.archive.improvements = state["improvements"]
+        optimizer.result = optimizer.archive
+        optimizer.nfe = state["nfe"]
+        if optimizer.variator is None:
+            optimizer.variator = PlatypusConfig.default_variator(problem)
+
+        conv_state = state["convergence"]
+        convergence.index = conv_state["index"]
+        convergence.generation = conv_state["generation"]
+        convergence.last_check = conv_state["last_check"]
+        convergence.i = conv_state["i"]
+        for metric, results in zip(convergence.metrics, conv_state["metrics"]):
+            metric.results = results
+
+        set_rng_state(state["rng_state"])
+        self.last_nfe = optimizer.nfe
+        self.last_time = time.time()
+        _logger.info(f"resumed optimization from {self.filename} at nfe {optimizer.nfe}")
+        return state["extra"]
+
+    def mark_done(self):
+        """Remove the checkpoint once the run has completed"""
+        if self.exists:
+            os.remove(self.filename)
@@ -0,0 +1,411 @@
+"""
+Convergence tracking while the direct search is running.
+
+The hypervolume is computed exactly by slicing along the objectives, with a
+vectorized sweep for the last two objectives. For the three objectives of
+problem formulation 8 this is fast enough to evaluate the archive while the
+search is running.
+
+ConvergenceStop is a stopping rule for run_optimization. At a fixed interval it
+records the epsilon progress of the archive and its hypervolume with respect
+to a reference point fixed at the start of the run. Once both have improved
+less than a threshold over a window of function evaluations, the search is
+stopped and the reason is kept in stopping_rule.reason.
+
+ArchiveMetrics computes the convergence metrics of the directed search
+(hypervolume, generational distance, epsilon indicator, inverted generational
+distance and spacing) for an archive with NumPy, with the same definitions as
+the platypus indicators wrapped by the workbench. ArchiveMetricsLogger is a
+convergence metric that keeps the archive at every convergence check in
+memory instead of on disk. If the reference set is known when the search
+starts the metrics are computed as the snapshots are taken, otherwise
+compute_metrics scores the snapshots of many runs in parallel once the
+reference set is known. Snapshots that are identical to the previous snapshot
+of the same run, which is common once the search has converged, reuse the
+previous scores.
+"""
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import cdist
+
+from platypus import Direction
+
+from ema_workbench.em_framework.optimization import AbstractConvergenceMetric
+from ema_workbench.util import EMAError, ema_logging
+
+from funs_pareto import minimized
+
+_logger = ema_logging.get_module_logger(__name__)
+
+
+def _hypervolume_2d(points, reference):
+    points = points[np.lexsort((points[:, 1], points[:, 0]))]
+    best_so_far = np.minimum.accumulate(np.concatenate([[reference[1]], points[:, 1]]))[:-1]
+    heights = np.maximum(best_so_far - points[:, 1], 0)
+    return float(np.sum((reference[0] - points[:, 0]) * heights))
+
+
+def _hypervolume(points, reference):
+    n_objectives = points.shape[1]
+    if n_objectives == 1:
+        return float(reference[0] - points[:, 0].min())
+    if n_objectives == 2:
+        return _hypervolume_2d(points, reference)
+
+    # slice along the last objective, every slab is covered by the points below it
+    points = points[np.argsort(points[:, -1], kind="stable")]
+    upper = np.append(points[1:, -1], reference[-1])
+    volume = 0.0
+    for i in range(len(points)):
+        depth = upper[i] - points[i, -1]
+        if depth > 0:
+            volume += depth * _hypervolume(points[: i + 1, :-1], reference[:-1])
+    return volume
+
+
+def hypervolume(points, reference):
+    """Hypervolume dominated by points, for minimized objectives
+
+    Parameters
+    ----------
+    points : 2d array
+    reference : 1d array
+                points that do not dominate the reference point do not
+                contribute
+
+    Returns
+    -------
+    float
+    """
+    points = np.asarray(points, dtype=float)
+    reference = np.asarray(reference, dtype=float)
+    if points.size == 0:
+        return 0.0
+    points = points[np.all(points < reference, axis=1)]
+    if len(points) == 0:
+        return 0.0
+    return _hypervolume(points, reference)
+
+
+def minimized_objectives(solutions, problem):
+    """Objective values of solutions as an array, with maximized objectives
+    negated"""
+    if not solutions:
+        return np.empty((0, len(problem.directions)))
+    return minimized([s.objectives[:] for s in solutions], problem.directions)
+
+
+class ConvergenceStop:
+    """Stop the search once it no longer improves
+
+    Parameters
+    ----------
+    window : int, optional
+             number of function evaluations over which the improvement is
+             measured
+    min_epsilon_progress : int, optional
+                           stop if the epsilon archive improved fewer times
+                           than this over the window
+    min_hypervolume_gain : float, optional
+                           stop if the hypervolume grew by less than this
+                           fraction over the window
+    check_freq : int, optional
+                 number of function evaluations between checks
+    min_nfe : int, optional
+              never stop before this number of function evaluations
+    margin : float, optional
+             the reference point of the hypervolume is the worst value of
+             every objective at the first check, plus this fraction of the
+             range of the objective
+
+    Both criteria have to be met before the search is stopped.
+    """
+
+    def __init__(
+        self,
+        window=2000,
+        min_epsilon_progress=5,
+        min_hypervolume_gain=1e-3,
+        check_freq=500,
+        min_nfe=0,
+        margin=0.1,
+    ):
+        self.window = window
+        self.min_epsilon_progress = min_epsilon_progress
+        self.min_hypervolume_gain = min_hypervolume_gain
+        self.check_freq = check_freq
+        self.min_nfe = min_nfe
+        self.margin = margin
+
+        self.reference = None
+        self.scale = None
+        self.history = []
+        self.reason = None
+        self._cache = (None, 0.0)
+
+    def _hypervolume(self, optimizer):
+        """Normalized hypervolume of the archive, only recomputed when the
+        archive changed since the last check"""
+        objectives = minimized_objectives(list(optimizer.archive), optimizer.problem)
+        key = objectives.tobytes()
+        if key == self._cache[0]:
+            return self._cache[1]
+
+        if self.reference is None:
+            everything = np.vstack(
+                [objectives, minimized_objectives(list(optimizer.population), optimizer.problem)]
+            )
+            ideal = everything.min(axis=0)
+            nadir = everything.max(axis=0)
+            span = np.where(nadir > ideal, nadir - ideal, 1.0)
+            self.reference = nadir + self.margin * span
+            self.scale = self.reference - ideal
+
+        value = hypervolume(objectives / self.scale, self.reference / self.scale)
+        self._cache = (key, value)
+        return value
+
+    def __call__(self, optimizer):
+        """Record the state of the search and return True if it should stop"""
+        nfe = optimizer.nfe
+        if self.history and nfe - self.history[-1]["nfe"] < self.check_freq:
+            return False
+
+        entry = {
+            "nfe": nfe,
+            "epsilon_progress": optimizer.archive.improvements,
+            "hypervolume": self._hypervolume(optimizer),
+        }
+        self.history.append(entry)
+
+        if nfe < self.min_nfe:
+            return False
+        earlier = [h for h in self.history if h["nfe"] <= nfe - self.window]
+        if not earlier:
+            return False
+        start = earlier[-1]
+
+        progress = entry["epsilon_progress"] - start["epsilon_progress"]
+        gain = (entry["hypervolume"] - start["hypervolume"]) / max(start["hypervolume"], 1e-12)
+        if progress < self.min_epsilon_progress and gain < self.min_hypervolume_gain:
+            self.reason = (
+                f"converged: {progress} epsilon progress and {gain:.2%} hypervolume gain "
+                f"between nfe {start['nfe']} and {nfe}"
+            )
+            return True
+        return False
+
+    def summary(self, nfe):
+        """Why and when the search stopped"""
+        last = self.history[-1] if self.history else {}
+        return {
+            "nfe": nfe,
+            "stopped_early": self.reason is not None,
+            "reason": self.reason if self.reason is not None else "nfe budget reached",
+            "epsilon_progress": last.get("epsilon_progress"),
+            "hypervolume": last.get("hypervolume"),
+        }
+
+    def get_state(self):
+        return {
+            "reference": self.reference,
+            "scale": self.scale,
+            "history": self.history,
+            "reason": self.reason,
+        }
+
+    def set_state(self, state):
+        self.reference = state["reference"]
+        self.scale = state["scale"]
+        self.history = state["history"]
+        self.reason = state["reason"]
+
+
+class ArchiveMetrics:
+    """Convergence metrics of an archive with respect to a reference set
+
+    Parameters
+    ----------
+    reference_set : 2d array
+                    objective values of the reference set
+    directions : list, optional
+                 platypus directions of the objectives, all minimized by
+                 default
+    d : float, optional
+        power used in the generational distances
+
+    Objectives are normalized on the range of the reference set. The
+    metrics are those of the platypus indicators, for the same definitions
+    and the same values as HypervolumeMetric, GenerationalDistanceMetric,
+    EpsilonIndicatorMetric, InvertedGenerationalDistanceMetric and
+    SpacingMetric.
+
+    Raises
+    ------
+    EMAError if an objective has the same value everywhere in the reference
+    set
+    """
+
+    names = ["generational_distance", "hypervolume", "epsilon_indicator", "inverted_gd", "spacing"]
+
+    def __init__(self, reference_set, directions=None, d=1):
+        reference_set = np.asarray(reference_set, dtype=float)
+        self.minimum = reference_set.min(axis=0)
+        self.maximum = reference_set.max(axis=0)
+        if np.any(self.maximum - self.minimum < 1e-10):
+            raise EMAError("objective with empty range in the reference set")
+
+        if directions is None:
+            directions = [Direction.MINIMIZE] * reference_set.shape[1]
+        self.minimized = np.array([Direction(d) == Direction.MINIMIZE for d in directions])
+        self.d = d
+        self.reference_set = self._normalize(reference_set)
+
+    @classmethod
+    def from_dataframe(cls, reference_set, problem, **kwargs):
+        """ArchiveMetrics for the outcomes of problem"""
+        return cls(reference_set[problem.outcome_names].to_numpy(), problem.directions, **kwargs)
+
+    def _normalize(self, objectives):
+        return (objectives - self.minimum) / (self.maximum - self.minimum)
+
+    def hypervolume(self, normalized):
+        inside = np.clip(normalized[np.all(normalized <= 1.0, axis=1)], 0.0, 1.0)
+        inside = np.where(self.minimized, inside, 1.0 - inside)
+        return hypervolume(inside, np.ones(inside.shape[1]))
+
+    def score(self, objectives):
+        """All metrics for the objective values of an archive, as a dict"""
+        objectives = np.asarray(objectives, dtype=float).reshape(-1, len(self.minimum))
+        n = len(objectives)
+        if n == 0:
+            return dict(zip(self.names, [np.inf, 0.0, np.inf, np.inf, 0.0]))
+
+        normalized = self._normalize(objectives)
+        distances = cdist(normalized, self.reference_set)
+        gd = np.sum(distances.min(axis=1) ** self.d) ** (1 / self.d) / n
+        igd = np.sum(distances.min(axis=0) ** self.d) ** (1 / self.d) / len(self.reference_set)
+
+        # largest shift needed to cover every reference point by the archive
+        shifts = (normalized[:, np.newaxis, :] - self.reference_set[np.newaxis, :, :]).max(axis=2)
+        epsilon_indicator = shifts.min(axis=0).max()
+
+        spacing = 0.0
+        if n > 1:
+            nearest = cdist(objectives, objectives, "cityblock")
+            np.fill_diagonal(nearest, np.inf)
+            spacing = np.std(nearest.min(axis=1), ddof=1)
+
+        return {
+            "generational_distance": gd,
+            "hypervolume": self.hypervolume(normalized),
+            "epsilon_indicator": epsilon_indicator,
+            "inverted_gd": igd,
+            "spacing": spacing,
+        }
+
+
+def score_snapshots(metrics, snapshots, known=None):
+    """Score a sequence of archive snapshots of a single run
+
+    Parameters
+    ----------
+    metrics : ArchiveMetrics instance
+    snapshots : list of tuples
+                nfe and objective values of the archive
+    known : dict, optional
+            scores that were already computed, by nfe
+
+    Returns
+    -------
+    DataFrame
+        one row per snapshot, sorted on nfe
+    """
+    known = known if known is not None else {}
+    rows = []
+    previous, scores = None, None
+    for nfe, objectives in sorted(snapshots, key=lambda snapshot: snapshot[0]):
+        if nfe in known:
+            scores = known[nfe]
+        elif previous is None or not np.array_equal(objectives, previous):
+            scores = metrics.score(objectives)
+        previous = objectives
+        rows.append(dict(scores, nfe=int(nfe)))
+    return pd.DataFrame(rows, columns=ArchiveMetrics.names + ["nfe"])
+
+
+def compute_metrics(runs, metrics, n_processes=None):
+    """Score the snapshots of several runs in parallel
+
+    Parameters
+    ----------
+    runs : dict
+           snapshots of every run, as stored by ArchiveMetricsLogger
+    metrics : ArchiveMetrics instance
+    n_processes : int, optional
+                  defaults to the number of cores
+
+    Returns
+    -------
+    dict
+        with the same keys as runs and a DataFrame as returned by
+        score_snapshots
+    """
+    if len(runs) < 2 or n_processes == 1:
+        return {key: score_snapshots(metrics, snapshots) for key, snapshots in runs.items()}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes) as pool:
+        futures = {key: pool.submit(score_snapshots, metrics, snapshots) for key, snapshots in runs.items()}
+        return {key: future.result() for key, future in futures.items()}
+
+
+class ArchiveMetricsLogger(AbstractConvergenceMetric):
+    """Convergence metric that keeps the objective values of the archive at
+    every convergence check
+
+    Parameters
+    ----------
+    metrics : ArchiveMetrics instance, optional
+              if given, every new snapshot is scored when it is taken
+
+    The snapshots are kept in results, so they are stored with the
+    checkpoints of funs_checkpoint. An unchanged archive shares the array of
+    the previous snapshot. The logger does not add a column to the
+    convergence DataFrame, the scores are returned by to_dataframe.
+    """
+
+    def __init__(self, metrics=None):
+        super().__init__("archive_metrics")
+        self.metrics = metrics
+        self.scores = {}
+
+    def __call__(self, optimizer):
+        objectives = np.array([s.objectives[:] for s in optimizer.archive], dtype=float)
+        unchanged = bool(self.results) and np.array_equal(objectives, self.results[-1][1])
+        if unchanged:
+            objectives = self.results[-1][1]
+
+        if self.metrics is not None:
+            if unchanged and self.results[-1][0] in self.scores:
+                scores = self.scores[self.results[-1][0]]
+            else:
+                scores = self.metrics.score(objectives)
+            self.scores[optimizer.nfe] = scores
+            _logger.debug(f"archive metrics at nfe {optimizer.nfe}: {scores}")
+        self.results.append((optimizer.nfe, objectives))
+
+    def reset(self):
+        super().reset()
+        self.scores = {}
+
+    def get_results(self):
+        return None
+
+    def to_dataframe(self, metrics=None):
+        """Scores of all snapshots, snapshots that were scored while the
+        search was running are not scored again"""
+        if metrics is None or metrics is self.metrics:
+            return score_snapshots(self.metrics, self.results, known=self.scores)
+        return score_snapshots(metrics, self.results)
@@ -0,0 +1,313 @@
+"""
+Pre-screening of candidate policies on the objectives that need no simulation.
+
+The dike investment costs and the room for the river costs of a policy only
+depend on its levers (see DikeNetwork.lever_costs), only the expected annual
+damage needs the flood simulation. Much of the direct search used to be
+spent on lever combinations that were obviously too expensive.
+
+CostScreen computes these cheap objectives of a candidate and checks them
+against budgets, e.g. a maximum of the dike investment costs, or of the
+total of all cheap objectives. The budgets are also added to the problem as
+constraints, so solutions over budget that do get evaluated (the initial
+population) are infeasible.
+
+CostScreening wraps the variator of the optimizer, in the same way as
+SurrogateScreening. Every offspring is screened before it is evaluated, and
+offspring are bred from the same parents until enough of them pass. An
+offspring is rejected
+
+* when its cheap objectives break a budget,
+* when it could not enter the epsilon archive even if the expensive
+  objectives took their best possible value (zero for the minimized
+  damages): its cheap objectives combined with these lower bounds are
+  epsilon-dominated by the current archive. Such an offspring would be
+  dominated whatever its simulation returns, so the rejection never loses
+  a solution the archive would have kept.
+
+If no offspring passes after a number of attempts, offspring are bred from
+other parents drawn from the population. If that does not help either, the
+rejected offspring closest to the budget are repaired: their levers are moved
+toward the lower bounds until the costs are within budget. Only when the
+repaired offspring are still rejected, the offspring with the smallest budget
+violation are evaluated anyway, so the search keeps moving. These forced
+offspring are counted apart from the offspring that passed the screen.
+"""
+import collections
+import copy
+
+import numpy as np
+from platypus import EpsilonDominance, Integer, Real, Solution, Variator
+
+from ema_workbench import Constraint, ScalarOutcome
+from ema_workbench.em_framework.optimization import transform_variables
+from ema_workbench.em_framework.parameters import CategoricalParameter
+from ema_workbench.util import EMAError, ema_logging
+
+_logger = ema_logging.get_module_logger(__name__)
+
+TOTAL = "total"
+
+
+class _Budget:
+    """Constraint function, the amount by which the cheap objectives exceed
+    the budget"""
+
+    def __init__(self, limit):
+        self.limit = limit
+
+    def __call__(self, *values):
+        return max(0.0, sum(values) - self.limit)
+
+
+def lever_only_outcomes(model):
+    """The outcomes of a model whose function is a DikeNetwork that can be
+    computed from the levers alone, see DikeNetwork.lever_costs"""
+    lowest = {
+        lever.name: lever.categories[0].value
+        if isinstance(lever, CategoricalParameter)
+        else lever.lower_bound
+        for lever in model.levers
+    }
+    keys = set(model.function.lever_costs(**lowest))
+    return [
+        o for o in model.outcomes
+        if o.kind != ScalarOutcome.INFO and all(name in keys for name in o.variable_name)
+    ]
+
+
+class CostScreen:
+    """The objectives of a model that only depend on the levers, and their
+    budgets
+
+    Parameters
+    ----------
+    model : Model instance
+            a problem formulation whose function is a DikeNetwork
+    budgets : dict, optional
+              maximum per outcome name, the key 'total' limits the sum of
+              all cheap objectives
+    lower_bounds : dict, optional
+                   best possible value of the objectives that need the
+                   simulation, by default zero for minimized objectives
+
+    Raises
+    ------
+    EMAError if the model has no cheap objectives or a budget is set on an
+             objective that needs the simulation
+    """
+
+    def __init__(self, model, budgets=None, lower_bounds=None):
+        self.network = model.function
+        self.outcomes = [o for o in model.outcomes if o.kind != ScalarOutcome.INFO]
+        self.budgets = dict(budgets or {})
+
+        self.cheap = lever_only_outcomes(model)
+        if not self.cheap:
+            raise EMAError(f"none of the outcomes of {model.name} can be computed from the levers alone")
+        cheap_names = {o.name for o in self.cheap}
+        for name in self.budgets:
+            if name != TOTAL and name not in cheap_names:
+                raise EMAError(f"no budget can be set on {name}, it needs the simulation")
+
+        lower_bounds = dict(lower_bounds or {})
+        self.lower_bounds = {
+            o.name: lower_bounds.get(o.name, 0.0 if o.kind == ScalarOutcome.MINIMIZE else np.inf)
+            for o in self.outcomes
+            if o.name not in cheap_names
+        }
+
+    def costs(self, levers):
+        """The cheap objectives of a candidate, by outcome name"""
+        data = self.network.lever_costs(**levers)
+        return {o.name: o.process([data[name] for name in o.variable_name]) for o in self.cheap}
+
+    def violation(self, costs):
+        """Amount by which the costs exceed the budgets, zero if within"""
+        violation = 0.0
+        for name, limit in self.budgets.items():
+            value = sum(costs.values()) if name == TOTAL else costs[name]
+            violation += max(0.0, value - limit)
+        return violation
+
+    def optimistic(self, costs, outcome_names):
+        """The best objectives a candidate with these costs can have, in the
+        order of outcome_names"""
+        return [costs[name] if name in costs else self.lower_bounds[name] for name in outcome_names]
+
+    def constraints(self):
+        """The budgets as constraints of the optimization problem"""
+        return [
+            Constraint(
+                f"{name} budget",
+                outcome_names=[o.name for o in self.cheap] if name == TOTAL else name,
+                function=_Budget(limit),
+            )
+            for name, limit in self.budgets.items()
+        ]
+
+
+class CostScreening(Variator):
+    """Variator that rejects offspring on their cheap objectives
+
+    Parameters
+    ----------
+    variator : platypus Variator instance
+               the variator that generates the candidates
+    screen : CostScreen instance
+    problem : platypus Problem instance
+    epsilons : list of float, optional
+               the epsilons of the archive, without them offspring are only
+               checked against the budgets
+    max_attempts : int, optional
+                   number of times the variator is applied to a set of
+                   parents
+    max_redraws : int, optional
+                  number of times other parents are drawn from the
+                  population before rejected offspring are repaired
+
+    The optimizer is attached with attach. The number of accepted, rejected,
+    repaired and forced offspring is kept in counts.
+    """
+
+    def __init__(self, variator, screen, problem, epsilons=None, max_attempts=10, max_redraws=5):
+        super().__init__(variator.arity)
+        self.variator = variator
+        self.screen = screen
+        self.problem = problem
+        self.dominance = EpsilonDominance(epsilons) if epsilons is not None else None
+        self.max_attempts = max_attempts
+        self.max_redraws = max_redraws
+
+        self.optimizer = None
+        self.counts = collections.Counter()
+
+    def attach(self, optimizer):
+        self.optimizer = optimizer
+
+    def _levers(self, solution):
+        values = transform_variables(self.problem, solution.variables)
+        return dict(zip(self.problem.parameter_names, values))
+
+    def _dominated(self, costs):
+        """Whether the best case of a candidate is epsilon-dominated by the
+        archive"""
+        archive = getattr(self.optimizer, "archive", None)
+        if self.dominance is None or not archive:
+            return False
+        best_case = Solution(self.problem)
+        best_case.objectives[:] = self.screen.optimistic(costs, self.problem.outcome_names)
+        return any(self.dominance.compare(best_case, member) > 0 for member in archive)
+
+    def _screen(self, solution):
+        """The budget violation of a candidate and whether it passes"""
+        costs = self.screen.costs(self._levers(solution))
+        violation = self.screen.violation(costs)
+        if violation > 0:
+            self.counts["over budget"] += 1
+            return violation, False
+        if self._dominated(costs):
+            self.counts["dominated"] += 1
+            return violation, False
+        return violation, True
+
+    def _other_parents(self):
+        """Parents drawn from the population by the selector of the
+        optimizer, None if the optimizer has none"""
+        selector = getattr(self.optimizer, "selector", None)
+        population = getattr(self.optimizer, "population", None)
+        if selector is None or not population:
+            return None
+        return selector.select(self.arity, population)
+
+    def _scaled(self, solution, fraction):
+        """Copy of solution with every integer and real variable moved to
+        fraction of the way from its lower bound"""
+        scaled = copy.deepcopy(solution)
+        for i, variable_type in enumerate(self.problem.types):
+            if isinstance(variable_type, Integer):
+                value = variable_type.decode(solution.variables[i])
+                lowest = variable_type.min_value
+                scaled.variables[i] = variable_type.encode(lowest + int((value - lowest) * fraction))
+            elif isinstance(variable_type, Real):
+                lowest = variable_type.min_value
+                scaled.variables[i] = lowest + (solution.variables[i] - lowest) * fraction
+        scaled.evaluated = False
+        return scaled
+
+    def _repair(self, solution, steps=8):
+        """Copy of an offspring over budget that is moved toward the lower
+        bounds of the levers just far enough to be within budget
+
+        The fraction of the way is found by bisection, on the assumption that
+        the costs grow with the levers (see lever_only_outcomes).
+        """
+        within, over = 0.0, 1.0
+        for _ in range(steps):
+            fraction = (within + over) / 2
+            costs = self.screen.costs(self._levers(self._scaled(solution, fraction)))
+            if self.screen.violation(costs) > 0:
+                over = fraction
+            else:
+                within = fraction
+        return self._scaled(solution, within)
+
+    def _breed(self, parents, n_out, accepted, rejected):
+        """Apply the variator to parents until n_out offspring pass"""
+        for _ in range(self.max_attempts):
+            offspring = self.variator.evolve(parents)
+            n_out = n_out or len(offspring)
+            for solution in offspring:
+                violation, passed = self._screen(solution)
+                if passed:
+                    accepted.append(solution)
+                else:
+                    rejected.append((violation, solution))
+            if len(accepted) >= n_out:
+                break
+        return n_out
+
+    def evolve(self, parents):
+        accepted = []
+        rejected = []
+        n_out = self._breed(parents, None, accepted, rejected)
+        for _ in range(self.max_redraws):
+            if accepted:
+                break
+            parents = self._other_parents()
+            if parents is None:
+                break
+            self.counts["redrawn"] += 1
+            n_out = self._breed(parents, n_out, accepted, rejected)
+
+        rejected.sort(key=lambda item: item[0])
+        if not accepted:
+            for violation, solution in rejected[:n_out]:
+                if violation > 0:
+                    repaired = self._repair(solution)
+                    if self._screen(repaired)[1]:
+                        accepted.append(repaired)
+            self.counts["repaired"] += len(accepted)
+
+        if accepted:
+            accepted = accepted[:n_out]
+            self.counts["accepted"] += len(accepted)
+        else:
+            # keep the search moving with the offspring closest to the budget
+            accepted = [solution for _, solution in rejected[:n_out]]
+            self.counts["forced"] += len(accepted)
+            _logger.debug(f"no offspring passed the cost screen, forcing {len(accepted)}")
+        return accepted
+
+    def summary(self):
+        """Number of offspring accepted, rejected, repaired and forced, the
+        share of the screened offspring that was rejected and the share of
+        the evaluated offspring that was forced"""
+        summary = {key: self.counts[key] for key in ("accepted", "repaired", "forced", "over budget", "dominated")}
+        summary["redrawn"] = self.counts["redrawn"]
+        rejected = self.counts["over budget"] + self.counts["dominated"]
+        screened = rejected + self.counts["accepted"]
+        summary["rejected share"] = rejected / screened if screened else 0.0
+        evaluated = self.counts["accepted"] + self.counts["forced"]
+        summary["forced share"] = self.counts["forced"] / evaluated if evaluated else 0.0
+        return summary
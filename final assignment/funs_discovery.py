@@ -0,0 +1,234 @@
+"""
+Parallel scenario discovery over memory-mapped results.
+
+The notebooks run PRIM one policy and one condition at a time, and rerun
+every box when the notebook is restarted. run_discovery takes a list of
+DiscoveryJob instances instead, each with a results file, an optional
+policy, a condition on the outcomes and the PRIM threshold, and runs the
+jobs in a process pool. The workers read the experiments from the
+ResultsCache of funs_results, so the columns are memory-mapped and shared
+through the page cache instead of being pickled to every worker.
+
+Every fitted PrimBox or CART object is pickled in the ResultsCache
+directory under a hash of the job and of the source file, so rerunning a
+notebook loads the boxes instead of peeling again. A changed results file
+rebuilds the ResultsCache, which drops its stored boxes as well.
+"""
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+import ema_workbench.analysis.cart as cart
+import ema_workbench.analysis.prim as prim
+from ema_workbench.util import EMAError, ema_logging
+
+from funs_checkpoint import atomic_pickle, load_pickle
+from funs_results import ResultsCache, _operators
+
+_logger = ema_logging.get_module_logger(__name__)
+
+# experiment columns that identify a run rather than describe a scenario
+_bookkeeping = ["scenario", "policy", "model"]
+
+
+class DiscoveryJob:
+    """A single PRIM or CART run
+
+    Parameters
+    ----------
+    file_name : str
+                results archive or CSV file
+    conditions : list of (outcome, operator, percentile) tuples
+                 the cases of interest are the experiments in which every
+                 outcome compares to its percentile over the selected rows
+                 with operator, e.g. [('Expected Annual Damage', '>', 75)]
+    threshold : float, optional
+                density threshold of PRIM
+    method : {'prim', 'cart'}, optional
+    policy : str, optional
+             only use the experiments of this policy
+    columns : list of str, optional
+              the uncertainties to search over, by default all experiment
+              columns that vary over the selected rows
+    name : str, optional
+           key of the result returned by run_discovery
+    peel_alpha, paste_alpha, mass_min : float, optional
+                                        passed on to PRIM, mass_min to CART
+                                        as well
+    """
+
+    def __init__(
+        self,
+        file_name,
+        conditions,
+        threshold=0.8,
+        method="prim",
+        policy=None,
+        columns=None,
+        name=None,
+        peel_alpha=0.05,
+        paste_alpha=0.05,
+        mass_min=0.05,
+    ):
+        if method not in ("prim", "cart"):
+            raise EMAError(f"unknown scenario discovery method {method}")
+        for _, op, _ in conditions:
+            if op not in _operators:
+                raise EMAError(f"unknown operator {op}")
+
+        self.file_name = file_name
+        self.conditions = [tuple(condition) for condition in conditions]
+        self.threshold = threshold
+        self.method = method
+        self.policy = policy
+        self.columns = columns
+        self.peel_alpha = peel_alpha
+        self.paste_alpha = paste_alpha
+        self.mass_min = mass_min
+
+        if name is None:
+            label = policy if policy is not None else os.path.basename(file_name)
+            name = f"{label} {method} {threshold}"
+        self.name = name
+
+    def parameters(self):
+        """Everything that determines the result, the name excluded"""
+        return {
+            "file_name": os.path.abspath(self.file_name),
+            "conditions": self.conditions,
+            "threshold": self.threshold,
+            "method": self.method,
+            "policy": self.policy,
+            "columns": self.columns,
+            "peel_alpha": self.peel_alpha,
+            "paste_alpha": self.paste_alpha,
+            "mass_min": self.mass_min,
+        }
+
+    def key(self, cache):
+        """Hash of the job and of the source file of cache"""
+        content = json.dumps([self.parameters(), cache.index["source"]], sort_keys=True, default=str)
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def __repr__(self):
+        return f"DiscoveryJob({self.name!r})"
+
+
+def _result_file(job, cache):
+    return os.path.join(cache.cache_dir, "discovery", f"{job.key(cache)}.pkl")
+
+
+def cases_of_interest(outcomes, conditions):
+    """Boolean array of the experiments that meet all conditions"""
+    y = None
+    for outcome, op, percentile in conditions:
+        values = np.asarray(outcomes[outcome])
+        met = _operators[op](values, np.percentile(values, percentile))
+        y = met if y is None else y & met
+    return y
+
+
+def run_job(job):
+    """Load the data of a job and fit PRIM or CART
+
+    Returns
+    -------
+    PrimBox or CART instance
+
+    The ResultsCache of the job has to exist, run_discovery builds it before
+    the jobs are submitted so workers never build the same cache at once.
+    """
+    cache = ResultsCache(job.file_name)
+    columns = job.columns
+    if columns is None:
+        columns = [c for c in cache.uncertainties_and_levers if c not in _bookkeeping]
+    outcomes = list(dict.fromkeys(outcome for outcome, _, _ in job.conditions))
+    experiments, results = cache.load(columns=columns + outcomes, policy=job.policy)
+
+    x = experiments[columns]
+    if job.columns is None:
+        # the levers of a single policy are constant and cannot bound a box
+        x = x.loc[:, x.nunique() > 1]
+    y = cases_of_interest(results, job.conditions)
+
+    if job.method == "prim":
+        algorithm = prim.Prim(
+            x,
+            y,
+            threshold=job.threshold,
+            peel_alpha=job.peel_alpha,
+            paste_alpha=job.paste_alpha,
+            mass_min=job.mass_min,
+        )
+        return algorithm.find_box()
+
+    algorithm = cart.CART(x, y, mass_min=job.mass_min)
+    algorithm.build_tree()
+    return algorithm
+
+
+def _run_and_store(job, filename):
+    start = time.perf_counter()
+    result = run_job(job)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    atomic_pickle(result, filename)
+    return result, time.perf_counter() - start
+
+
+def run_discovery(jobs, n_processes=None, use_cache=True):
+    """Run scenario discovery jobs in parallel
+
+    Parameters
+    ----------
+    jobs : list of DiscoveryJob instances
+    n_processes : int, optional
+                  defaults to the number of cores
+    use_cache : bool, optional
+                if False, every job is run again and its stored result
+                replaced
+
+    Returns
+    -------
+    dict
+        with the name of every job as key and the PrimBox or CART instance
+        as value, in the order of the jobs
+
+    Raises
+    ------
+    EMAError if two jobs have the same name
+    """
+    names = [job.name for job in jobs]
+    if len(set(names)) != len(names):
+        raise EMAError("the names of the scenario discovery jobs are not unique")
+
+    caches = {}
+    for job in jobs:
+        if job.file_name not in caches:
+            caches[job.file_name] = ResultsCache(job.file_name)
+
+    results = {}
+    pending = {}
+    for job in jobs:
+        filename = _result_file(job, caches[job.file_name])
+        if use_cache and os.path.exists(filename):
+            results[job.name] = load_pickle(filename)
+            _logger.info(f"{job.name} loaded from {filename}")
+        else:
+            pending[job.name] = (job, filename)
+
+    if len(pending) < 2 or n_processes == 1:
+        done = {name: _run_and_store(*args) for name, args in pending.items()}
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes) as pool:
+            futures = {name: pool.submit(_run_and_store, *args) for name, args in pending.items()}
+            done = {name: future.result() for name, future in futures.items()}
+
+    for name, (result, duration) in done.items():
+        results[name] = result
+        _logger.info(f"{name} completed in {duration:.1f} s")
+
+    return {name: results[name] for name in names}
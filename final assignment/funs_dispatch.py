@@ -0,0 +1,296 @@
+"""
+Cost-aware chunked dispatch of experiments.
+
+The MultiprocessingEvaluator sends every experiment to a worker as a separate
+task, and every result comes back as its own pickled dict. For the large
+simulation campaigns a noticeable share of the time goes to this traffic
+instead of the DikeNetwork itself.
+
+ChunkedEvaluator groups the experiments into chunks of about equal predicted
+run time. A worker runs a chunk back to back and returns one NumPy block per
+outcome plus the measured run time of every experiment. The run times feed a
+CostModel, so the chunks of later calls (later batches of a checkpointed
+campaign, later generations of an optimization) are sized on observed costs.
+The most expensive chunks are dispatched first, so the tail of a call is
+filled with cheap work.
+
+With a MemoryBudget the evaluator probes the memory of a worker before the
+pool is started and picks the number of processes and the chunk size to fit
+the budget, see funs_memory. Every chunk also reports the memory of its
+worker, so growth beyond the budget during a run is logged.
+
+With a Telemetry instance the workers also report the wall time and model
+run stats of every experiment, see funs_telemetry.
+"""
+import collections
+import queue
+import time
+
+import numpy as np
+
+from ema_workbench import MultiprocessingEvaluator
+from ema_workbench.em_framework import futures_multiprocessing
+from ema_workbench.em_framework.points import experiment_generator
+from ema_workbench.util import EMAError, ema_logging
+
+from funs_memory import MemoryMonitor, private_memory, probe_worker, worker_memory
+from funs_telemetry import Telemetry, model_run_stats
+
+_logger = ema_logging.get_module_logger(__name__)
+
+
+def dike_cost_key(experiment):
+    """Group experiments that are expected to take about equally long
+
+    Experiments are grouped by model (the fidelity copies of the dike model
+    differ a lot in run time), flood wave shape, and total dike heightening,
+    which controls how many breaches, and so how many steps on the dike
+    failure branch, are simulated.
+    """
+    wave_shape = experiment.scenario.get("A.0_ID flood wave shape")
+    heightening = sum(v for k, v in experiment.policy.items() if "DikeIncrease" in k)
+    return experiment.model_name, wave_shape, int(heightening // 5)
+
+
+class CostModel:
+    """Predicted run time of an experiment, learned from measured run times
+
+    Parameters
+    ----------
+    key : callable, optional
+          maps an experiment on the group whose mean run time is used as
+          prediction
+
+    Experiments of an unseen group get the mean run time over all groups, and
+    without any measurements all experiments cost the same.
+    """
+
+    def __init__(self, key=dike_cost_key):
+        self.key = key
+        self.totals = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+
+    def predict(self, experiments):
+        n_measured = sum(self.counts.values())
+        default = sum(self.totals.values()) / n_measured if n_measured else 1.0
+
+        costs = np.empty(len(experiments))
+        for i, experiment in enumerate(experiments):
+            key = self.key(experiment)
+            count = self.counts.get(key, 0)
+            costs[i] = self.totals[key] / count if count else default
+        return costs
+
+    def update(self, experiments, times):
+        for experiment, duration in zip(experiments, times):
+            key = self.key(experiment)
+            self.totals[key] += duration
+            self.counts[key] += 1
+
+
+def plan_chunks(costs, n_workers, chunks_per_worker=4, max_chunksize=None):
+    """Split experiments into chunks of about equal predicted cost
+
+    Parameters
+    ----------
+    costs : 1d numpy array
+            predicted cost of every experiment
+    n_workers : int
+    chunks_per_worker : int, optional
+                        more chunks per worker give a better load balance,
+                        fewer chunks less communication
+    max_chunksize : int, optional
+
+    Returns
+    -------
+    list of numpy arrays
+        indices of the experiments in every chunk, the most expensive chunk
+        first
+    """
+    n = len(costs)
+    if n == 0:
+        return []
+
+    # experiments of similar cost are grouped, so the chunks stay homogeneous
+    order = np.argsort(-costs, kind="stable")
+    n_chunks = min(n, max(1, n_workers * chunks_per_worker))
+    if max_chunksize is not None:
+        n_chunks = max(n_chunks, int(np.ceil(n / max_chunksize)))
+
+    cumulative = np.cumsum(costs[order])
+    targets = cumulative[-1] * np.arange(1, n_chunks) / n_chunks
+    boundaries = np.searchsorted(cumulative, targets, side="right")
+    chunks = [c for c in np.split(order, boundaries) if len(c)]
+
+    if max_chunksize is not None:
+        chunks = [
+            piece
+            for c in chunks
+            for piece in np.array_split(c, int(np.ceil(len(c) / max_chunksize)))
+        ]
+
+    chunk_costs = [costs[c].sum() for c in chunks]
+    return [chunks[i] for i in np.argsort(chunk_costs, kind="stable")[::-1]]
+
+
+def run_chunk(runner, experiments, stats=None):
+    """Run experiments back to back and stack their outcomes
+
+    Parameters
+    ----------
+    runner : ExperimentRunner instance
+    experiments : list of Experiment instances
+    stats : list, optional
+            if given, the start and end time and the model run stats of
+            every experiment are appended to it
+
+    Returns
+    -------
+    tuple
+        dict with one array per outcome (first axis is the experiment) and
+        the run time of every experiment in seconds
+    """
+    times = np.empty(len(experiments))
+    blocks = {}
+    for i, experiment in enumerate(experiments):
+        wall_start = time.time()
+        start = time.perf_counter()
+        outcomes = runner.run_experiment(experiment)
+        times[i] = time.perf_counter() - start
+        if stats is not None:
+            stats.append(
+                {
+                    "start": wall_start,
+                    "end": wall_start + times[i],
+                    "run_stats": model_run_stats(runner, experiment),
+                }
+            )
+
+        for name, value in outcomes.items():
+            blocks.setdefault(name, []).append(np.asarray(value))
+    # stacking promotes over the whole chunk, a policy without dike heightening
+    # returns its investment costs as int 0 while other policies return floats
+    return {name: np.stack(values) for name, values in blocks.items()}, times
+
+
+def unpack_chunk(experiments, blocks, callback):
+    """Hand the rows of the outcome blocks to the callback"""
+    for i, experiment in enumerate(experiments):
+        callback(experiment, {name: block[i] for name, block in blocks.items()})
+
+
+def run_chunk_with_telemetry(runner, experiments, telemetry):
+    """run_chunk, plus the memory of the worker and, if telemetry is True,
+    the records for Telemetry.record_chunk"""
+    received = time.time()
+    stats = [] if telemetry else None
+    blocks, times = run_chunk(runner, experiments, stats)
+    if telemetry:
+        stats = {"received": received, "finished": time.time(), "experiments": stats}
+    return blocks, times, worker_memory(), stats
+
+
+def _pool_worker(experiments, telemetry=False):
+    return run_chunk_with_telemetry(futures_multiprocessing.experiment_runner, experiments, telemetry)
+
+
+class ChunkedEvaluator(MultiprocessingEvaluator):
+    """MultiprocessingEvaluator that dispatches cost-balanced chunks
+
+    Parameters
+    ----------
+    msis : collection of models
+    n_processes : int, optional
+    chunks_per_worker : int, optional
+    max_chunksize : int, optional
+    cost_model : CostModel instance, optional
+    memory_budget : MemoryBudget instance, optional
+                    if given, n_processes and max_chunksize are upper
+                    limits that are lowered to fit the budget, and
+                    memory_plan holds the chosen numbers
+    telemetry : Telemetry instance, optional
+                records the run time of every experiment and the timeline
+                of the workers, and adds the telemetry columns to the
+                outcomes (use TelemetryCallback to store them)
+    kwargs : passed on to MultiprocessingEvaluator
+    """
+
+    def __init__(
+        self,
+        msis,
+        n_processes=None,
+        chunks_per_worker=4,
+        max_chunksize=200,
+        cost_model=None,
+        memory_budget=None,
+        telemetry=None,
+        **kwargs,
+    ):
+        super().__init__(msis, n_processes=n_processes, **kwargs)
+        self.chunks_per_worker = chunks_per_worker
+        self.max_chunksize = max_chunksize
+        self.cost_model = cost_model if cost_model is not None else CostModel()
+        self.memory_budget = memory_budget
+        self.memory_monitor = MemoryMonitor(memory_budget)
+        self.memory_plan = None
+        self.telemetry = telemetry
+
+    def initialize(self):
+        if self.memory_budget is not None:
+            # the number of processes of a pool is fixed once it is started
+            probe = probe_worker(self._msis)
+            n_parameters = sum(len(msi.uncertainties) + len(msi.levers) for msi in self._msis)
+            self.memory_plan = self.memory_budget.plan(
+                parent=private_memory(),
+                worker=probe["worker"],
+                result_bytes=probe["result_bytes"],
+                # a float per parameter plus scenario, policy and model
+                experiment_bytes=8 * (n_parameters + 3),
+                max_processes=self.n_processes,
+                max_chunksize=self.max_chunksize,
+            )
+            _logger.info(self.memory_budget.describe(self.memory_plan))
+            self.n_processes = self.memory_plan["n_processes"]
+            self.max_chunksize = self.memory_plan["max_chunksize"]
+        return super().initialize()
+
+    def evaluate_experiments(self, scenarios, policies, callback, combine="factorial"):
+        experiments = list(experiment_generator(scenarios, self._msis, policies, combine=combine))
+        costs = self.cost_model.predict(experiments)
+        chunks = plan_chunks(costs, self.n_processes, self.chunks_per_worker, self.max_chunksize)
+
+        telemetry = self.telemetry is not None
+        if telemetry:
+            self.telemetry.start_call()
+
+        done = queue.Queue()
+        for indices in chunks:
+            chunk = [experiments[i] for i in indices]
+            self._pool.apply_async(
+                _pool_worker,
+                (chunk, telemetry),
+                callback=lambda result, chunk=chunk: done.put((chunk, result, time.time())),
+                error_callback=lambda error, chunk=chunk: done.put((chunk, error, time.time())),
+            )
+
+        for _ in range(len(chunks)):
+            chunk, result, returned = done.get()
+            if isinstance(result, BaseException):
+                raise EMAError("experiment failed") from result
+            blocks, times, memory, stats = result
+            self.cost_model.update(chunk, times)
+            self.memory_monitor.update(memory)
+            if telemetry:
+                self.telemetry.record_chunk(memory["pid"], chunk, stats, returned)
+                blocks.update(Telemetry.columns(stats))
+            unpack_chunk(chunk, blocks, callback)
+
+        if telemetry:
+            self.telemetry.end_call()
+
+        if not self.memory_monitor.check(self.n_processes) and self.max_chunksize > 1:
+            # the pool cannot shrink, smaller chunks at least shrink the result buffers
+            self.max_chunksize = max(1, self.max_chunksize // 2)
+            _logger.warning(f"chunks of at most {self.max_chunksize} experiments from now on")
+
+        _logger.debug(f"{len(experiments)} experiments in {len(chunks)} chunks")
@@ -0,0 +1,235 @@
+"""
+Parallel, bootstrapped extra-trees feature scoring.
+
+Judging whether feature scores have converged means refitting the extra
+trees ensembles of the workbench on subsets of the experiments of growing
+size, one after the other. score_convergence fits all sample sizes and
+bootstrap replicates in a process pool instead. The prepared experiments
+matrix and the outcomes are written once as .npy files, which the workers
+memory-map, so only the row indices of a replicate are sent to a worker.
+
+The scores of every fit are stored under a hash of the data and of the fit
+settings, so refitting the same data, or adding sample sizes or replicates
+to an earlier run, only fits what is missing.
+
+rank_stability compares the rankings of the features between replicates and
+between successive sample sizes, and stable_sample_size reports the sample
+size from which the rankings no longer change, the point at which a
+sampling run could have stopped.
+"""
+import concurrent.futures
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from ema_workbench.analysis import feature_scoring
+from ema_workbench.analysis.scenario_discovery_util import RuleInductionType
+from ema_workbench.util import EMAError, ema_logging
+
+from funs_results import _column_filename
+
+_logger = ema_logging.get_module_logger(__name__)
+
+
+def _hash(*parts):
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else json.dumps(part, default=str).encode())
+    return digest.hexdigest()
+
+
+def _fit(directory, outcome, rows, task_file, random_state, mode, kwargs):
+    """Fit a single extra trees ensemble on memory-mapped data, in a worker"""
+    x = np.load(os.path.join(directory, "x.npy"), mmap_mode="r")
+    y = np.load(os.path.join(directory, "y_" + _column_filename(outcome)), mmap_mode="r")
+    with open(os.path.join(directory, "features.json")) as fh:
+        features = json.load(fh)
+
+    importances, _ = feature_scoring.get_ex_feature_scores(
+        pd.DataFrame(x[rows], columns=features), y[rows], mode=mode, random_state=random_state, **kwargs
+    )
+    scores = importances[1].reindex(features).to_numpy()
+    np.save(task_file, scores)
+    return scores
+
+
+def score_convergence(
+    experiments,
+    outcomes,
+    sample_sizes,
+    n_replicates=10,
+    n_processes=None,
+    cache_dir="feature_scores",
+    seed=0,
+    mode=RuleInductionType.REGRESSION,
+    **kwargs,
+):
+    """Extra trees feature scores for several sample sizes and bootstrap
+    replicates
+
+    Parameters
+    ----------
+    experiments : DataFrame
+                  the uncertainties, nominal columns are encoded as in the
+                  feature scoring of the workbench
+    outcomes : dict of 1d arrays
+    sample_sizes : list of int
+                   every replicate draws this many experiments with
+                   replacement
+    n_replicates : int, optional
+    n_processes : int, optional
+                  defaults to the number of cores
+    cache_dir : str, optional
+                directory for the shared data and the stored scores
+    seed : int, optional
+           the rows and the random state of every fit follow from the seed,
+           the sample size and the replicate
+    mode : RuleInductionType, optional
+    kwargs : passed on to get_ex_feature_scores
+
+    Returns
+    -------
+    DataFrame
+        with columns outcome, n_samples, replicate, feature and score
+    """
+    x, features = feature_scoring._prepare_experiments(experiments)
+    x = np.ascontiguousarray(x, dtype=float)
+    n_rows = len(x)
+    if max(sample_sizes) > n_rows:
+        raise EMAError(f"sample sizes larger than the {n_rows} experiments")
+
+    ys = {name: np.ascontiguousarray(np.asarray(values, dtype=float)) for name, values in outcomes.items()}
+    data_hash = _hash(features, x.tobytes(), *[(name, y.tobytes()) for name, y in ys.items()])
+    directory = os.path.join(os.path.abspath(cache_dir), data_hash)
+    if not os.path.exists(os.path.join(directory, "features.json")):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "x.npy"), x)
+        for name, y in ys.items():
+            np.save(os.path.join(directory, "y_" + _column_filename(name)), y)
+        # written last, so an interrupted run does not leave a valid looking directory
+        with open(os.path.join(directory, "features.json"), "w") as fh:
+            json.dump(features, fh)
+
+    tasks = {}
+    scores = {}
+    for outcome in ys:
+        for n in sample_sizes:
+            for replicate in range(n_replicates):
+                key = (outcome, n, replicate)
+                task_hash = _hash(outcome, n, replicate, seed, str(mode), sorted(kwargs.items()))
+                task_file = os.path.join(directory, f"{task_hash}.npy")
+                if os.path.exists(task_file):
+                    scores[key] = np.load(task_file)
+                    continue
+                rng = np.random.default_rng([seed, n, replicate])
+                rows = np.sort(rng.integers(0, n_rows, size=n))
+                random_state = int(rng.integers(2**31 - 1))
+                tasks[key] = (directory, outcome, rows, task_file, random_state, mode, kwargs)
+
+    _logger.info(f"{len(scores)} feature scorings loaded, fitting {len(tasks)}")
+    if len(tasks) < 2 or n_processes == 1:
+        scores.update({key: _fit(*task) for key, task in tasks.items()})
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes) as pool:
+            futures = {key: pool.submit(_fit, *task) for key, task in tasks.items()}
+            scores.update({key: future.result() for key, future in futures.items()})
+
+    rows = []
+    for (outcome, n, replicate), values in sorted(scores.items(), key=lambda item: item[0]):
+        for feature, score in zip(features, values):
+            rows.append((outcome, n, replicate, feature, score))
+    return pd.DataFrame(rows, columns=["outcome", "n_samples", "replicate", "feature", "score"])
+
+
+def summarize_scores(scores, conf_level=0.95):
+    """Mean and percentile interval of the score of every feature over the
+    replicates, one row per outcome, sample size and feature"""
+    alpha = (1 - conf_level) / 2
+    grouped = scores.groupby(["outcome", "n_samples", "feature"])["score"]
+    return pd.DataFrame(
+        {
+            "mean": grouped.mean(),
+            "lower": grouped.quantile(alpha),
+            "upper": grouped.quantile(1 - alpha),
+        }
+    )
+
+
+def _mean_rank_correlation(ranks):
+    """Mean Spearman correlation between all pairs of rows of ranks"""
+    if len(ranks) < 2:
+        return np.nan
+    correlation = np.corrcoef(ranks)
+    return correlation[np.triu_indices(len(ranks), k=1)].mean()
+
+
+def rank_stability(scores, top=None):
+    """Agreement of the feature rankings
+
+    Parameters
+    ----------
+    scores : DataFrame
+             as returned by score_convergence
+    top : int, optional
+          only rank the features with the highest mean scores at the largest
+          sample size; the order of features without influence is noise and
+          never stabilizes
+
+    Returns
+    -------
+    DataFrame
+        indexed by outcome and sample size, with the mean Spearman
+        correlation between the rankings of the replicates (agreement) and
+        the Spearman correlation between the ranking of the mean scores and
+        that of the next larger sample size (change)
+    """
+    records = []
+    for outcome, data in scores.groupby("outcome"):
+        table = data.pivot_table(index=["n_samples", "replicate"], columns="feature", values="score")
+        sizes = sorted(table.index.get_level_values("n_samples").unique())
+        if top is not None:
+            table = table[table.loc[sizes[-1]].mean().nlargest(top).index]
+        mean_ranks = {}
+        for n in sizes:
+            ranks = table.loc[n].rank(axis=1).to_numpy()
+            mean_ranks[n] = table.loc[n].mean().rank().to_numpy()
+            records.append({"outcome": outcome, "n_samples": n, "agreement": _mean_rank_correlation(ranks)})
+        for record, n, next_n in zip(records[-len(sizes) :], sizes, sizes[1:] + [None]):
+            if next_n is None:
+                record["change"] = np.nan
+            else:
+                record["change"] = np.corrcoef(mean_ranks[n], mean_ranks[next_n])[0, 1]
+    return pd.DataFrame(records).set_index(["outcome", "n_samples"])
+
+
+def stable_sample_size(scores, threshold=0.9, top=None):
+    """The smallest sample size from which the rankings are stable
+
+    The rankings are stable at a sample size when the replicates agree with
+    a mean rank correlation of at least threshold there and at every larger
+    sample size, and the ranking of the mean scores correlates at least as
+    strongly with that of every next sample size. See rank_stability for
+    top.
+
+    Returns
+    -------
+    dict
+        with the sample size per outcome, or None if the rankings did not
+        stabilize within the sample sizes
+    """
+    stability = rank_stability(scores, top=top)
+    result = {}
+    for outcome, data in stability.groupby(level="outcome"):
+        data = data.droplevel("outcome").sort_index()
+        stable = (data["agreement"] >= threshold) & (data["change"].fillna(1.0) >= threshold)
+        # a sample size only counts if all larger ones are stable as well
+        stable_from = stable[::-1].cummin()[::-1]
+        result[outcome] = int(stable_from.idxmax()) if stable_from.any() else None
+        if result[outcome] is None:
+            _logger.info(f"feature ranking of {outcome} not stable within {data.index.max()} samples")
+        else:
+            _logger.info(f"feature ranking of {outcome} stable from {result[outcome]} samples")
+    return result
@@ -1,19 +1,52 @@
+import os
+
 import numpy as np
 import networkx as nx
 import pandas as pd
 from funs_dikes import Lookuplin  # @UnresolvedImport
 
 
+# Column names of the full IJssel dataset (dikeIjssel_alldata.xlsx), the
+# trajectory parameters are used for the dike costs
+ALLDATA_COLUMNS = {
+    "BRANCH": "branch",
+    "traject": "traject_id",
+    "c_traj": "c",
+    "b_traj": "b",
+    "lambda_traj": "lambda",
+}
+
+
 def to_dict_dropna(data):
     return {str(k): v.dropna().to_dict() for k, v in data.items()}
 
 
-def get_network(plann_steps_max=10):
-    """Build network uploading crucial parameters"""
+def prec_nodes(prec_node):
+    """Upstream nodes of a node, several at a confluence, separated by a
+    comma or semicolon"""
+    if not isinstance(prec_node, str):
+        return []
+    return [name.strip() for name in prec_node.replace(";", ",").split(",") if name.strip()]
+
+
+def get_network(plann_steps_max=10, network_file="dikeIjssel.xlsx", data_dir="./data"):
+    """Build network uploading crucial parameters
+
+    All data is read from data_dir, which holds the IJssel data or a network
+    written by funs_synthetic_network.write_network; network_file is the
+    node table within it.
+
+    Every node is connected to the node(s) in its prec_node column. Nodes
+    that are fed by a node with several downstream nodes take the share of
+    its discharge in their optional split column, an even share of the rest
+    otherwise. Upstream nodes other than A.0 follow its flood wave, scaled by
+    their optional discharge share column.
+    """
 
     # Upload dike info
-    df = pd.read_excel("./data/dikeIjssel.xlsx", dtype=object)
+    df = pd.read_excel(os.path.join(data_dir, network_file), dtype=object)
     df = df.set_index("NodeName")
+    df = df.rename(columns={k: v for k, v in ALLDATA_COLUMNS.items() if v not in df})
 
     nodes = df.to_dict("index")
 
@@ -21,6 +54,11 @@ def get_network(plann_steps_max=10):
     G = nx.MultiDiGraph()
     for key, attr in nodes.items():
         G.add_node(key, **attr)
+    for key, attr in nodes.items():
+        for prec in prec_nodes(attr["prec_node"]):
+            if prec not in G:
+                raise KeyError(f"upstream node {prec} of {key} is not in the network")
+            G.add_edge(prec, key)
 
     # Select dike type nodes
     branches = df["branch"].dropna().unique()
@@ -29,17 +67,19 @@ def get_network(plann_steps_max=10):
 
     # Upload fragility curves:
     frag_curves = pd.read_excel(
-        "./data/fragcurves/frag_curves.xlsx", header=None, index_col=0
+        os.path.join(data_dir, "fragcurves", "frag_curves.xlsx"), header=None, index_col=0
     ).transpose()
     calibration_factors = pd.read_excel(
-        "./data/fragcurves/calfactors_pf1250.xlsx", index_col=0
+        os.path.join(data_dir, "fragcurves", "calfactors_pf1250.xlsx"), index_col=0
     )
 
     # Upload room for the river projects:
     steps = np.array(range(plann_steps_max))
 
     projects = pd.read_excel(
-        "./data/rfr_strategies.xlsx", index_col=0, names=["project name", 0, 1, 2, 3, 4]
+        os.path.join(data_dir, "rfr_strategies.xlsx"),
+        index_col=0,
+        names=["project name", 0, 1, 2, 3, 4],
     )
 
     for n in steps:
@@ -51,11 +91,13 @@ def get_network(plann_steps_max=10):
         G.add_node(f"discount rate {n}", **{"value": 0})
 
     # Upload evacuation policies:
-    G.add_node("EWS", **pd.read_excel("./data/EWS.xlsx").to_dict())
+    G.add_node("EWS", **pd.read_excel(os.path.join(data_dir, "EWS.xlsx")).to_dict())
     G.nodes["EWS"]["type"] = "measure"
 
     # Upload muskingum params:
-    Muskingum_params = pd.read_excel("./data/Muskingum/params.xlsx", index_col=0)
+    Muskingum_params = pd.read_excel(
+        os.path.join(data_dir, "Muskingum", "params.xlsx"), index_col=0
+    )
 
     # Fill network with crucial info:
     for dike in dike_list:
@@ -72,24 +114,28 @@ def get_network(plann_steps_max=10):
         G.nodes[dike]["dikelevel"] = Lookuplin(G.nodes[dike]["f"], 1, 0, 0.5)
 
         # Assign stage-discharge relationships
-        filename = f"./data/rating_curves/{dike}_ratingcurve_new.txt"  # Load file
+        filename = os.path.join(data_dir, "rating_curves", f"{dike}_ratingcurve_new.txt")
         rc_array = np.loadtxt(filename)  # Load file into array
         G.nodes[dike]["r"] = rc_array[
             rc_array[:, 0].argsort()
         ]  # Sort on first column before saving
 
         # Assign losses per location:
-        name = f"./data/losses_tables/{dike}_lossestable.xlsx"
+        name = os.path.join(data_dir, "losses_tables", f"{dike}_lossestable.xlsx")
         G.nodes[dike]["table"] = pd.read_excel(name, index_col=0).values
 
-        # Assign Muskingum paramters:
-        G.nodes[dike]["C1"] = Muskingum_params.loc[G.nodes[dike]["prec_node"], "C1"]
-        G.nodes[dike]["C2"] = Muskingum_params.loc[G.nodes[dike]["prec_node"], "C2"]
-        G.nodes[dike]["C3"] = Muskingum_params.loc[G.nodes[dike]["prec_node"], "C3"]
-
-    # The plausible 133 upstream wave-shapes:
-    G.nodes["A.0"]["Qevents_shape"] = pd.read_excel(
-        "./data/hydrology/wave_shapes.xls", index_col=0
-    )
+        # Assign Muskingum paramters, K and X are used to derive C1-C3 for
+        # time steps other than one day. Below a confluence the parameters
+        # of the first upstream node are used:
+        prec = prec_nodes(G.nodes[dike]["prec_node"])[0]
+        for param in ["K", "X", "C1", "C2", "C3"]:
+            G.nodes[dike][param] = Muskingum_params.loc[prec, param]
+
+    # The plausible 133 upstream wave-shapes (synthetic networks are written
+    # as xlsx, as xls can no longer be written):
+    wave_shapes = os.path.join(data_dir, "hydrology", "wave_shapes.xls")
+    if not os.path.exists(wave_shapes):
+        wave_shapes += "x"
+    G.nodes["A.0"]["Qevents_shape"] = pd.read_excel(wave_shapes, index_col=0)
 
     return G, dike_list, dike_branches, steps
@@ -0,0 +1,382 @@
+"""
+Memory budget of the evaluators.
+
+The SLURM jobs allocate a fixed amount of memory per CPU, and how much a
+worker running the DikeNetwork needs depends on the problem formulation (the
+ArrayOutcome of formulation 5, the number of planning steps), on the number
+of events simulated, and on the size of the result buffers. Overruns used to
+show up only when the job was killed.
+
+The memory of a process is measured as the memory private to it (the
+Private_Clean and Private_Dirty fields of /proc/self/smaps_rollup), which is
+what the forked workers add on top of the pages they share with the parent.
+Where that file does not exist the resident set size is used instead.
+
+ChunkedEvaluator uses this module to
+
+1. run a few experiments in a single forked probe process at start-up and
+   measure its memory and the size of the results of an experiment,
+2. pick the number of worker processes, the largest chunk of experiments
+   and the number of experiments whose results the parent may hold before
+   they should be flushed (flush_batch_size), such that the parent and all
+   workers together stay within the MemoryBudget,
+3. keep measuring the workers after every chunk and warn when the observed
+   memory no longer fits the budget.
+
+The memory model is logged, so the numbers behind a choice of process count
+can be checked against the accounting of SLURM afterwards.
+"""
+import concurrent.futures
+import os
+import resource
+import sys
+
+import numpy as np
+
+from ema_workbench import Policy
+from ema_workbench.em_framework.experiment_runner import ExperimentRunner
+from ema_workbench.em_framework.model import AbstractModel
+from ema_workbench.em_framework.parameters import CategoricalParameter
+from ema_workbench.em_framework.points import experiment_generator
+from ema_workbench.em_framework.samplers import sample_uncertainties
+from ema_workbench.em_framework.util import NamedObjectMap
+from ema_workbench.util import EMAError, ema_logging
+
+_logger = ema_logging.get_module_logger(__name__)
+
+_MB = 2**20
+
+
+def format_bytes(n):
+    """Human readable number of bytes"""
+    for unit in ["B", "kB", "MB", "GB"]:
+        if abs(n) < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def resident_memory():
+    """Resident set size of the current process in bytes"""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return peak_memory()
+
+
+def private_memory():
+    """Bytes of memory private to the current process"""
+    try:
+        total = 0
+        with open("/proc/self/smaps_rollup") as fh:
+            for line in fh:
+                if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                    total += int(line.split()[1]) * 1024
+        return total
+    except OSError:
+        return resident_memory()
+
+
+def peak_memory():
+    """Peak resident set size of the current process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def worker_memory():
+    """Memory measurements of the current process, as sent back by the
+    workers with every chunk"""
+    return {
+        "pid": os.getpid(),
+        "private": private_memory(),
+        "resident": resident_memory(),
+        "peak": peak_memory(),
+    }
+
+
+def budget_from_environment():
+    """Memory available to the job and where that number came from
+
+    The SLURM allocation (SLURM_MEM_PER_CPU times the CPUs of the task, or
+    SLURM_MEM_PER_NODE) is used when the job runs under SLURM, the physical
+    memory of the machine otherwise.
+
+    Returns
+    -------
+    tuple
+        bytes and a description of the source
+    """
+    per_cpu = os.environ.get("SLURM_MEM_PER_CPU")
+    if per_cpu:
+        cpus = int(
+            os.environ.get("SLURM_CPUS_PER_TASK") or os.environ.get("SLURM_CPUS_ON_NODE") or 1
+        )
+        return int(per_cpu) * _MB * cpus, f"SLURM_MEM_PER_CPU for {cpus} CPU(s)"
+    per_node = os.environ.get("SLURM_MEM_PER_NODE")
+    if per_node:
+        return int(per_node) * _MB, "SLURM_MEM_PER_NODE"
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"), "physical memory"
+
+
+def probe_experiments(model, n=4):
+    """Experiments for the memory probe
+
+    A few sampled scenarios under the policy with every lever at its lower
+    bound (the first category for categorical levers). For the dike model
+    that is the policy without any measures, which has the most breaches
+    and so the most events.
+    """
+    lowest = {
+        lever.name: lever.categories[0].value
+        if isinstance(lever, CategoricalParameter)
+        else lever.lower_bound
+        for lever in model.levers
+    }
+    scenarios = list(sample_uncertainties(model, n))
+    return list(experiment_generator(scenarios, [model], [Policy("memory probe", **lowest)]))
+
+
+def _probe(models, experiments):
+    """Run experiments in a fresh worker and measure its memory"""
+    from funs_dispatch import run_chunk
+
+    msis = NamedObjectMap(AbstractModel)
+    msis.extend(models)
+    runner = ExperimentRunner(msis)
+    start = worker_memory()
+    blocks, times = run_chunk(runner, experiments)
+    end = worker_memory()
+    runner.cleanup()
+    # the peak resident set size also holds memory that was freed again
+    # before the end, but counts the pages shared with the parent as well
+    shared = start["resident"] - start["private"]
+    return {
+        "start": start["private"],
+        "private": end["private"],
+        "peak": end["peak"],
+        "worker": max(end["private"], end["peak"] - shared),
+        "result_bytes": sum(block.nbytes for block in blocks.values()) / len(experiments),
+        "run_time": float(np.mean(times)),
+    }
+
+
+def probe_worker(msis, n=4):
+    """Memory of a worker process after running a few experiments
+
+    The probe process is started the same way as the workers of the pool, so
+    it shares the pages of the parent as they do.
+
+    Parameters
+    ----------
+    msis : collection of models
+    n : int, optional
+        number of experiments per model
+
+    Returns
+    -------
+    dict
+        with the private memory of the worker when started (start) and
+        after the experiments (private), its peak resident set size, the
+        estimated memory of a worker (the larger of its private memory and
+        its peak less the pages it shared with the parent at start), the
+        bytes of results per experiment and the mean run time
+    """
+    models = list(msis)
+    experiments = [e for model in models for e in probe_experiments(model, n)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+        probe = pool.submit(_probe, models, experiments).result()
+
+    _logger.info(
+        f"memory probe: worker {format_bytes(probe['start'])} at start, "
+        f"{format_bytes(probe['private'])} after {len(experiments)} experiments "
+        f"(peak resident {format_bytes(probe['peak'])}, estimated {format_bytes(probe['worker'])}), "
+        f"{format_bytes(probe['result_bytes'])} of results per experiment"
+    )
+    return probe
+
+
+class MemoryBudget:
+    """Memory available to an evaluator, its workers and its results
+
+    Parameters
+    ----------
+    total : int, optional
+            bytes for the parent and all workers together, by default the
+            SLURM allocation or the physical memory, see
+            budget_from_environment
+    reserve : float, optional
+              share of the total that is kept free, for the operating system
+              and everything the measurements miss
+    margin : float, optional
+             relative margin on the measured memory of a worker, which grows
+             with the number of events of the experiments it runs
+    result_share : float, optional
+                   share of the memory left after the workers that the
+                   results held by the parent may take
+    """
+
+    def __init__(self, total=None, reserve=0.1, margin=0.25, result_share=0.5):
+        if total is None:
+            total, self.source = budget_from_environment()
+        else:
+            self.source = "configured"
+        self.total = int(total)
+        self.reserve = reserve
+        self.margin = margin
+        self.result_share = result_share
+
+    @property
+    def usable(self):
+        return self.total * (1 - self.reserve)
+
+    def plan(self, parent, worker, result_bytes, experiment_bytes, max_processes, max_chunksize):
+        """Process count, chunk size and flush size that fit the budget
+
+        Parameters
+        ----------
+        parent : int
+                 bytes used by the parent process
+        worker : int
+                 bytes used by a worker
+        result_bytes : float
+                       bytes of the outcomes of an experiment
+        experiment_bytes : float
+                           bytes of a row of the experiments
+        max_processes : int
+        max_chunksize : int
+
+        Returns
+        -------
+        dict
+            n_processes, max_chunksize and flush_size (experiments whose
+            results the parent can hold), with the inputs and the projected
+            use of memory
+
+        Raises
+        ------
+        EMAError if not even a single worker fits the budget
+        """
+        worker = worker * (1 + self.margin)
+        result_bytes = max(result_bytes, 1.0)
+        # a chunk of results never takes more than a tenth of a worker
+        chunksize = int(min(max_chunksize, max(1, 0.1 * worker // result_bytes)))
+        # a worker holds the block of a chunk and its pickle, the parent
+        # receives it once more
+        per_worker = worker + 3 * chunksize * result_bytes
+
+        available = self.usable - parent
+        n_processes = int(min(max_processes, available // per_worker))
+        if n_processes < 1:
+            raise EMAError(
+                f"a memory budget of {format_bytes(self.total)} ({self.source}) leaves "
+                f"{format_bytes(available)} for the workers, a single worker needs {format_bytes(per_worker)}"
+            )
+
+        left = available - n_processes * per_worker
+        flush_size = int(max(1, self.result_share * left // (result_bytes + experiment_bytes)))
+        return {
+            "n_processes": n_processes,
+            "max_chunksize": chunksize,
+            "flush_size": flush_size,
+            "parent": parent,
+            "worker": worker,
+            "result_bytes": result_bytes,
+            "experiment_bytes": experiment_bytes,
+            "projected": parent + n_processes * per_worker + flush_size * (result_bytes + experiment_bytes),
+        }
+
+    def describe(self, plan):
+        """The memory model of a plan as a single line for the log"""
+        return (
+            f"memory budget {format_bytes(self.total)} ({self.source}, {self.reserve:.0%} reserved): "
+            f"parent {format_bytes(plan['parent'])}, "
+            f"{plan['n_processes']} workers of {format_bytes(plan['worker'])} "
+            f"(incl. {self.margin:.0%} margin), "
+            f"chunks of at most {plan['max_chunksize']} experiments, "
+            f"results of {plan['flush_size']} experiments held before a flush "
+            f"({format_bytes(plan['result_bytes'] + plan['experiment_bytes'])} each), "
+            f"projected {format_bytes(plan['projected'])}"
+        )
+
+
+class MemoryMonitor:
+    """Memory of the workers as measured after every chunk
+
+    Parameters
+    ----------
+    budget : MemoryBudget instance, optional
+             without a budget the measurements are only logged at debug
+             level
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.workers = {}
+        self.peaks = {}
+        self._warned = False
+
+    def update(self, memory):
+        pid = memory["pid"]
+        self.workers[pid] = max(self.workers.get(pid, 0), memory["private"])
+        self.peaks[pid] = max(self.peaks.get(pid, 0), memory["peak"])
+
+    @property
+    def largest_worker(self):
+        return max(self.workers.values(), default=0)
+
+    def check(self, n_processes, parent=None):
+        """Compare the measured memory with the budget
+
+        Parameters
+        ----------
+        n_processes : int
+        parent : int, optional
+                 bytes used by the parent, by default the private memory
+                 of the current process
+
+        Returns
+        -------
+        bool
+            False if the parent and n_processes workers of the largest
+            measured size exceed the usable budget
+        """
+        if parent is None:
+            parent = private_memory()
+        projected = parent + n_processes * self.largest_worker
+        _logger.debug(
+            f"largest worker {format_bytes(self.largest_worker)}, projected {format_bytes(projected)}"
+        )
+        if self.budget is None or projected <= self.budget.usable:
+            return True
+        if not self._warned:
+            _logger.warning(
+                f"workers of up to {format_bytes(self.largest_worker)} measured, {n_processes} of them "
+                f"need {format_bytes(projected)}, more than the usable "
+                f"{format_bytes(self.budget.usable)} of the memory budget"
+            )
+            self._warned = True
+        return False
+
+
+def flush_batch_size(evaluator, batch_size, experiments_per_item=1):
+    """Batch size of an ExperimentCheckpoint within the flush size of the
+    evaluator
+
+    Parameters
+    ----------
+    evaluator : evaluator instance
+    batch_size : int
+                 the batch size without a memory budget
+    experiments_per_item : int, optional
+                           experiments per batched scenario or policy, i.e.
+                           the number of policies or scenarios they are
+                           combined with
+    """
+    plan = getattr(evaluator, "memory_plan", None)
+    if plan is None:
+        return batch_size
+    limit = max(1, plan["flush_size"] // experiments_per_item)
+    if limit < batch_size:
+        _logger.info(f"batches of {limit} instead of {batch_size} to stay within the memory budget")
+    return min(batch_size, limit)
@@ -0,0 +1,308 @@
+"""
+MPI execution path for the dike model drivers.
+
+The MultiprocessingEvaluator is limited to the cores of a single node. With
+MPI the drivers can spread their experiments over all ranks of a SLURM
+allocation, on as many nodes as requested:
+
+    mpirun -n 4 python dike_model_simulation_final_0policy.py --mpi
+    srun python dike_model_optimization_project_final.py --mpi
+
+Rank 0 runs the driver as usual; all other ranks call start_workers and
+become workers that wait for experiments. The model is only built on rank 0.
+When an MPIClusterEvaluator is opened the pickled model is sent once to every
+node and shared with the other ranks on that node, so the input data of the
+DikeNetwork is not read or transferred once per worker. Experiments are handed
+out in cost-balanced chunks (see funs_dispatch) to whichever worker is idle,
+so slow experiments do not hold up the other workers.
+
+Several evaluators can be open at the same time (e.g. the full and the
+screening model of the optimization driver); every evaluator is a separate
+session on the workers.
+"""
+import atexit
+import collections
+import itertools
+import pickle
+import signal
+import sys
+import time
+
+from ema_workbench import MultiprocessingEvaluator
+from ema_workbench.em_framework.evaluators import BaseEvaluator, experiment_generator
+from ema_workbench.em_framework.experiment_runner import ExperimentRunner
+from ema_workbench.em_framework.model import AbstractModel
+from ema_workbench.em_framework.util import NamedObjectMap
+from ema_workbench.util import EMAError, ema_logging
+
+from funs_dispatch import CostModel, plan_chunks, run_chunk_with_telemetry, unpack_chunk
+from funs_memory import MemoryMonitor
+from funs_telemetry import Telemetry
+
+_logger = ema_logging.get_module_logger(__name__)
+
+MASTER = 0
+
+# message tags
+MODELS, CLOSE, TASK, RESULT, SHUTDOWN = range(1, 6)
+
+_communicators = None
+_sessions = itertools.count()
+
+
+def _setup_communicators():
+    """Return the world communicator, the communicator of the ranks on the same
+    node and the communicator between the first ranks of every node"""
+    from mpi4py import MPI
+
+    world = MPI.COMM_WORLD
+    rank = world.Get_rank()
+    node = world.Split_type(MPI.COMM_TYPE_SHARED, key=rank)
+    is_leader = node.Get_rank() == 0
+    leaders = world.Split(0 if is_leader else MPI.UNDEFINED, key=rank)
+    return world, node, leaders
+
+
+def _share(payload, node, leaders):
+    """Broadcast a pickled payload from rank 0 to the first rank on every node,
+    and from there to the other ranks on the same node
+
+    Every worker unpickles its own copy, rank 0 already has the objects and
+    gets None.
+    """
+    from mpi4py import MPI
+
+    if leaders != MPI.COMM_NULL:
+        payload = leaders.bcast(payload, root=0)
+    payload = node.bcast(payload, root=0)
+    if MPI.COMM_WORLD.Get_rank() == MASTER:
+        return None
+    return pickle.loads(payload)
+
+
+def _serve(world, node, leaders):
+    """Worker loop, runs experiments until the master sends SHUTDOWN"""
+    from mpi4py import MPI
+
+    models = {}
+    runners = {}
+    status = MPI.Status()
+    while True:
+        message = world.recv(source=MASTER, tag=MPI.ANY_TAG, status=status)
+        tag = status.Get_tag()
+
+        if tag == MODELS:
+            msis = NamedObjectMap(AbstractModel)
+            msis.extend(_share(None, node, leaders))
+            models[message] = msis
+            runners[message] = ExperimentRunner(msis)
+        elif tag == TASK:
+            session, experiments, telemetry = message
+            runner = runners[session]
+            try:
+                results = run_chunk_with_telemetry(runner, experiments, telemetry)
+            except (Exception, EMAError) as e:
+                # EMAError is not an Exception, a failed model run raises it
+                # and leaves the runner without models
+                results = e
+                runners[session] = ExperimentRunner(models[session])
+            world.send(results, dest=MASTER, tag=RESULT)
+        elif tag == CLOSE:
+            del models[message]
+            runners.pop(message).cleanup()
+        elif tag == SHUTDOWN:
+            break
+
+
+def _shutdown():
+    world = _communicators[0]
+    for rank in range(1, world.Get_size()):
+        world.send(None, dest=rank, tag=SHUTDOWN)
+
+
+def start_workers():
+    """Turn every rank except rank 0 into a worker
+
+    Has to be called on all ranks before the model is built. On the worker
+    ranks this function only returns by exiting the process once the driver
+    on rank 0 has finished.
+
+    Raises
+    ------
+    EMAError if the script was not started with at least two MPI ranks
+    """
+    global _communicators
+
+    _communicators = _setup_communicators()
+    world, node, leaders = _communicators
+    if world.Get_size() < 2:
+        raise EMAError("the MPI path needs at least two ranks, start the script with mpirun -n <ranks>")
+
+    if world.Get_rank() != MASTER:
+        # the preemption signal is meant for the driver on rank 0, which
+        # still needs the workers to finish the current unit of work
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        _serve(world, node, leaders)
+        sys.exit(0)
+
+    n_nodes = leaders.Get_size()
+    _logger.info(f"MPI started with {world.Get_size() - 1} workers on {n_nodes} node(s)")
+    atexit.register(_shutdown)
+
+
+class MPIClusterEvaluator(BaseEvaluator):
+    """Evaluator that runs experiments on the worker ranks started with
+    start_workers
+
+    Parameters
+    ----------
+    msis : collection of models
+    chunks_per_worker : int, optional
+    max_chunksize : int, optional
+    cost_model : CostModel instance, optional
+    memory_budget : MemoryBudget instance, optional
+                    memory of a single rank; the number of ranks is fixed
+                    by mpirun, so the memory of the workers is only
+                    checked against it
+    telemetry : Telemetry instance, optional
+                see ChunkedEvaluator, the workers are identified by rank
+    """
+
+    def __init__(
+        self,
+        msis,
+        chunks_per_worker=4,
+        max_chunksize=200,
+        cost_model=None,
+        memory_budget=None,
+        telemetry=None,
+        **kwargs,
+    ):
+        super().__init__(msis, **kwargs)
+        self.chunks_per_worker = chunks_per_worker
+        self.max_chunksize = max_chunksize
+        self.cost_model = cost_model if cost_model is not None else CostModel()
+        self.memory_monitor = MemoryMonitor(memory_budget)
+        self.telemetry = telemetry
+        self.session = None
+        self._idle = []
+        self._assigned = {}
+
+    @property
+    def n_processes(self):
+        return _communicators[0].Get_size() - 1
+
+    def initialize(self):
+        if _communicators is None:
+            raise EMAError("call start_workers on all ranks before using the MPIClusterEvaluator")
+        world, node, leaders = _communicators
+
+        self.session = next(_sessions)
+        for rank in range(1, world.Get_size()):
+            world.send(self.session, dest=rank, tag=MODELS)
+        _share(pickle.dumps(list(self._msis), protocol=pickle.HIGHEST_PROTOCOL), node, leaders)
+
+        self._idle = list(range(1, world.Get_size()))
+
+        _logger.info(f"MPI session {self.session} started with {self.n_processes} workers")
+        return self
+
+    def submit(self, experiment):
+        """Send a single experiment to an idle worker, see collect"""
+        world = _communicators[0]
+        if not self._idle:
+            raise EMAError("no idle worker, collect a result first")
+        self._send(world, self._idle.pop(), [experiment])
+
+    def _send(self, world, rank, chunk):
+        self._assigned[rank] = chunk
+        world.send((self.session, chunk, self.telemetry is not None), dest=rank, tag=TASK)
+
+    def _receive(self, world):
+        """Wait for any worker, returns its rank, chunk of experiments and
+        outcome blocks"""
+        from mpi4py import MPI
+
+        status = MPI.Status()
+        results = world.recv(source=MPI.ANY_SOURCE, tag=RESULT, status=status)
+        returned = time.time()
+        rank = status.Get_source()
+        chunk = self._assigned.pop(rank)
+        if isinstance(results, (Exception, EMAError)):
+            self._drain(world)
+            raise EMAError(f"experiment failed on rank {rank}") from results
+
+        blocks, times, memory, stats = results
+        self.cost_model.update(chunk, times)
+        self.memory_monitor.update(memory)
+        if stats is not None:
+            self.telemetry.record_chunk(rank, chunk, stats, returned)
+            blocks.update(Telemetry.columns(stats))
+        return rank, chunk, blocks
+
+    def _drain(self, world):
+        """Wait for the chunks still running on the other workers and discard
+        them, so that every worker is idle again after a failed experiment"""
+        for rank in list(self._assigned):
+            world.recv(source=rank, tag=RESULT)
+        self._assigned = {}
+        self._idle = list(range(1, world.Get_size()))
+
+    def collect(self):
+        """Wait for any submitted experiment to finish
+
+        Returns
+        -------
+        tuple
+            experiment and outcomes
+        """
+        rank, chunk, blocks = self._receive(_communicators[0])
+        self._idle.append(rank)
+        return chunk[0], {name: block[0] for name, block in blocks.items()}
+
+    def finalize(self):
+        world = _communicators[0]
+        for rank in range(1, world.Get_size()):
+            world.send(self.session, dest=rank, tag=CLOSE)
+
+    def evaluate_experiments(self, scenarios, policies, callback, combine="factorial"):
+        world = _communicators[0]
+        if self.telemetry is not None:
+            self.telemetry.start_call()
+        experiments = list(experiment_generator(scenarios, self._msis, policies, combine=combine))
+        costs = self.cost_model.predict(experiments)
+        chunks = collections.deque(
+            [experiments[i] for i in indices]
+            for indices in plan_chunks(
+                costs, self.n_processes, self.chunks_per_worker, self.max_chunksize
+            )
+        )
+
+        # fill all workers, then hand out a new chunk whenever a worker reports back
+        for rank in range(1, world.Get_size()):
+            if not chunks:
+                break
+            self._send(world, rank, chunks.popleft())
+
+        while self._assigned:
+            rank, chunk, blocks = self._receive(world)
+            unpack_chunk(chunk, blocks, callback)
+            if chunks:
+                self._send(world, rank, chunks.popleft())
+
+        # every rank has its own share of the allocation
+        self.memory_monitor.check(1, parent=0)
+        if self.telemetry is not None:
+            self.telemetry.end_call()
+
+
+def get_evaluator(msis, mpi=False, fallback=MultiprocessingEvaluator, **kwargs):
+    """MPIClusterEvaluator when running under MPI, the fallback evaluator
+    class otherwise, kwargs are passed on to the fallback; a memory_budget
+    and telemetry are passed on to both"""
+    if mpi:
+        return MPIClusterEvaluator(
+            msis, memory_budget=kwargs.get("memory_budget"), telemetry=kwargs.get("telemetry")
+        )
+    return fallback(msis, **kwargs)
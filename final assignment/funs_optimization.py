@@ -0,0 +1,351 @@
+"""
+Project level optimization loop for the direct search.
+
+run_optimization mirrors ``evaluator.optimize`` from the workbench, but owns the
+loop over the generations of the optimizer instead of handing it to
+``optimizer.run``. That gives the drivers a place to write checkpoints between
+generations and to resume an interrupted run from the last checkpoint.
+
+The loop can also screen the first generations with a cheaper evaluator, for
+example one wrapping a low fidelity copy of the dike model (see with_fidelity
+in problem_formulation_project_final). Once the screening budget is spent, the
+population and the archive are re-evaluated with the full fidelity evaluator
+and the search continues at full fidelity.
+
+With a surrogate (see funs_surrogate) the offspring are pre-screened on their
+predicted objectives, so that only promising lever combinations are evaluated.
+
+A run can be warm started from the policies found by earlier runs, see
+load_stored_policies. The stored policies replace part of the random initial
+population and so end up in the epsilon archive after the first generation.
+
+With a stopping rule (see ConvergenceStop in funs_convergence) the run ends
+before the nfe budget is spent once the search no longer improves.
+
+With a cost screen (see funs_cost_screening) the offspring are first checked
+on the objectives that only depend on the levers. Offspring over budget, or
+that would be epsilon-dominated by the archive even without any flood damage,
+are rejected before the dike model is run.
+"""
+import functools
+import glob
+import random
+
+import numpy as np
+import pandas as pd
+from platypus import InjectedPopulation, PlatypusConfig, Solution
+
+from ema_workbench import IntegerParameter
+from ema_workbench.em_framework import callbacks, evaluators
+from ema_workbench.em_framework.optimization import (
+    CombinedVariator,
+    Convergence,
+    EpsNSGAII,
+    to_dataframe,
+    to_problem,
+)
+from ema_workbench.util import EMAError, ema_logging
+from ema_workbench.util.ema_logging import INFO, temporary_filter
+
+from funs_checkpoint import CampaignInterrupted
+from funs_cost_screening import CostScreening
+from funs_surrogate import SurrogateScreening
+
+_logger = ema_logging.get_module_logger(__name__)
+
+
+def _default_variator(problem):
+    """Same variator choice as the workbench: platypus defaults for a single
+    variable type, the CombinedVariator for mixed types"""
+    klass = problem.types[0].__class__
+    if all(isinstance(t, klass) for t in problem.types):
+        return None
+    return CombinedVariator()
+
+
+# stored policies in order of preference, the best policies of the robustness analysis first
+STORED_POLICY_FILES = [
+    "./data/5_best_policies.csv",
+    "./data/857_policies_optimization.csv",
+    "./data/directed_search/optimization_results_seed_*_scenario_*.csv",
+    "./optimization_results_seed_*_scenario_*.csv",
+]
+
+
+def _valid_lever_values(values, lever):
+    """Mask of the values that are valid for the lever"""
+    if hasattr(lever, "categories"):
+        return values.isin([c.value for c in lever.categories])
+    valid = values.between(lever.lower_bound, lever.upper_bound)
+    if isinstance(lever, IntegerParameter):
+        valid &= np.isclose(values, values.round())
+    return valid
+
+
+def load_stored_policies(model, file_names=STORED_POLICY_FILES):
+    """Collect the lever values of stored policies for the levers of model
+
+    Parameters
+    ----------
+    model : Model instance
+    file_names : list of str, optional
+                 CSV files, glob patterns are expanded, earlier files take
+                 precedence
+
+    Returns
+    -------
+    DataFrame
+        one row per unique policy, with one column per lever of model
+
+    Files that do not contain all levers of the model are skipped, columns of
+    other levers and outcomes are dropped, and policies with values outside
+    the range of a lever are removed.
+    """
+    lever_names = [lever.name for lever in model.levers]
+    frames = []
+    for pattern in file_names:
+        for file_name in sorted(glob.glob(pattern)):
+            data = pd.read_csv(file_name)
+            missing = set(lever_names) - set(data.columns)
+            if missing:
+                _logger.info(f"skipping {file_name}, missing levers {sorted(missing)}")
+                continue
+            frames.append(data[lever_names].dropna())
+
+    if not frames:
+        return pd.DataFrame(columns=lever_names)
+
+    policies = pd.concat(frames, ignore_index=True)
+    valid = np.ones(len(policies), dtype=bool)
+    for lever in model.levers:
+        valid &= _valid_lever_values(policies[lever.name], lever).to_numpy()
+        if isinstance(lever, IntegerParameter):
+            policies[lever.name] = policies[lever.name].round().astype(int)
+
+    policies = policies[valid].drop_duplicates(ignore_index=True)
+    _logger.info(f"loaded {len(policies)} unique stored policies")
+    return policies
+
+
+def warm_start_generator(problem, policies, population_size=100, fraction=0.5):
+    """Generator for an initial population that is partly made of stored
+    policies
+
+    Parameters
+    ----------
+    problem : Problem instance
+    policies : DataFrame
+               lever values, as returned by load_stored_policies
+    population_size : int, optional
+    fraction : float, optional
+               at most this fraction of the initial population is taken from
+               the stored policies, the rest is random to keep diversity
+
+    If there are more stored policies than places, the first ones (from the
+    most preferred files) are always kept and the remaining places are filled
+    with a random sample of the others.
+    """
+    n = min(len(policies), int(fraction * population_size))
+    n_first = min(n, max(1, n // 10))
+    rest = random.sample(range(n_first, len(policies)), n - n_first) if n > n_first else []
+    selected = policies.iloc[list(range(n_first)) + rest]
+
+    solutions = []
+    for _, row in selected.iterrows():
+        solution = Solution(problem)
+        solution.variables[:] = [
+            platypus_type.encode(row[name])
+            for platypus_type, name in zip(problem.types, problem.parameter_names)
+        ]
+        solutions.append(solution)
+    _logger.info(f"warm start with {len(solutions)} stored policies")
+    return InjectedPopulation(solutions)
+
+
+def reevaluate(optimizer):
+    """Evaluate the population and the archive again with the current evaluator
+    and rebuild the archive from the new objective values
+
+    The improvement counter of the archive is kept, so epsilon progress stays
+    comparable over the switch.
+    """
+    solutions = {id(s): s for s in list(optimizer.population) + list(optimizer.archive)}
+    solutions = list(solutions.values())
+    for solution in solutions:
+        solution.evaluated = False
+    optimizer.evaluate_all(solutions)
+
+    improvements = optimizer.archive.improvements
+    optimizer.archive._contents = []
+    optimizer.archive += solutions
+    optimizer.archive.improvements = improvements
+    optimizer.result = optimizer.archive
+
+
+def run_optimization(
+    model,
+    evaluator,
+    nfe,
+    searchover="levers",
+    reference=None,
+    convergence=None,
+    constraints=None,
+    convergence_freq=1000,
+    logging_freq=5,
+    algorithm=EpsNSGAII,
+    variator=None,
+    checkpoint=None,
+    screening_evaluator=None,
+    screening_nfe=0,
+    surrogate=None,
+    surrogate_candidates=4,
+    cost_screen=None,
+    warm_start=None,
+    stopping_rule=None,
+    **kwargs,
+):
+    """Optimize the model, optionally resuming from and writing checkpoints
+
+    Parameters
+    ----------
+    model : Model instance
+    evaluator : evaluator instance
+    nfe : int
+    searchover : {'levers', 'uncertainties'}, optional
+    reference : Scenario or Policy instance, optional
+    convergence : list of convergence metrics, optional
+    constraints : list, optional
+    convergence_freq : int, optional
+                       nfe between convergence checks
+    logging_freq : int, optional
+                   number of generations between logging of progress
+    algorithm : platypus Algorithm class, optional
+    variator : platypus Variator instance, optional
+    checkpoint : OptimizationCheckpoint instance, optional
+                 if the checkpoint file exists the run is resumed from it,
+                 and new checkpoints are written while the run progresses
+    screening_evaluator : evaluator instance, optional
+                          cheaper evaluator used for the first screening_nfe
+                          function evaluations
+    screening_nfe : int, optional
+                    number of function evaluations done with the screening
+                    evaluator, these count towards nfe
+    surrogate : Surrogate instance, optional
+                if given, offspring are pre-screened on the predicted
+                objectives, the prediction error ends up in surrogate.history
+    surrogate_candidates : int, optional
+                           number of candidate offspring generated for every
+                           offspring that is evaluated
+    cost_screen : CostScreen instance, optional
+                  if given, its budgets are added to the constraints and
+                  offspring are rejected on their cheap objectives before
+                  they are evaluated
+    warm_start : DataFrame, optional
+                 lever values of stored policies used to seed the initial
+                 population, see load_stored_policies
+    stopping_rule : callable, optional
+                    called with the optimizer after every full fidelity
+                    generation, the run ends when it returns True
+    kwargs : passed on to the algorithm, e.g. epsilons
+
+    Returns
+    -------
+    tuple
+        DataFrame with the final archive, and DataFrame with the convergence
+        information, as returned by evaluator.optimize
+
+    Raises
+    ------
+    EMAError if the number of epsilons does not match the number of outcomes
+    """
+    if cost_screen is not None:
+        constraints = list(constraints or []) + cost_screen.constraints()
+    problem = to_problem(model, searchover, reference=reference, constraints=constraints)
+
+    if "epsilons" in kwargs and len(kwargs["epsilons"]) != len(problem.outcome_names):
+        raise EMAError("Number of epsilon values does not match number of outcomes")
+
+    if variator is None:
+        variator = _default_variator(problem)
+    screening = None
+    if cost_screen is not None:
+        if variator is None:
+            variator = PlatypusConfig.default_variator(problem)
+        variator = screening = CostScreening(variator, cost_screen, problem, epsilons=kwargs.get("epsilons"))
+    if surrogate is not None:
+        if variator is None:
+            variator = PlatypusConfig.default_variator(problem)
+        variator = SurrogateScreening(variator, surrogate, problem, candidates=surrogate_candidates)
+
+    if warm_start is not None and len(warm_start):
+        kwargs["generator"] = warm_start_generator(
+            problem, warm_start, population_size=kwargs.get("population_size", 100)
+        )
+
+    optimizer = algorithm(
+        problem, evaluator=evaluator, variator=variator, log_frequency=500, **kwargs
+    )
+    if surrogate is not None:
+        variator.attach(optimizer)
+    if screening is not None:
+        screening.attach(optimizer)
+
+    convergence = Convergence(
+        convergence, nfe, convergence_freq=convergence_freq, logging_freq=logging_freq
+    )
+    evaluator.callback = functools.partial(convergence, optimizer)
+
+    state = {"screening": screening_evaluator is not None and screening_nfe > 0}
+    if state["screening"]:
+        screening_evaluator.callback = evaluator.callback
+
+    if checkpoint is not None and checkpoint.exists:
+        state.update(checkpoint.restore(optimizer, convergence))
+        if stopping_rule is not None and "stopping_rule" in state:
+            stopping_rule.set_state(state["stopping_rule"])
+
+    if state["screening"]:
+        optimizer.evaluator = screening_evaluator
+
+    with temporary_filter(name=[callbacks.__name__, evaluators.__name__], level=INFO):
+        while optimizer.nfe < nfe:
+            if state["screening"] and optimizer.nfe >= screening_nfe:
+                _logger.info(f"screening finished at nfe {optimizer.nfe}, re-evaluating archive")
+                optimizer.evaluator = evaluator
+                reevaluate(optimizer)
+                state["screening"] = False
+                continue
+
+            optimizer.step()
+            if surrogate is not None:
+                variator.observe(full_fidelity=not state["screening"])
+
+            # the objectives of the screening evaluator are not comparable
+            converged = (
+                stopping_rule is not None and not state["screening"] and stopping_rule(optimizer)
+            )
+            if converged:
+                _logger.info(f"stopping at nfe {optimizer.nfe}, {stopping_rule.reason}")
+                break
+
+            if checkpoint is not None and checkpoint.due(optimizer):
+                if stopping_rule is not None:
+                    state["stopping_rule"] = stopping_rule.get_state()
+                checkpoint.save(optimizer, convergence, extra=state)
+                if checkpoint.preemption is not None and checkpoint.preemption.stop_requested:
+                    raise CampaignInterrupted(f"optimization stopped at nfe {optimizer.nfe}")
+
+    # a run that ends during screening still reports full fidelity results
+    if state["screening"]:
+        optimizer.evaluator = evaluator
+        reevaluate(optimizer)
+
+    convergence(optimizer, force=True)
+
+    results = to_dataframe(optimizer.result, problem.parameter_names, problem.outcome_names)
+    convergence = convergence.to_dataframe()
+
+    if screening is not None:
+        _logger.info(f"cost screening of the offspring: {screening.summary()}")
+    _logger.info(f"optimization completed, found {len(optimizer.archive)} solutions")
+    return results, convergence
@@ -0,0 +1,217 @@
+"""
+Vectorized non-dominated filtering for large policy sets.
+
+The workbench filters policy sets with epsilon_nondominated, which rebuilds a
+platypus Solution for every row and adds them one by one to an epsilon box
+archive, comparing every new solution with the archive in pure python. That
+is slow for the merged results of the 25 optimization runs, and it fails for
+lever names that are not valid python identifiers.
+
+This module works on plain arrays of objective values:
+
+* nondominated_mask and nondominated_sort for Pareto filtering and ranking,
+* epsilon_nondominated_mask for epsilon box filtering, with the same boxes
+  and the same choice of the solution kept per box as the platypus
+  EpsilonBoxArchive,
+* EpsilonArchive for incremental insertion of batches of points,
+* epsilon_nondominated, a drop-in replacement for the workbench function
+  that filters DataFrames of results.
+
+Objectives are minimized, arrays with maximized objectives are converted
+with minimized.
+"""
+import numpy as np
+import pandas as pd
+
+from platypus import Direction
+
+from ema_workbench.util import EMAError, ema_logging
+
+_logger = ema_logging.get_module_logger(__name__)
+
+
+def minimized(objectives, directions=None):
+    """Objective values as a float array in which every objective is
+    minimized, maximized objectives are negated"""
+    objectives = np.asarray(objectives, dtype=float)
+    if directions is None:
+        return objectives
+    signs = np.array([1.0 if Direction(d) == Direction.MINIMIZE else -1.0 for d in directions])
+    return objectives * signs
+
+
+def nondominated_mask(objectives):
+    """Mask of the points that are not dominated by any other point
+
+    Parameters
+    ----------
+    objectives : 2d array
+                 minimized objective values, one row per point
+
+    Returns
+    -------
+    1d boolean array
+
+    The points are sorted lexicographically, so a point can only be
+    dominated by points before it. The first remaining point is therefore
+    non-dominated, and all points it dominates are removed in one vectorized
+    comparison. The number of iterations equals the size of the front.
+    Duplicate points are all kept.
+    """
+    points = np.asarray(objectives, dtype=float)
+    mask = np.zeros(len(points), dtype=bool)
+    if len(points) == 0:
+        return mask
+
+    order = np.lexsort(points.T[::-1])
+    remaining = points[order]
+    indices = order
+    while len(indices):
+        head, rest = remaining[0], remaining[1:]
+        mask[indices[0]] = True
+        dominated = np.all(head <= rest, axis=1) & np.any(head < rest, axis=1)
+        remaining = rest[~dominated]
+        indices = indices[1:][~dominated]
+    return mask
+
+
+def nondominated_sort(objectives):
+    """Rank of every point, 0 for the Pareto front, 1 for the front that
+    remains once the first is removed, and so on"""
+    points = np.asarray(objectives, dtype=float)
+    ranks = np.full(len(points), -1, dtype=int)
+    remaining = np.arange(len(points))
+    rank = 0
+    while len(remaining):
+        front = nondominated_mask(points[remaining])
+        ranks[remaining[front]] = rank
+        remaining = remaining[~front]
+        rank += 1
+    return ranks
+
+
+def epsilon_boxes(objectives, epsilons):
+    """Index of the epsilon box of every point and the distance of the point
+    to the corner of its box"""
+    points = np.asarray(objectives, dtype=float)
+    epsilons = np.asarray(epsilons, dtype=float)
+    boxes = np.floor(points / epsilons)
+    distances = np.sqrt(np.sum((points - boxes * epsilons) ** 2, axis=1))
+    return boxes, distances
+
+
+def epsilon_nondominated_mask(objectives, epsilons):
+    """Mask of the points kept by an epsilon box archive
+
+    Parameters
+    ----------
+    objectives : 2d array
+                 minimized objective values, one row per point
+    epsilons : list of float
+
+    Returns
+    -------
+    1d boolean array
+
+    A point is kept if its box is not dominated by the box of another point
+    and it is the point closest to the corner of its box; of equally close
+    points the first one is kept.
+
+    Raises
+    ------
+    EMAError if the number of epsilons does not match the number of
+    objectives
+    """
+    points = np.asarray(objectives, dtype=float).reshape(len(objectives), -1)
+    if points.shape[1] != len(epsilons):
+        raise EMAError("Number of epsilon values does not match number of outcomes")
+
+    mask = np.zeros(len(points), dtype=bool)
+    if len(points) == 0:
+        return mask
+
+    boxes, distances = epsilon_boxes(points, epsilons)
+    order = np.lexsort((np.arange(len(points)), distances) + tuple(boxes.T[::-1]))
+    sorted_boxes = boxes[order]
+    first = np.ones(len(points), dtype=bool)
+    first[1:] = np.any(sorted_boxes[1:] != sorted_boxes[:-1], axis=1)
+    candidates = order[first]
+
+    mask[candidates[nondominated_mask(boxes[candidates])]] = True
+    return mask
+
+
+class EpsilonArchive:
+    """Epsilon box archive that accepts batches of points
+
+    Parameters
+    ----------
+    epsilons : list of float
+
+    The archive keeps the objective values of its members and, for every
+    member, the position of the point in the sequence of all points that
+    were added, so the members can be looked up in the original data.
+    """
+
+    def __init__(self, epsilons):
+        self.epsilons = list(epsilons)
+        self.objectives = np.empty((0, len(self.epsilons)))
+        self.positions = np.empty(0, dtype=np.int64)
+        self.n_added = 0
+        self.improvements = 0
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, objectives):
+        """Add a batch of minimized objective values
+
+        Returns
+        -------
+        1d boolean array
+            which of the new points are members of the archive afterwards
+        """
+        objectives = np.asarray(objectives, dtype=float).reshape(-1, len(self.epsilons))
+        positions = np.arange(self.n_added, self.n_added + len(objectives))
+        self.n_added += len(objectives)
+
+        # the current members come first, so they win ties within a box
+        merged = np.vstack([self.objectives, objectives])
+        mask = epsilon_nondominated_mask(merged, self.epsilons)
+        accepted = mask[len(self.objectives) :]
+
+        self.objectives = merged[mask]
+        self.positions = np.concatenate([self.positions, positions])[mask]
+        self.improvements += int(accepted.sum())
+        return accepted
+
+
+def epsilon_nondominated(results, epsilons, problem):
+    """Merge results and keep the epsilon non-dominated rows
+
+    Parameters
+    ----------
+    results : list of DataFrames
+    epsilons : list of float
+    problem : PlatypusProblem instance
+
+    Returns
+    -------
+    DataFrame
+        the selected rows, with all columns of the results
+
+    Same purpose as epsilon_nondominated of the workbench, which this
+    replaces in the project. The results are added to an EpsilonArchive one
+    DataFrame at a time.
+    """
+    if len(epsilons) != len(problem.outcome_names):
+        raise EMAError("Number of epsilon values does not match number of outcomes")
+
+    archive = EpsilonArchive(epsilons)
+    for result in results:
+        archive.add(minimized(result[problem.outcome_names], problem.directions))
+
+    merged = pd.concat(results, ignore_index=True)
+    selected = merged.iloc[np.sort(archive.positions)].reset_index(drop=True)
+    _logger.info(f"{len(selected)} of {len(merged)} solutions are epsilon non-dominated")
+    return selected
@@ -0,0 +1,330 @@
+"""
+Lazy, column oriented access to saved experiment results.
+
+``load_results`` decompresses a tar.gz archive and parses every CSV column each
+time a notebook starts, even when a PRIM run only needs a few uncertainties and
+a single outcome. ResultsCache converts an archive (or a results CSV such as
+dike_model_combined_results.csv) once into a directory with one .npy file per
+column. Columns are then memory-mapped and only the requested ones are read.
+
+The rows in the cache are grouped by policy, and the index stores the row range
+of every policy, so selecting a single policy is a slice instead of a scan.
+The source row of every cached row is stored as well, so loads that are not
+restricted to a policy return the rows in the order of load_results.
+Further row filters are evaluated on the memory-mapped filter columns in chunks
+before any of the requested columns is gathered.
+"""
+import json
+import operator
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from ema_workbench import load_results
+
+CACHE_VERSION = 2
+ROW_FILE = "_source_rows.npy"
+SCAN_CHUNK = 1_000_000
+
+_operators = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+
+def _column_filename(name):
+    """Column names contain spaces and dots, keep file names safe"""
+    safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+    return f"{safe}.npy"
+
+
+def _source_signature(file_name):
+    stat = os.stat(file_name)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+class ResultsCache:
+    """Columnar cache of a results archive
+
+    Parameters
+    ----------
+    file_name : str
+                tar.gz archive written by save_results, or a CSV file
+    cache_dir : str, optional
+                defaults to the archive name with a .cache suffix
+    group_by : str, optional
+               column used to group the rows, by default 'policy' for
+               archives and 'policy_name' for CSV files when present
+
+    The cache is built on first use and rebuilt automatically when the source
+    file changes.
+    """
+
+    def __init__(self, file_name, cache_dir=None, group_by=None):
+        self.file_name = os.path.abspath(file_name)
+        if cache_dir is None:
+            cache_dir = f"{self.file_name}.cache"
+        self.cache_dir = cache_dir
+        self.group_by = group_by
+
+        if not self._is_valid():
+            self.build()
+
+        with open(os.path.join(self.cache_dir, "index.json")) as fh:
+            self.index = json.load(fh)
+
+    @property
+    def columns(self):
+        return list(self.index["columns"])
+
+    @property
+    def uncertainties_and_levers(self):
+        return [k for k, v in self.index["columns"].items() if v["kind"] == "experiment"]
+
+    @property
+    def outcome_names(self):
+        return [k for k, v in self.index["columns"].items() if v["kind"] == "outcome"]
+
+    @property
+    def groups(self):
+        return list(self.index["groups"])
+
+    def __len__(self):
+        return self.index["n_rows"]
+
+    def _is_valid(self):
+        index_file = os.path.join(self.cache_dir, "index.json")
+        if not os.path.exists(index_file):
+            return False
+        with open(index_file) as fh:
+            index = json.load(fh)
+        return (
+            index.get("version") == CACHE_VERSION
+            and index.get("source") == _source_signature(self.file_name)
+        )
+
+    def _read_source(self):
+        if self.file_name.endswith(".csv"):
+            experiments = pd.read_csv(self.file_name)
+            return experiments, {}
+        return load_results(self.file_name)
+
+    def build(self):
+        """Convert the source file into the columnar cache"""
+        experiments, outcomes = self._read_source()
+
+        group_by = self.group_by
+        if group_by is None:
+            group_by = next(
+                (c for c in ("policy", "policy_name") if c in experiments.columns), None
+            )
+
+        # group the rows per policy, keeping the original order within a group
+        if group_by is not None:
+            keys = experiments[group_by].astype(str)
+            order = np.argsort(pd.Categorical(keys).codes, kind="stable")
+        else:
+            order = np.arange(len(experiments))
+
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+        os.makedirs(self.cache_dir)
+
+        np.save(os.path.join(self.cache_dir, ROW_FILE), order)
+
+        columns = {}
+        for kind, data in (("experiment", experiments), ("outcome", outcomes)):
+            for name in data.keys():
+                values = data[name]
+                entry = {"kind": kind, "file": _column_filename(name)}
+
+                if isinstance(values, pd.Series) and not pd.api.types.is_numeric_dtype(
+                    values.dtype
+                ):
+                    categorical = pd.Categorical(values)
+                    entry["categories"] = categorical.categories.tolist()
+                    values = categorical.codes
+
+                values = np.ascontiguousarray(np.asarray(values)[order])
+                entry["dtype"] = values.dtype.str
+                entry["shape"] = list(values.shape[1:])
+                np.save(os.path.join(self.cache_dir, entry["file"]), values)
+                columns[name] = entry
+
+        groups = {}
+        if group_by is not None:
+            sorted_keys = experiments[group_by].astype(str).values[order]
+            names, starts = np.unique(sorted_keys, return_index=True)
+            ends = np.append(starts[1:], len(sorted_keys))
+            order_of_appearance = np.argsort(starts)
+            for i in order_of_appearance:
+                groups[names[i]] = [int(starts[i]), int(ends[i])]
+
+        index = {
+            "version": CACHE_VERSION,
+            "source": _source_signature(self.file_name),
+            "n_rows": len(experiments),
+            "group_by": group_by,
+            "groups": groups,
+            "in_source_order": bool(np.all(order == np.arange(len(order)))),
+            "columns": columns,
+        }
+        with open(os.path.join(self.cache_dir, "index.json"), "w") as fh:
+            json.dump(index, fh, indent=1)
+
+    def column(self, name):
+        """Return the memory-mapped raw values of a column
+
+        Categorical columns are returned as integer codes, see decode.
+        """
+        try:
+            entry = self.index["columns"][name]
+        except KeyError:
+            raise KeyError(f"unknown column {name}, available: {self.columns}")
+        return np.load(os.path.join(self.cache_dir, entry["file"]), mmap_mode="r")
+
+    def source_rows(self):
+        """Return the memory-mapped row number in the source file of every
+        cached row"""
+        return np.load(os.path.join(self.cache_dir, ROW_FILE), mmap_mode="r")
+
+    def decode(self, name, values):
+        """Turn stored values back into the type of the original column"""
+        entry = self.index["columns"][name]
+        if "categories" in entry:
+            return pd.Categorical.from_codes(values, entry["categories"])
+        return values
+
+    def _row_range(self, policy):
+        if policy is None:
+            return 0, len(self)
+        try:
+            return tuple(self.index["groups"][str(policy)])
+        except KeyError:
+            raise KeyError(f"unknown policy {policy}, available: {self.groups}")
+
+    def _condition_mask(self, condition, start, stop):
+        name, op, value = condition
+        entry = self.index["columns"][name]
+        data = self.column(name)
+
+        # categorical columns are stored as codes, translate the value as well
+        if "categories" in entry:
+            codes = {c: i for i, c in enumerate(entry["categories"])}
+            if op == "in":
+                value = [codes[v] for v in value if v in codes]
+            else:
+                value = codes.get(value, -1)
+
+        mask = np.empty(stop - start, dtype=bool)
+        for chunk_start in range(start, stop, SCAN_CHUNK):
+            chunk_stop = min(chunk_start + SCAN_CHUNK, stop)
+            chunk = data[chunk_start:chunk_stop]
+            if op == "in":
+                result = np.isin(chunk, value)
+            else:
+                result = _operators[op](chunk, value)
+            mask[chunk_start - start : chunk_stop - start] = result
+        return mask
+
+    def row_mask(self, where=None, policy=None):
+        """Evaluate the row filters
+
+        Parameters
+        ----------
+        where : list of (column, operator, value) tuples, optional
+                operator is one of >, >=, <, <=, ==, != or 'in'; all
+                conditions have to hold
+        policy : str, optional
+
+        Returns
+        -------
+        (start, stop) row range and boolean mask within that range, or None
+        if no further filtering is needed
+        """
+        start, stop = self._row_range(policy)
+        if not where:
+            return (start, stop), None
+
+        mask = np.ones(stop - start, dtype=bool)
+        for condition in where:
+            mask &= self._condition_mask(condition, start, stop)
+        return (start, stop), mask
+
+    def load(self, columns=None, where=None, policy=None):
+        """Load a subset of columns and rows
+
+        Parameters
+        ----------
+        columns : list of str, optional
+                  experiment and outcome columns to load, all by default
+        where : list of (column, operator, value) tuples, optional
+        policy : str, optional
+                 only load the rows of this policy
+
+        Returns
+        -------
+        tuple
+            experiments DataFrame and outcomes dict, like load_results, with
+            the rows in the order of the source file
+        """
+        if columns is None:
+            columns = self.columns
+
+        (start, stop), mask = self.row_mask(where, policy)
+
+        # the rows of a single policy are already in source order
+        order = None
+        if policy is None and not self.index["in_source_order"]:
+            rows = self.source_rows()[start:stop]
+            if mask is not None:
+                rows = rows[mask]
+            order = np.argsort(rows, kind="stable")
+
+        experiments = {}
+        outcomes = {}
+        for name in columns:
+            # without a mask, outcomes stay memory-mapped until they are used
+            values = self.column(name)[start:stop]
+            if mask is not None:
+                values = values[mask]
+            if order is not None:
+                values = values[order]
+            values = self.decode(name, values)
+
+            if self.index["columns"][name]["kind"] == "outcome":
+                outcomes[name] = values
+            else:
+                experiments[name] = values
+
+        return pd.DataFrame(experiments), outcomes
+
+
+def load_results_lazy(file_name, columns=None, where=None, policy=None, cache_dir=None):
+    """Drop-in replacement for load_results backed by a ResultsCache
+
+    Parameters
+    ----------
+    file_name : str
+    columns : list of str, optional
+              only load these experiment and outcome columns
+    where : list of (column, operator, value) tuples, optional
+            row filters evaluated before the columns are gathered, for
+            example [('Expected Annual Damage', '>', 1e8)]
+    policy : str, optional
+             only load the rows of this policy
+    cache_dir : str, optional
+
+    Returns
+    -------
+    tuple
+        experiments DataFrame and outcomes dict
+    """
+    cache = ResultsCache(file_name, cache_dir=cache_dir)
+    return cache.load(columns=columns, where=where, policy=policy)
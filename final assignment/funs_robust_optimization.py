@@ -0,0 +1,209 @@
+"""
+Multi-scenario robust optimization.
+
+The direct search optimized the policies separately for each of the five
+scenarios from the open exploration, after which all resulting policies were
+re-evaluated on all five scenarios to find the robust ones. robust_model
+turns a problem formulation into one whose objectives are robustness
+statistics over a fixed set of scenarios, so a single search finds the
+robust policies directly.
+
+Every candidate policy is a single experiment of the robust model. Its
+function, RobustObjectives, runs the DikeNetwork for all scenarios in one
+call of DikeNetwork.run_scenarios: the setup that depends on the levers is
+done once per candidate and the flood events of all scenarios are routed
+together. The outcomes of the original problem formulation are computed per
+scenario. The investment costs only depend on the levers and are the same in
+every scenario, so they stay single objectives. The other outcomes are
+summarized by the statistics:
+
+* mean, the mean over the scenarios,
+* max, the worst value over the scenarios,
+* max regret, the largest difference over the scenarios with the best value
+  known for a scenario, e.g. the best of the stored re-evaluation results
+  (see best_from_results); candidates better than the best known value get
+  a negative regret. When the best known value is zero in every scenario,
+  as for the damage in the stored re-evaluation, the max regret is the max,
+* p<q>, e.g. p90, the q-th percentile on the bad side of the distribution.
+"""
+import numpy as np
+import pandas as pd
+
+from ema_workbench import Model, ScalarOutcome
+from ema_workbench.util import EMAError, ema_logging
+
+from funs_cost_screening import lever_only_outcomes
+from funs_robustness import best_per_scenario, load_outcome_cube, max_regret
+
+_logger = ema_logging.get_module_logger(__name__)
+
+
+def _maximize(outcomes):
+    return [outcome.kind == ScalarOutcome.MAXIMIZE for outcome in outcomes]
+
+
+def _statistic(name, values, maximize, best):
+    """A robustness statistic of every outcome, values has one row per
+    scenario"""
+    signs = np.where(maximize, -1.0, 1.0)
+    if name == "mean":
+        return values.mean(axis=0)
+    if name == "max":
+        return (values * signs).max(axis=0) * signs
+    if name == "max regret":
+        return max_regret(values[np.newaxis], maximize, best)[0]
+    if name.startswith("p") and name[1:].replace(".", "", 1).isdigit():
+        return np.percentile(values * signs, float(name[1:]), axis=0) * signs
+    raise EMAError(f"unknown robustness statistic {name}")
+
+
+def best_from_results(file_name, outcome_names, scenario_column="scenario"):
+    """Best value of every outcome in every scenario of stored re-evaluation
+    results, as reference for the max regret
+
+    Returns
+    -------
+    DataFrame
+        one row per scenario label, one column per outcome
+    """
+    cube, _, scenarios = load_outcome_cube(file_name, outcome_names, scenario_column=scenario_column)
+    return pd.DataFrame(best_per_scenario(cube), index=scenarios, columns=outcome_names)
+
+
+class RobustObjectives:
+    """Model function that evaluates a policy on a set of scenarios
+
+    Parameters
+    ----------
+    network : DikeNetwork instance
+    scenarios : list of dict
+                the uncertainties of every scenario
+    outcomes : list of ScalarOutcome instances
+               the outcomes of a problem formulation, computed per scenario
+               from the results of the DikeNetwork
+    statistics : list of str, optional
+    best : 2d array, optional
+           best value per scenario and outcome, needed for the max regret
+    timestep : int or str, optional
+               see DikeNetwork
+    lever_only : collection of str, optional
+                 names of the outcomes that do not depend on the scenario,
+                 these are returned once instead of per statistic
+    """
+
+    def __init__(
+        self, network, scenarios, outcomes, statistics=("mean", "max"), best=None, timestep=1, lever_only=()
+    ):
+        if "max regret" in statistics:
+            if best is None:
+                raise EMAError("the max regret needs the best value of every outcome per scenario")
+            best = np.asarray(best, dtype=float)
+            if best.shape != (len(scenarios), len(outcomes)):
+                raise EMAError(f"best has shape {best.shape}, expected {(len(scenarios), len(outcomes))}")
+        self.network = network
+        self.scenarios = list(scenarios)
+        self.outcomes = list(outcomes)
+        self.statistics = list(statistics)
+        self.best = best
+        self.timestep = timestep
+        self.lever_only = set(lever_only)
+
+        if "max regret" in self.statistics:
+            for outcome, column in zip(self.outcomes, best.T):
+                if outcome.name not in self.lever_only and np.all(column == 0):
+                    _logger.warning(f"the best {outcome.name} is zero in every scenario, its max regret is its max")
+
+    @property
+    def outcome_names(self):
+        return [
+            name
+            for outcome in self.outcomes
+            for name in (
+                [outcome.name]
+                if outcome.name in self.lever_only
+                else [f"{outcome.name} {statistic}" for statistic in self.statistics]
+            )
+        ]
+
+    @property
+    def run_stats(self):
+        return self.network.run_stats
+
+    def outcome_values(self, timestep=None, **levers):
+        """The outcomes of every scenario under the levers, one row per
+        scenario"""
+        results = self.network.run_scenarios(
+            self.scenarios, self.timestep if timestep is None else timestep, **levers
+        )
+        return np.array(
+            [
+                [outcome.process([result[name] for name in outcome.variable_name]) for outcome in self.outcomes]
+                for result in results
+            ],
+            dtype=float,
+        )
+
+    def __call__(self, timestep=None, **levers):
+        values = self.outcome_values(timestep, **levers)
+        maximize = _maximize(self.outcomes)
+        statistics = {name: _statistic(name, values, maximize, self.best) for name in self.statistics}
+        results = {}
+        for i, outcome in enumerate(self.outcomes):
+            if outcome.name in self.lever_only:
+                results[outcome.name] = values[0, i]
+                continue
+            for name in self.statistics:
+                results[f"{outcome.name} {name}"] = statistics[name][i]
+        return results
+
+
+def robust_model(model, scenarios, statistics=("mean", "max"), best=None):
+    """Model with the robustness of the outcomes of model as objectives
+
+    Parameters
+    ----------
+    model : Model instance
+            a problem formulation with scalar outcomes, whose function is a
+            DikeNetwork
+    scenarios : DataFrame or list of Scenario instances
+                the scenarios, values of uncertainties that are not in the
+                model are ignored
+    statistics : list of str, optional
+    best : DataFrame or 2d array, optional
+           see RobustObjectives
+
+    Returns
+    -------
+    Model instance
+        with the levers and constants of model, no uncertainties, an outcome
+        per scenario dependent outcome of model and statistic, and the
+        outcomes that only depend on the levers once, all with the same
+        direction
+    """
+    names = [uncertainty.name for uncertainty in model.uncertainties]
+    if isinstance(scenarios, pd.DataFrame):
+        scenarios = scenarios.to_dict("records")
+    scenarios = [{name: scenario[name] for name in names if name in scenario} for scenario in scenarios]
+
+    lever_only = [outcome.name for outcome in lever_only_outcomes(model)]
+    function = RobustObjectives(
+        model.function,
+        scenarios,
+        model.outcomes,
+        statistics,
+        None if best is None else np.asarray(best),
+        lever_only=lever_only,
+    )
+    robust = Model(f"{model.name}robust", function=function)
+    robust.levers = list(model.levers)
+    robust.constants = list(model.constants)
+    outcomes = []
+    for outcome in model.outcomes:
+        if outcome.name in lever_only:
+            outcomes.append(ScalarOutcome(outcome.name, kind=outcome.kind))
+        else:
+            outcomes.extend(
+                ScalarOutcome(f"{outcome.name} {statistic}", kind=outcome.kind) for statistic in statistics
+            )
+    robust.outcomes = outcomes
+    return robust
@@ -0,0 +1,310 @@
+"""
+Vectorized robustness metrics over policies and scenarios.
+
+The results of re-evaluating candidate policies over a set of scenarios are
+arranged in a cube with one axis for the policies, one for the scenarios and
+one for the outcomes (see outcome_cube and load_outcome_cube). All metrics
+are computed on the cube at once, for every policy:
+
+* maximum regret, the largest difference over the scenarios between the
+  outcome of a policy and the best outcome of any policy in that scenario,
+* satisficing, the fraction of scenarios in which an outcome meets its
+  threshold; by default the threshold of an outcome is a percentile of all
+  its values in the cube,
+* the domain criterion, the fraction of scenarios in which all outcomes meet
+  their thresholds at the same time,
+* the signal-to-noise ratio, mean times standard deviation over the
+  scenarios for minimized outcomes and mean over standard deviation for
+  maximized outcomes,
+* a percentile of the outcome over the scenarios, e.g. the 90th percentile
+  as a less extreme alternative to the worst case.
+
+robustness_table combines these in a DataFrame and rank_policies ranks the
+policies on them. For results that do not fit in memory, streaming_robustness
+computes the same table from chunks of policies.
+"""
+import numpy as np
+import pandas as pd
+
+from ema_workbench.util import EMAError, ema_logging
+
+from funs_results import ResultsCache
+
+_logger = ema_logging.get_module_logger(__name__)
+
+
+def outcome_cube(
+    data, outcome_names, policy_column="policy", scenario_column="scenario", scenarios=None
+):
+    """Arrange results in a policies x scenarios x outcomes array
+
+    Parameters
+    ----------
+    data : DataFrame
+           one row per experiment, with the policy and scenario columns and
+           the outcomes
+    outcome_names : list of str
+    policy_column : str, optional
+    scenario_column : str, optional
+                      if None, every policy has a single row
+    scenarios : list, optional
+                labels of the scenario axis, by default the scenarios in
+                order of first appearance
+
+    Returns
+    -------
+    tuple
+        the cube, the policy labels and the scenario labels; policies are in
+        order of first appearance and combinations without a result are NaN
+
+    Raises
+    ------
+    EMAError if data holds a scenario that is not in scenarios
+    """
+    policy_codes, policies = pd.factorize(np.asarray(data[policy_column]))
+    if scenario_column is None:
+        scenario_codes, scenarios = np.zeros(len(data), dtype=int), [None]
+    elif scenarios is None:
+        scenario_codes, scenarios = pd.factorize(np.asarray(data[scenario_column]))
+    else:
+        scenario_codes = pd.Index(scenarios).get_indexer(np.asarray(data[scenario_column]))
+        if np.any(scenario_codes < 0):
+            raise EMAError("the results hold scenarios that are not in scenarios")
+
+    cube = np.full((len(policies), len(scenarios), len(outcome_names)), np.nan)
+    cube[policy_codes, scenario_codes] = data[list(outcome_names)].to_numpy(dtype=float)
+    return cube, list(policies), list(scenarios)
+
+
+def load_outcome_cube(file_name, outcome_names, policy_column="policy", scenario_column="scenario"):
+    """outcome_cube of a results archive or CSV file, read through a
+    ResultsCache so only the needed columns are loaded"""
+    experiments, outcomes = ResultsCache(file_name).load(
+        columns=[policy_column, scenario_column] + list(outcome_names)
+    )
+    return outcome_cube(experiments.assign(**outcomes), outcome_names, policy_column, scenario_column)
+
+
+def _signs(n_outcomes, maximize):
+    """+1 for minimized and -1 for maximized outcomes"""
+    if maximize is None:
+        return np.ones(n_outcomes)
+    return np.where(np.asarray(maximize, dtype=bool), -1.0, 1.0)
+
+
+def best_per_scenario(cube, maximize=None):
+    """Best value of every outcome in every scenario over all policies"""
+    signs = _signs(cube.shape[2], maximize)
+    return np.nanmin(cube * signs, axis=0) * signs
+
+
+def max_regret(cube, maximize=None, best=None):
+    """Maximum regret of every policy and outcome, shape (policies, outcomes)
+
+    Parameters
+    ----------
+    cube : 3d array
+    maximize : list of bool, optional
+    best : 2d array, optional
+           best value per scenario and outcome, computed from the cube if not
+           given; needed when the cube only holds part of the policies
+    """
+    signs = _signs(cube.shape[2], maximize)
+    if best is None:
+        best = best_per_scenario(cube, maximize)
+    regret = (cube - best[np.newaxis]) * signs
+    return np.nanmax(regret, axis=1)
+
+
+def percentile_thresholds(cube, percentile=50):
+    """Threshold of every outcome as a percentile of all its values"""
+    return np.nanpercentile(cube.reshape(-1, cube.shape[2]), percentile, axis=0)
+
+
+def _meets(cube, thresholds, maximize):
+    signs = _signs(cube.shape[2], maximize)
+    return cube * signs <= np.asarray(thresholds, dtype=float) * signs
+
+
+def satisficing(cube, thresholds, maximize=None):
+    """Fraction of the scenarios in which every outcome meets its threshold,
+    shape (policies, outcomes)"""
+    valid = ~np.isnan(cube)
+    return (_meets(cube, thresholds, maximize) & valid).sum(axis=1) / valid.sum(axis=1)
+
+
+def domain_criterion(cube, thresholds, maximize=None):
+    """Fraction of the scenarios in which all outcomes meet their threshold
+    at the same time, shape (policies,)"""
+    valid = ~np.isnan(cube).any(axis=2)
+    met = _meets(cube, thresholds, maximize).all(axis=2) & valid
+    return met.sum(axis=1) / valid.sum(axis=1)
+
+
+def signal_to_noise(cube, maximize=None):
+    """Mean times standard deviation for minimized outcomes, mean over
+    standard deviation for maximized outcomes, shape (policies, outcomes)"""
+    mean = np.nanmean(cube, axis=1)
+    std = np.nanstd(cube, axis=1)
+    maximized = _signs(cube.shape[2], maximize) < 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(maximized, mean / std, mean * std)
+
+
+def robustness_table(
+    cube,
+    policies,
+    outcome_names,
+    maximize=None,
+    thresholds=None,
+    threshold_percentile=50,
+    percentile=90,
+    best=None,
+):
+    """All robustness metrics of every policy
+
+    Parameters
+    ----------
+    cube : 3d array
+           policies x scenarios x outcomes
+    policies : list of str
+    outcome_names : list of str
+    maximize : list of bool, optional
+               by default all outcomes are minimized
+    thresholds : list of float, optional
+                 satisficing thresholds, by default the threshold_percentile
+                 of all values of an outcome in the cube
+    threshold_percentile : float, optional
+    percentile : float, optional
+                 percentile of every outcome over the scenarios
+    best : 2d array, optional
+           see max_regret
+
+    Returns
+    -------
+    DataFrame
+        one row per policy
+    """
+    if cube.shape[2] != len(outcome_names):
+        raise EMAError("the cube does not match the number of outcomes")
+    if thresholds is None:
+        thresholds = percentile_thresholds(cube, threshold_percentile)
+
+    signs = _signs(cube.shape[2], maximize)
+    metrics = {
+        "max regret": max_regret(cube, maximize, best),
+        "satisficing": satisficing(cube, thresholds, maximize),
+        "signal to noise": signal_to_noise(cube, maximize),
+        # the percentile on the bad side of the distribution of an outcome
+        f"p{percentile:g}": np.nanpercentile(cube * signs, percentile, axis=1) * signs,
+    }
+
+    table = {}
+    for i, name in enumerate(outcome_names):
+        for metric, values in metrics.items():
+            table[f"{name} {metric}"] = values[:, i]
+    table["domain criterion"] = domain_criterion(cube, thresholds, maximize)
+    return pd.DataFrame(table, index=pd.Index(policies, name="policy"))
+
+
+def rank_policies(table, outcome_names, maximize=None):
+    """Rank the policies on every robustness metric and on the mean rank
+
+    Lower regret, higher satisficing and domain criterion, and a better
+    signal-to-noise ratio and percentile get a lower rank. The table is
+    returned sorted on the mean rank.
+    """
+    signs = _signs(len(outcome_names), maximize)
+    ranks = {}
+    for name, sign in zip(outcome_names, signs):
+        ranks[f"{name} max regret"] = table[f"{name} max regret"].rank()
+        ranks[f"{name} satisficing"] = table[f"{name} satisficing"].rank(ascending=False)
+        ranks[f"{name} signal to noise"] = table[f"{name} signal to noise"].rank(ascending=sign > 0)
+        for column in table.columns:
+            if column.startswith(f"{name} p"):
+                ranks[column] = table[column].rank(ascending=sign > 0)
+    ranks["domain criterion"] = table["domain criterion"].rank(ascending=False)
+
+    ranked = table.assign(**{"mean rank": pd.DataFrame(ranks).mean(axis=1)})
+    return ranked.sort_values("mean rank")
+
+
+def streaming_robustness(chunks, outcome_names, thresholds, maximize=None, percentile=90):
+    """robustness_table from chunks of policies
+
+    Parameters
+    ----------
+    chunks : callable
+             returns an iterator over (policies, cube) tuples, where every
+             cube holds all scenarios for a part of the policies, in the same
+             scenario order; it is called twice
+    outcome_names : list of str
+    thresholds : list of float
+                 satisficing thresholds, percentile thresholds would need all
+                 values in memory
+    maximize : list of bool, optional
+    percentile : float, optional
+
+    Returns
+    -------
+    DataFrame
+
+    The first pass collects the best value per scenario for the regret, the
+    second pass computes all metrics chunk by chunk, so only a single chunk
+    is held in memory.
+    """
+    if thresholds is None:
+        raise EMAError("streaming robustness needs explicit satisficing thresholds")
+
+    signs = _signs(len(outcome_names), maximize)
+    best = None
+    for _, cube in chunks():
+        chunk_best = np.nanmin(cube * signs, axis=0)
+        best = chunk_best if best is None else np.fmin(best, chunk_best)
+    if best is None:
+        raise EMAError("no results in the chunks")
+    best = best * signs
+
+    tables = [
+        robustness_table(
+            cube,
+            policies,
+            outcome_names,
+            maximize=maximize,
+            thresholds=thresholds,
+            percentile=percentile,
+            best=best,
+        )
+        for policies, cube in chunks()
+    ]
+    table = pd.concat(tables)
+    _logger.info(f"robustness of {len(table)} policies computed in {len(tables)} chunks")
+    return table
+
+
+def iter_cache_chunks(
+    file_name, outcome_names, policies_per_chunk=100, policy_column="policy", scenario_column="scenario"
+):
+    """Chunks of policies of a results file for streaming_robustness
+
+    Returns a callable, as streaming_robustness iterates twice. The rows of
+    a chunk are sliced from the memory-mapped columns of a ResultsCache
+    grouped on policy_column, and every chunk has the same scenario axis.
+    """
+    cache = ResultsCache(file_name, group_by=policy_column)
+    ranges = [cache.index["groups"][group] for group in cache.groups]
+    columns = [policy_column, scenario_column] + list(outcome_names)
+    scenarios = list(pd.unique(np.asarray(cache.load(columns=[scenario_column])[0][scenario_column])))
+
+    def chunks():
+        for start in range(0, len(ranges), policies_per_chunk):
+            first, last = ranges[start][0], ranges[min(start + policies_per_chunk, len(ranges)) - 1][1]
+            data = pd.DataFrame(
+                {name: cache.decode(name, cache.column(name)[first:last]) for name in columns}
+            )
+            cube, policies, _ = outcome_cube(
+                data, outcome_names, policy_column, scenario_column, scenarios=scenarios
+            )
+            yield policies, cube
+
+    return chunks
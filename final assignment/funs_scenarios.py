@@ -0,0 +1,235 @@
+"""
+Representative scenario selection over large experiment sets.
+
+The open exploration standardizes the experiments of interest and clusters
+them with KMeans in memory, then takes the experiment closest to every
+centroid as a scenario for the directed search. select_scenarios does the
+same for results of any size. The experiment and outcome columns are
+streamed from the memory-mapped columns of a ResultsCache, in chunks that
+fit within a memory budget:
+
+1. one pass collects the mean and standard deviation of every column, for
+   the standardization,
+2. MiniBatchKMeans is fitted with partial_fit over the chunks, with more
+   clusters than the number of scenarios asked for,
+3. one pass finds the experiment closest to every centroid and the share of
+   experiments in every cluster,
+4. of these candidates the scenarios are picked one by one, each time the
+   candidate farthest in outcome space from the ones already picked,
+   starting from the candidate of the largest cluster; clusters that hold
+   less than min_share of the experiments are left out,
+5. a last pass assigns every experiment to the closest picked scenario to
+   report how much of the experiment set each scenario represents.
+"""
+import numpy as np
+import pandas as pd
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.metrics.pairwise import euclidean_distances
+
+from ema_workbench.util import EMAError, ema_logging
+
+from funs_results import ResultsCache, _operators
+
+_logger = ema_logging.get_module_logger(__name__)
+
+# bookkeeping columns of the experiments, never used as features
+_bookkeeping = ["scenario", "policy", "model"]
+
+
+def percentile_conditions(cache, conditions):
+    """Turn (column, operator, percentile) tuples into row filters of the
+    cache, with the percentile over all rows as value"""
+    where = []
+    for name, op, percentile in conditions:
+        if op not in _operators:
+            raise EMAError(f"unknown operator {op}")
+        where.append((name, op, float(np.percentile(cache.column(name), percentile))))
+    return where
+
+
+class _Stream:
+    """Chunks of selected rows of some columns of a ResultsCache, as float
+    arrays, categorical columns as their codes"""
+
+    def __init__(self, cache, columns, where=None, policy=None, chunk_size=100_000):
+        self.columns = [cache.column(name) for name in columns]
+        (self.start, self.stop), self.mask = cache.row_mask(where, policy)
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        for start in range(self.start, self.stop, self.chunk_size):
+            stop = min(start + self.chunk_size, self.stop)
+            rows = np.arange(start, stop)
+            if self.mask is not None:
+                keep = self.mask[start - self.start : stop - self.start]
+                rows = rows[keep]
+            if not len(rows):
+                continue
+            block = np.empty((len(rows), len(self.columns)))
+            for i, column in enumerate(self.columns):
+                values = column[start:stop]
+                block[:, i] = values if self.mask is None else values[keep]
+            yield rows, block
+
+
+def _moments(stream):
+    """Number of rows, mean and standard deviation of every column"""
+    n = 0
+    total = None
+    squares = None
+    for _, block in stream:
+        n += len(block)
+        total = block.sum(axis=0) if total is None else total + block.sum(axis=0)
+        squares = (block**2).sum(axis=0) if squares is None else squares + (block**2).sum(axis=0)
+    if not n:
+        raise EMAError("no experiments meet the conditions")
+    mean = total / n
+    std = np.sqrt(np.maximum(squares / n - mean**2, 0))
+    return n, mean, np.where(std > 0, std, 1.0)
+
+
+def select_scenarios(
+    file_name,
+    n_scenarios=5,
+    columns=None,
+    outcome_columns=None,
+    where=None,
+    policy=None,
+    oversample=4,
+    min_share=0.01,
+    memory_budget=256 * 2**20,
+    n_passes=2,
+    seed=None,
+):
+    """Pick representative, diverse scenarios from a results file
+
+    Parameters
+    ----------
+    file_name : str
+                results archive or CSV file, read through a ResultsCache
+    n_scenarios : int, optional
+    columns : list of str, optional
+              columns to cluster on, by default all experiment columns
+              except scenario, policy and model
+    outcome_columns : list of str, optional
+                      columns for the diversity criterion, by default the
+                      outcomes of the cache; without outcomes the clustering
+                      columns are used
+    where : list of (column, operator, value) tuples, optional
+            only use the rows that meet these filters, see
+            percentile_conditions for filters on percentiles
+    policy : str, optional
+    oversample : int, optional
+                 number of clusters per scenario asked for
+    min_share : float, optional
+                smallest share of the experiments in a cluster for its
+                experiment to be picked
+    memory_budget : int, optional
+                    bytes for a chunk of rows
+    n_passes : int, optional
+               passes over the data for the mini-batch clustering
+    seed : int, optional
+
+    Returns
+    -------
+    tuple
+        DataFrame with the picked experiments, all their columns and the
+        share of the experiments they represent, and a dict with summary
+        statistics
+    """
+    cache = ResultsCache(file_name)
+    if columns is None:
+        columns = [c for c in cache.uncertainties_and_levers if c not in _bookkeeping]
+    if outcome_columns is None:
+        outcome_columns = cache.outcome_names or list(columns)
+
+    all_columns = list(dict.fromkeys(list(columns) + list(outcome_columns)))
+    chunk_size = max(1000, memory_budget // (8 * 4 * len(all_columns)))
+    stream = _Stream(cache, all_columns, where, policy, chunk_size)
+    features = [all_columns.index(c) for c in columns]
+    targets = [all_columns.index(c) for c in outcome_columns]
+
+    n_rows, mean, std = _moments(stream)
+    if n_rows < n_scenarios:
+        raise EMAError(f"only {n_rows} experiments to pick {n_scenarios} scenarios from")
+    n_clusters = min(oversample * n_scenarios, n_rows)
+    _logger.info(f"clustering {n_rows} experiments into {n_clusters} clusters, chunks of {chunk_size}")
+
+    def standardized(block, index):
+        return (block[:, index] - mean[index]) / std[index]
+
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=seed, n_init=3)
+    pending = None
+    for _ in range(n_passes):
+        for _, block in stream:
+            x = standardized(block, features)
+            # partial_fit needs at least as many rows as clusters
+            pending = x if pending is None else np.vstack([pending, x])
+            if len(pending) >= n_clusters:
+                kmeans.partial_fit(pending)
+                pending = None
+    if pending is not None:
+        kmeans.partial_fit(pending)
+
+    # the experiment closest to every centroid
+    best_distance = np.full(n_clusters, np.inf)
+    best_row = np.full(n_clusters, -1)
+    best_outcome = np.zeros((n_clusters, len(targets)))
+    sizes = np.zeros(n_clusters, dtype=np.int64)
+    for rows, block in stream:
+        distances = kmeans.transform(standardized(block, features))
+        labels = distances.argmin(axis=1)
+        sizes += np.bincount(labels, minlength=n_clusters)
+        closest = distances.argmin(axis=0)
+        improved = distances[closest, np.arange(n_clusters)] < best_distance
+        best_distance[improved] = distances[closest[improved], np.flatnonzero(improved)]
+        best_row[improved] = rows[closest[improved]]
+        best_outcome[improved] = standardized(block[closest[improved]], targets)
+
+    shares = sizes / n_rows
+    candidates = np.flatnonzero((shares >= min_share) & (best_row >= 0))
+    if len(candidates) < n_scenarios:
+        candidates = np.argsort(-shares)[:n_scenarios]
+
+    # farthest point selection in outcome space
+    picked = [candidates[np.argmax(shares[candidates])]]
+    min_distance = np.linalg.norm(best_outcome[candidates] - best_outcome[picked[0]], axis=1)
+    while len(picked) < n_scenarios:
+        next_index = candidates[np.argmax(min_distance)]
+        picked.append(next_index)
+        distance = np.linalg.norm(best_outcome[candidates] - best_outcome[next_index], axis=1)
+        min_distance = np.minimum(min_distance, distance)
+
+    # coverage of the picked scenarios
+    chosen_rows = best_row[picked]
+    chosen = np.column_stack([np.asarray(cache.column(name)[chosen_rows], dtype=float) for name in all_columns])
+    centers = standardized(chosen, features)
+    counts = np.zeros(n_scenarios, dtype=np.int64)
+    distance_sums = np.zeros(n_scenarios)
+    for _, block in stream:
+        distances = euclidean_distances(standardized(block, features), centers)
+        labels = distances.argmin(axis=1)
+        counts += np.bincount(labels, minlength=n_scenarios)
+        distance_sums += np.bincount(labels, weights=distances.min(axis=1), minlength=n_scenarios)
+
+    scenarios = pd.DataFrame(
+        {name: cache.decode(name, cache.column(name)[chosen_rows]) for name in cache.columns}
+    )
+    # the row in the results as load_results returns them
+    scenarios.insert(0, "row", np.asarray(cache.source_rows()[chosen_rows]))
+    scenarios["share"] = counts / n_rows
+    scenarios["mean distance"] = distance_sums / np.maximum(counts, 1)
+
+    outcome_distances = np.linalg.norm(
+        best_outcome[picked][:, np.newaxis] - best_outcome[picked][np.newaxis], axis=2
+    )
+    summary = {
+        "n_experiments": n_rows,
+        "n_clusters": n_clusters,
+        "n_candidates": len(candidates),
+        "min_outcome_distance": float(outcome_distances[np.triu_indices(n_scenarios, k=1)].min())
+        if n_scenarios > 1
+        else np.nan,
+        "mean_distance": float(distance_sums.sum() / n_rows),
+    }
+    return scenarios, summary
@@ -0,0 +1,346 @@
+"""
+Incremental Sobol analysis for streamed evaluation results.
+
+The sensitivity notebook judges convergence by running sobol.analyze of
+SALib again on ever longer prefixes of the Saltelli results, which repeats
+all earlier work for every prefix and can only start once all runs are
+done.
+
+IncrementalSobol keeps running sums of the terms of the SALib estimators
+instead. Every new block of Saltelli results (the A, AB, BA and B rows of a
+base sample) is added to the sums, and the first, second and total order
+indices follow from the sums at any time. The point estimates equal those
+of sobol.analyze on the same results, including its normalization of the
+output.
+
+The confidence intervals use a Poisson bootstrap: every base sample gets a
+random Poisson(1) weight in each replicate, so the replicates are updated
+with the same sums, all at once as a single matrix product, and never need
+the earlier results again.
+
+run_sobol evaluates a Saltelli design in batches of base samples, updates
+the estimators after every batch and stops once a SobolStop rule reports
+that the indices have stabilized.
+"""
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from ema_workbench.em_framework.salib_samplers import SobolSampler, get_SALib_problem
+from ema_workbench.em_framework.samplers import sample_uncertainties
+from ema_workbench.util import EMAError, ema_logging
+
+_logger = ema_logging.get_module_logger(__name__)
+
+
+class IncrementalSobol:
+    """Sobol indices of a single outcome, updated as results come in
+
+    Parameters
+    ----------
+    problem : dict
+              SALib problem, see get_SALib_problem
+    calc_second_order : bool, optional
+                        has to match the Saltelli design
+    num_resamples : int, optional
+                    number of bootstrap replicates
+    conf_level : float, optional
+    seed : int, optional
+           seed of the bootstrap weights
+
+    Results are passed to update in the order of the Saltelli design. They
+    do not have to arrive in whole base samples, an incomplete base sample
+    is kept until the rest of it arrives.
+    """
+
+    def __init__(self, problem, calc_second_order=True, num_resamples=100, conf_level=0.95, seed=None):
+        if not 0 < conf_level < 1:
+            raise EMAError("confidence level must be between 0 and 1")
+
+        self.names = list(problem["names"])
+        self.n_vars = problem["num_vars"]
+        self.calc_second_order = calc_second_order
+        self.num_resamples = num_resamples
+        self.z = norm.ppf(0.5 + conf_level / 2)
+        self.rng = np.random.default_rng(seed)
+
+        D = self.n_vars
+        self.step = 2 * D + 2 if calc_second_order else D + 2
+
+        # layout of the terms, see _terms
+        sizes = [("sum_y", 1), ("a", 1), ("b", 1), ("a2", 1), ("b2", 1), ("ab", 1)]
+        sizes += [("b_d", D), ("d", D), ("d2", D)]
+        if calc_second_order:
+            sizes += [("ba", D), ("ba_ab", D * D)]
+        self._slices = {}
+        start = 0
+        for name, size in sizes:
+            self._slices[name] = slice(start, start + size)
+            start += size
+
+        self.totals = np.zeros(start)
+        self.replicate_totals = np.zeros((num_resamples, start))
+        self.replicate_counts = np.zeros(num_resamples)
+        self.n_blocks = 0
+        self._pending = np.empty(0)
+        self.history = []
+
+    @property
+    def n_samples(self):
+        """Number of model results in the estimates"""
+        return self.n_blocks * self.step
+
+    def _terms(self, blocks):
+        """Terms of the estimators for every base sample, one row per block"""
+        D = self.n_vars
+        A = blocks[:, 0]
+        B = blocks[:, self.step - 1]
+        AB = blocks[:, 1 : D + 1]
+        d = AB - A[:, np.newaxis]
+
+        columns = [
+            blocks.sum(axis=1),
+            A,
+            B,
+            A**2,
+            B**2,
+            A * B,
+        ]
+        columns = [c[:, np.newaxis] for c in columns]
+        columns += [B[:, np.newaxis] * d, d, d**2]
+        if self.calc_second_order:
+            BA = blocks[:, D + 1 : 2 * D + 1]
+            columns += [BA, (BA[:, :, np.newaxis] * AB[:, np.newaxis, :]).reshape(len(blocks), -1)]
+        return np.hstack(columns)
+
+    def update(self, y):
+        """Add results in the order of the Saltelli design
+
+        Returns
+        -------
+        int
+            the number of base samples that were added
+        """
+        y = np.concatenate([self._pending, np.asarray(y, dtype=float).ravel()])
+        n_blocks = len(y) // self.step
+        self._pending = y[n_blocks * self.step :]
+        if not n_blocks:
+            return 0
+
+        terms = self._terms(y[: n_blocks * self.step].reshape(n_blocks, self.step))
+        weights = self.rng.poisson(1.0, size=(self.num_resamples, n_blocks))
+        self.totals += terms.sum(axis=0)
+        self.replicate_totals += weights @ terms
+        self.replicate_counts += weights.sum(axis=1)
+        self.n_blocks += n_blocks
+
+        if self.n_blocks < 2:
+            return n_blocks
+        indices = self.analyze()
+        self.history.append({"n_samples": self.n_samples, "S1": indices["S1"], "ST": indices["ST"]})
+        return n_blocks
+
+    def _estimate(self, totals, n, mean):
+        """Indices from summed terms, totals can hold a row per replicate"""
+        get = lambda name: totals[..., self._slices[name]]
+        n = np.asarray(n, dtype=float)[..., np.newaxis]
+
+        mean_ab = (get("a") + get("b")) / (2 * n)
+        var = (get("a2") + get("b2")) / (2 * n) - mean_ab**2
+        valid = var > np.finfo(float).eps * np.maximum(mean_ab**2, 1.0)
+        var = np.where(valid, var, 1.0)
+
+        # the terms are summed on the raw results, the mean of all results
+        # shifts them to the normalized output of sobol.analyze
+        S1 = np.where(valid, (get("b_d") - mean * get("d")) / n / var, 0.0)
+        ST = np.where(valid, 0.5 * get("d2") / n / var, 0.0)
+        if not self.calc_second_order:
+            return S1, ST, None
+
+        D = self.n_vars
+        shape = totals.shape[:-1] + (D, D)
+        ba_ab = get("ba_ab").reshape(shape)
+        linear = get("ba")[..., :, np.newaxis] + get("d")[..., np.newaxis, :] - get("b")[..., np.newaxis]
+        V = (ba_ab - get("ab")[..., np.newaxis] - mean * linear) / n[..., np.newaxis]
+        S2 = V / var[..., np.newaxis] - S1[..., :, np.newaxis] - S1[..., np.newaxis, :]
+        S2 = np.where(valid[..., np.newaxis], S2, 0.0)
+        S2[..., np.tril_indices(D)[0], np.tril_indices(D)[1]] = np.nan
+        return S1, ST, S2
+
+    def analyze(self):
+        """The current indices and confidence intervals
+
+        Returns
+        -------
+        dict
+            with the keys of sobol.analyze: S1, S1_conf, ST, ST_conf and, for
+            a second order design, S2 and S2_conf
+
+        Raises
+        ------
+        EMAError if there are fewer than two base samples
+        """
+        if self.n_blocks < 2:
+            raise EMAError("at least two base samples are needed for the Sobol indices")
+
+        mean = self.totals[self._slices["sum_y"]][0] / self.n_samples
+        S1, ST, S2 = self._estimate(self.totals, self.n_blocks, mean)
+        counts = np.maximum(self.replicate_counts, 1)
+        S1_r, ST_r, S2_r = self._estimate(self.replicate_totals, counts, mean)
+
+        indices = {
+            "S1": S1,
+            "S1_conf": self.z * S1_r.std(axis=0, ddof=1),
+            "ST": ST,
+            "ST_conf": self.z * ST_r.std(axis=0, ddof=1),
+        }
+        if S2 is not None:
+            indices["S2"] = S2
+            indices["S2_conf"] = self.z * S2_r.std(axis=0, ddof=1)
+        return indices
+
+    def to_dataframe(self):
+        """First and total order indices with their confidence intervals,
+        one row per uncertainty"""
+        indices = self.analyze()
+        keys = ["S1", "S1_conf", "ST", "ST_conf"]
+        return pd.DataFrame({k: indices[k] for k in keys}, index=self.names)
+
+    def history_frame(self, index="ST"):
+        """An index after every update, one row per uncertainty and one
+        column per number of samples"""
+        return pd.DataFrame(
+            {entry["n_samples"]: entry[index] for entry in self.history}, index=self.names
+        )
+
+
+class SobolStop:
+    """Stopping rule for run_sobol
+
+    Parameters
+    ----------
+    tolerance : float, optional
+                largest change of any first or total order index over the
+                window that still counts as stable
+    window : int, optional
+             number of consecutive updates over which the indices have to be
+             stable
+    max_conf : float, optional
+               largest confidence interval of the total order indices
+    min_samples : int, optional
+                  never stop before this number of results
+
+    Calling the rule with a dict of IncrementalSobol instances returns True
+    once the indices of all of them are stable; reason then tells why.
+    """
+
+    def __init__(self, tolerance=0.01, window=3, max_conf=0.1, min_samples=0):
+        self.tolerance = tolerance
+        self.window = window
+        self.max_conf = max_conf
+        self.min_samples = min_samples
+        self.reason = None
+
+    def _is_stable(self, estimator):
+        if len(estimator.history) < self.window + 1:
+            return False
+        recent = estimator.history[-(self.window + 1) :]
+        change = max(
+            np.nanmax(np.abs(entry[key] - recent[-1][key])) for entry in recent for key in ("S1", "ST")
+        )
+        if change > self.tolerance:
+            return False
+        return np.nanmax(estimator.analyze()["ST_conf"]) <= self.max_conf
+
+    def __call__(self, estimators):
+        n_samples = min(estimator.n_samples for estimator in estimators.values())
+        if n_samples < self.min_samples:
+            return False
+        if all(self._is_stable(estimator) for estimator in estimators.values()):
+            self.reason = (
+                f"indices changed less than {self.tolerance} over {self.window} updates "
+                f"after {n_samples} samples"
+            )
+            return True
+        return False
+
+
+def run_sobol(
+    model,
+    evaluator,
+    n_samples,
+    outcomes,
+    policy=None,
+    batch_size=50,
+    stopping_rule=None,
+    calc_second_order=True,
+    num_resamples=100,
+    seed=None,
+):
+    """Evaluate a Saltelli design in batches and update the Sobol indices
+    after every batch
+
+    Parameters
+    ----------
+    model : Model instance
+    evaluator : evaluator instance
+    n_samples : int
+                number of base samples of the full design
+    outcomes : list of str
+               scalar outcomes to analyze
+    policy : Policy instance, optional
+    batch_size : int, optional
+                 number of base samples per batch
+    stopping_rule : callable, optional
+                    called with the dict of estimators after every batch,
+                    e.g. SobolStop; the run ends when it returns True
+    calc_second_order : bool, optional
+    num_resamples : int, optional
+    seed : int, optional
+
+    Returns
+    -------
+    tuple
+        dict with an IncrementalSobol instance per outcome, and the
+        experiments and outcomes that were evaluated
+    """
+    problem = get_SALib_problem(model.uncertainties)
+    scenarios = list(
+        sample_uncertainties(model, n_samples, sampler=SobolSampler(second_order=calc_second_order))
+    )
+    estimators = {
+        outcome: IncrementalSobol(
+            problem,
+            calc_second_order=calc_second_order,
+            num_resamples=num_resamples,
+            seed=seed,
+        )
+        for outcome in outcomes
+    }
+    step = estimators[outcomes[0]].step
+    batch = batch_size * step
+
+    experiments = []
+    results = {}
+    for start in range(0, len(scenarios), batch):
+        kwargs = {} if policy is None else {"policies": policy}
+        batch_experiments, batch_outcomes = evaluator.perform_experiments(
+            scenarios=scenarios[start : start + batch], **kwargs
+        )
+        experiments.append(batch_experiments)
+        for key, value in batch_outcomes.items():
+            results.setdefault(key, []).append(value)
+
+        for outcome, estimator in estimators.items():
+            estimator.update(batch_outcomes[outcome])
+        _logger.info(
+            f"Sobol indices updated with {min(start + batch, len(scenarios))} of {len(scenarios)} samples"
+        )
+
+        if stopping_rule is not None and stopping_rule(estimators):
+            _logger.info(f"stopping the Sobol sampling, {stopping_rule.reason}")
+            break
+
+    experiments = pd.concat(experiments, ignore_index=True)
+    results = {k: np.concatenate(v) for k, v in results.items()}
+    return estimators, experiments, results
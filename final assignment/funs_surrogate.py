@@ -0,0 +1,313 @@
+"""
+Surrogate assisted pre-screening for the direct search.
+
+Every full evaluation of problem formulation 8 runs the complete DikeNetwork,
+while the stored results of earlier campaigns (the re-evaluated policies in
+dike_model_combined_results.csv, the directed search results and the archives
+written by the ArchiveLogger) already map thousands of lever combinations to
+the objectives. Surrogate fits a cheap emulator of the objectives on the lever
+values of those results. Each search optimizes for a single reference
+scenario, so only the stored results of that scenario are used; results that
+do not record their uncertainties, such as 857_policies_optimization.csv,
+cannot be attributed to a scenario and are skipped.
+
+SurrogateScreening wraps the variator of the optimizer. For every set of
+parents it generates several candidate offspring, predicts their objectives
+and only passes on the candidates that the emulator ranks best against the
+current archive. After every generation the predictions of the offspring that
+were actually evaluated are compared with the real outcomes, the error is
+logged and the emulator is periodically refitted on the new points. Offspring
+evaluated by the low fidelity screening model are not used, their outcomes
+differ from the full model the emulator predicts.
+"""
+import random
+
+import numpy as np
+import pandas as pd
+from scipy.stats import spearmanr
+from sklearn.ensemble import ExtraTreesRegressor
+
+from platypus import Solution, Variator, crowding_distance, nondominated_sort
+
+from ema_workbench.em_framework.optimization import ArchiveLogger, transform_variables
+from ema_workbench.util import ema_logging
+
+from funs_archive import load_archives
+from funs_results import ResultsCache
+
+_logger = ema_logging.get_module_logger(__name__)
+
+# stored results that contain lever values together with the pf 8 objectives
+DEFAULT_TRAINING_FILES = [
+    "./data/dike_model_combined_results.csv",
+    "./data/857_policies_optimization.csv",
+]
+
+
+def _matches(data, reference):
+    """Mask of the rows whose uncertainties have the values of reference"""
+    mask = np.ones(len(data), dtype=bool)
+    for name, value in reference.items():
+        mask &= np.isclose(pd.to_numeric(np.asarray(data[name])), float(value))
+    return mask
+
+
+def load_training_data(lever_names, outcome_names, file_names=(), archive_files=(), reference=None):
+    """Collect lever values and outcomes from stored results
+
+    Parameters
+    ----------
+    lever_names : list of str
+    outcome_names : list of str
+    file_names : list of str, optional
+                 CSV files or archives written by save_results, files that do
+                 not contain all levers and outcomes are skipped
+    archive_files : list of str, optional
+                    tar.gz files written by the ArchiveLogger or delta
+                    archives written by the DeltaArchiveLogger, these are
+                    taken to be for the reference scenario
+    reference : dict, optional
+                uncertainty values of the reference scenario, only rows of
+                file_names with these values are used and files without
+                these uncertainties are skipped
+
+    Returns
+    -------
+    tuple of numpy arrays
+        lever values (n, n_levers) and outcomes (n, n_outcomes)
+    """
+    columns = list(lever_names) + list(outcome_names)
+    reference = dict(reference or {})
+    frames = []
+
+    for file_name in file_names:
+        cache = ResultsCache(file_name)
+        missing = set(columns).union(reference) - set(cache.columns)
+        if missing:
+            _logger.info(f"skipping {file_name}, missing columns {sorted(missing)}")
+            continue
+        experiments, outcomes = cache.load(columns=columns + [n for n in reference if n not in columns])
+        data = experiments.assign(**outcomes)
+        frames.append(data.loc[_matches(data, reference), columns])
+
+    for file_name in archive_files:
+        if file_name.endswith(".tar.gz"):
+            archives = ArchiveLogger.load_archives(file_name)
+        else:
+            archives = load_archives(file_name)
+        for archive in archives.values():
+            if not archive.empty and set(columns).issubset(archive.columns):
+                frames.append(archive[columns])
+
+    if not frames:
+        return np.empty((0, len(lever_names))), np.empty((0, len(outcome_names)))
+
+    data = pd.concat(frames, ignore_index=True).drop_duplicates()
+    return (
+        data[list(lever_names)].to_numpy(dtype=float),
+        data[list(outcome_names)].to_numpy(dtype=float),
+    )
+
+
+class Surrogate:
+    """Emulator of the objectives as a function of the lever values
+
+    Parameters
+    ----------
+    lever_names : list of str
+    outcome_names : list of str
+    n_estimators : int, optional
+    random_state : int, optional
+
+    Extremely randomized trees are used, they need no scaling of the inputs,
+    cope with the integer levers and are cheap to refit.
+    """
+
+    def __init__(self, lever_names, outcome_names, n_estimators=100, random_state=None):
+        self.lever_names = list(lever_names)
+        self.outcome_names = list(outcome_names)
+        self.n_estimators = n_estimators
+        self.random_state = random_state
+
+        self.X = np.empty((0, len(self.lever_names)))
+        self.y = np.empty((0, len(self.outcome_names)))
+        self.regressor = None
+        self.history = []
+
+    @classmethod
+    def from_results(cls, model, file_names=DEFAULT_TRAINING_FILES, archive_files=(), reference=None, **kwargs):
+        """Create a surrogate for the levers and outcomes of model and fit it
+        on stored results, of the reference scenario if given"""
+        surrogate = cls(
+            [l.name for l in model.levers], [o.name for o in model.outcomes], **kwargs
+        )
+        if reference is not None:
+            reference = {u.name: reference[u.name] for u in model.uncertainties}
+        X, y = load_training_data(
+            surrogate.lever_names, surrogate.outcome_names, file_names, archive_files, reference
+        )
+        surrogate.add(X, y)
+        surrogate.fit()
+        return surrogate
+
+    @property
+    def is_fitted(self):
+        return self.regressor is not None
+
+    def add(self, X, y):
+        """Add training points, the model is only refitted by fit"""
+        self.X = np.vstack([self.X, np.asarray(X, dtype=float)])
+        self.y = np.vstack([self.y, np.asarray(y, dtype=float)])
+
+    def fit(self):
+        if len(self.X) == 0:
+            _logger.info("no training data for the surrogate yet")
+            return
+        self.regressor = ExtraTreesRegressor(
+            n_estimators=self.n_estimators, random_state=self.random_state, n_jobs=-1
+        )
+        self.regressor.fit(self.X, self.y)
+        _logger.info(f"surrogate fitted on {len(self.X)} points")
+
+    def predict(self, X):
+        prediction = self.regressor.predict(np.asarray(X, dtype=float))
+        return prediction.reshape(len(X), len(self.outcome_names))
+
+    def error_dataframe(self):
+        """Prediction error on the evaluated offspring, one row per generation"""
+        return pd.DataFrame(self.history)
+
+
+def prediction_error(predicted, observed, outcome_names):
+    """Mean absolute error and rank correlation per outcome
+
+    For screening only the ordering of the candidates matters, so the
+    Spearman rank correlation is the most relevant number.
+    """
+    error = {}
+    for i, name in enumerate(outcome_names):
+        error[f"{name} mae"] = np.mean(np.abs(predicted[:, i] - observed[:, i]))
+        if np.ptp(predicted[:, i]) > 0 and np.ptp(observed[:, i]) > 0:
+            error[f"{name} spearman"] = spearmanr(predicted[:, i], observed[:, i])[0]
+        else:
+            error[f"{name} spearman"] = np.nan
+    return error
+
+
+class SurrogateScreening(Variator):
+    """Variator that pre-screens offspring with a surrogate
+
+    Parameters
+    ----------
+    variator : platypus Variator instance
+               the variator that generates the candidates
+    surrogate : Surrogate instance
+    problem : platypus Problem instance
+    candidates : int, optional
+                 number of times the variator is applied to each set of
+                 parents, only the best ranked offspring are kept
+    retrain_every : int, optional
+                    refit the surrogate after this many new evaluations
+
+    The optimizer is attached with attach, after which observe has to be
+    called after every generation. The prediction error is stored in the
+    history of the surrogate.
+    """
+
+    def __init__(self, variator, surrogate, problem, candidates=4, retrain_every=500):
+        super().__init__(variator.arity)
+        self.variator = variator
+        self.surrogate = surrogate
+        self.problem = problem
+        self.candidates = candidates
+        self.retrain_every = retrain_every
+
+        self.optimizer = None
+        self.pending = []
+        self.new_points = 0
+
+    def attach(self, optimizer):
+        self.optimizer = optimizer
+
+    def _decode(self, solutions):
+        return np.array([transform_variables(self.problem, s.variables) for s in solutions])
+
+    def _as_solutions(self, objectives):
+        solutions = []
+        for values in objectives:
+            solution = Solution(self.problem)
+            solution.objectives[:] = list(values)
+            solution.evaluated = True
+            solutions.append(solution)
+        return solutions
+
+    def _rank(self, predicted):
+        """Rank candidates by their non-domination front when mixed with the
+        current archive, ties are broken on crowding distance"""
+        candidates = self._as_solutions(predicted)
+        reference = []
+        if self.optimizer is not None and self.optimizer.archive is not None:
+            reference = self._as_solutions([s.objectives[:] for s in self.optimizer.archive])
+
+        nondominated_sort(candidates + reference)
+        for rank in {c.rank for c in candidates}:
+            crowding_distance([c for c in candidates if c.rank == rank])
+
+        return sorted(
+            range(len(candidates)),
+            key=lambda i: (candidates[i].rank, -candidates[i].crowding_distance, random.random()),
+        )
+
+    def evolve(self, parents):
+        # without a fitted surrogate the offspring are only collected for training
+        if not self.surrogate.is_fitted:
+            offspring = self.variator.evolve(parents)
+            self.pending.extend((s, None) for s in offspring)
+            return offspring
+
+        offspring = []
+        for _ in range(self.candidates):
+            offspring.extend(self.variator.evolve(parents))
+        n_out = len(offspring) // self.candidates
+
+        predicted = self.surrogate.predict(self._decode(offspring))
+        selected = self._rank(predicted)[:n_out]
+        for i in selected:
+            self.pending.append((offspring[i], predicted[i]))
+        return [offspring[i] for i in selected]
+
+    def observe(self, full_fidelity=True):
+        """Compare the predictions with the evaluated offspring, add them to
+        the training data and refit the surrogate when due
+
+        Offspring evaluated while full_fidelity is False are dropped.
+        """
+        evaluated = [(s, p) for s, p in self.pending if s.evaluated]
+        self.pending = [(s, p) for s, p in self.pending if not s.evaluated]
+        if not evaluated or not full_fidelity:
+            return
+
+        solutions = [s for s, _ in evaluated]
+        observed = np.array([s.objectives[:] for s in solutions])
+
+        predicted = [(o, p) for o, (_, p) in zip(observed, evaluated) if p is not None]
+        if predicted:
+            observed_part, predicted_part = (np.array(a) for a in zip(*predicted))
+            error = prediction_error(predicted_part, observed_part, self.surrogate.outcome_names)
+            error["nfe"] = self.optimizer.nfe if self.optimizer is not None else np.nan
+            error["n_train"] = len(self.surrogate.X)
+            self.surrogate.history.append(error)
+
+        self.surrogate.add(self._decode(solutions), observed)
+        self.new_points += len(solutions)
+        if self.new_points >= self.retrain_every or not self.surrogate.is_fitted:
+            if predicted:
+                _logger.info(
+                    "surrogate rank correlation: "
+                    + ", ".join(
+                        f"{name} {error[f'{name} spearman']:.2f}"
+                        for name in self.surrogate.outcome_names
+                    )
+                )
+            self.surrogate.fit()
+            self.new_points = 0
@@ -0,0 +1,183 @@
+"""
+Synthetic dike networks for scaling studies.
+
+The IJssel network has five dikes, 133 flood wave shapes of 31 days and is
+run with 30 flood events, which says little about the cost of the model on
+larger river systems. write_network writes a synthetic network to a
+directory, with the same files and columns that get_network reads from
+./data, so DikeNetwork(data_dir=directory) runs it like the real one.
+
+The data of every synthetic dike is derived from one of the IJssel dikes,
+its template:
+
+* the rating curve, the loss table, the calibration of the fragility curve
+  and the ground level are raised or lowered by the same random offset,
+  so the dike fails at similar discharges as its template,
+* the discharges of the rating curve are scaled by the share of the river
+  discharge that reaches the branch of the dike,
+* the Muskingum parameters of the reach above the dike are those of a
+  random IJssel reach,
+* the five room for the river projects act on the synthetic dikes as they
+  act on their templates, at a cost scaled by the number of dikes.
+
+With several branches the river bifurcates evenly below A.0, and every
+branch is a chain of dikes ending in its own downstream node.
+The flood wave shapes are generated, with a configurable number of days.
+"""
+import os
+import shutil
+import string
+
+import numpy as np
+import pandas as pd
+
+TEMPLATE_DIKES = ["A.1", "A.2", "A.3", "A.4", "A.5"]
+
+# files copied from the template data as is
+COPIED_FILES = [
+    "EWS.xlsx",
+    os.path.join("fragcurves", "frag_curves.xlsx"),
+    os.path.join("hydrology", "werklijn_params.xlsx"),
+]
+
+
+def wave_shapes(n_shapes, n_timesteps, rng):
+    """Flood wave shapes normalized to a peak of one
+
+    Every shape rises from a base flow to its peak around the middle of the
+    event and falls back more slowly, with random base flow, peak time and
+    widths.
+    """
+    days = np.arange(n_timesteps)
+    base = rng.uniform(0.15, 0.3, (n_shapes, 1))
+    peak = n_timesteps // 2 + rng.integers(-n_timesteps // 10, n_timesteps // 10 + 1, (n_shapes, 1))
+    rise = rng.uniform(0.08, 0.15, (n_shapes, 1)) * n_timesteps
+    fall = rng.uniform(0.12, 0.25, (n_shapes, 1)) * n_timesteps
+    width = np.where(days < peak, rise, fall)
+    shapes = base + (1 - base) * np.exp(-(((days - peak) / width) ** 2))
+    return pd.DataFrame(shapes / shapes.max(axis=1, keepdims=True), columns=days)
+
+
+def branch_layout(n_dikes, n_branches):
+    """Names of the dikes of every branch, A.1, A.2, ... on branch A"""
+    if not 1 <= n_branches <= min(n_dikes, len(string.ascii_uppercase)):
+        raise ValueError(f"cannot spread {n_dikes} dikes over {n_branches} branches")
+    sizes = np.full(n_branches, n_dikes // n_branches)
+    sizes[: n_dikes % n_branches] += 1
+    return {
+        branch: [f"{branch}.{i}" for i in range(1, size + 1)]
+        for branch, size in zip(string.ascii_uppercase, sizes)
+    }
+
+
+def write_network(
+    directory,
+    n_dikes=5,
+    n_branches=1,
+    n_timesteps=31,
+    n_shapes=133,
+    template_dir="./data",
+    seed=None,
+):
+    """Write a synthetic network in the format read by get_network
+
+    Parameters
+    ----------
+    directory : str
+                the data directory to write, created if needed
+    n_dikes : int, optional
+    n_branches : int, optional
+                 number of parallel branches below the upstream node
+    n_timesteps : int, optional
+                  length of the flood waves in days
+    n_shapes : int, optional
+               number of flood wave shapes, the range of the A.0_ID flood
+               wave shape uncertainty
+    template_dir : str, optional
+                   the IJssel data the dikes are derived from
+    seed : int, optional
+
+    Returns
+    -------
+    list of str
+        the names of the dikes
+    """
+    rng = np.random.default_rng(seed)
+    layout = branch_layout(n_dikes, n_branches)
+    for subdirectory in ["fragcurves", "hydrology", "losses_tables", "Muskingum", "rating_curves"]:
+        os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+    for name in COPIED_FILES:
+        shutil.copyfile(os.path.join(template_dir, name), os.path.join(directory, name))
+
+    template_nodes = pd.read_excel(os.path.join(template_dir, "dikeIjssel.xlsx"), index_col="NodeName")
+    calibration = pd.read_excel(
+        os.path.join(template_dir, "fragcurves", "calfactors_pf1250.xlsx"), index_col=0
+    )
+    muskingum = pd.read_excel(os.path.join(template_dir, "Muskingum", "params.xlsx"), index_col=0)
+    projects = pd.read_excel(os.path.join(template_dir, "rfr_strategies.xlsx"), index_col=0)
+
+    rows = [template_nodes.loc["A.0"].to_dict() | {"NodeName": "A.0"}]
+    calibration_rows = {}
+    muskingum_rows = {}
+    project_rows = {}
+    dikes = []
+    share = 1 / n_branches
+    for branch, branch_dikes in layout.items():
+        prec = "A.0"
+        for dike in branch_dikes:
+            template = TEMPLATE_DIKES[len(dikes) % len(TEMPLATE_DIKES)]
+            offset = rng.uniform(-0.5, 0.5)
+
+            row = template_nodes.loc[template].to_dict()
+            row.update(
+                NodeName=dike,
+                prec_node=prec,
+                branch=branch,
+                km=len(dikes),
+                hground=row["hground"] + offset,
+            )
+            rows.append(row)
+            calibration_rows[dike] = calibration.loc[template].values + offset
+            muskingum_rows[prec] = muskingum.iloc[rng.integers(len(muskingum))]
+            project_rows[dike] = projects.loc[template]
+
+            curve = np.loadtxt(
+                os.path.join(template_dir, "rating_curves", f"{template}_ratingcurve_new.txt")
+            )
+            curve[:, 0] *= share
+            curve[:, 1] += offset
+            np.savetxt(os.path.join(directory, "rating_curves", f"{dike}_ratingcurve_new.txt"), curve)
+
+            table = pd.read_excel(
+                os.path.join(template_dir, "losses_tables", f"{template}_lossestable.xlsx"), index_col=0
+            )
+            table["WL"] += offset
+            table.to_excel(os.path.join(directory, "losses_tables", f"{dike}_lossestable.xlsx"))
+
+            dikes.append(dike)
+            prec = dike
+
+        end = template_nodes.loc["A.6"].to_dict()
+        end.update(NodeName=f"{branch}.{len(branch_dikes) + 1}", prec_node=prec, branch=branch)
+        rows.append(end)
+
+    network = pd.DataFrame(rows)
+    network["OBJECTID"] = np.arange(len(network))
+    columns = ["OBJECTID", "NodeName"] + [c for c in template_nodes.columns if c != "OBJECTID"]
+    network[columns].to_excel(os.path.join(directory, "dikeIjssel.xlsx"), index=False)
+
+    pd.DataFrame.from_dict(calibration_rows, orient="index", columns=calibration.columns).to_excel(
+        os.path.join(directory, "fragcurves", "calfactors_pf1250.xlsx")
+    )
+    pd.DataFrame(muskingum_rows).T.to_excel(os.path.join(directory, "Muskingum", "params.xlsx"))
+
+    strategies = pd.DataFrame(project_rows).T
+    costs = projects.loc[["costs_1e6"]] * n_dikes / len(TEMPLATE_DIKES)
+    strategies = pd.concat([strategies, costs])
+    strategies.index.name = projects.index.name
+    strategies.to_excel(os.path.join(directory, "rfr_strategies.xlsx"))
+
+    wave_shapes(n_shapes, n_timesteps, rng).to_excel(
+        os.path.join(directory, "hydrology", "wave_shapes.xlsx")
+    )
+    return dikes
@@ -0,0 +1,298 @@
+"""
+Runtime telemetry of the evaluators.
+
+Which scenarios and policies are expensive, and how long the workers wait
+for work, cannot be read from the results of a campaign. With a Telemetry
+instance the ChunkedEvaluator and the MPIClusterEvaluator record, for every
+experiment, its wall time and the work reported by the model (the DikeNetwork
+reports the number of flood events simulated and the number of dike breaches
+in its run_stats), and for every chunk when the worker received it, finished
+it, and when its results arrived back at the parent.
+
+TelemetryCallback adds the wall time, events simulated and breaches as extra
+outcome columns, so they end up next to the outcomes of every experiment.
+
+From the chunk records Telemetry.timeline reconstructs for every worker the
+intervals in which it ran experiments (busy), spent time between the
+experiments of a chunk (overhead), in which its results travelled back to
+the parent (ipc), and in which it waited (idle). Telemetry.summary reports
+the utilization of the workers and flags straggler experiments, and
+Telemetry.save writes all of it to a directory:
+
+    experiments.csv   one row per experiment
+    timeline.csv      busy, overhead, ipc and idle intervals per worker
+    workers.csv       time per kind of interval and utilization per worker
+    stragglers.csv    the experiments flagged as stragglers
+    summary.json
+
+Timestamps are wall clock times; under MPI the clocks of the nodes are
+assumed to be synchronized.
+"""
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from ema_workbench import ScalarOutcome
+from ema_workbench.em_framework.callbacks import DefaultCallback
+from ema_workbench.util import ema_logging
+
+_logger = ema_logging.get_module_logger(__name__)
+
+# extra outcome columns
+WALL_TIME = "wall time"
+EVENTS = "events simulated"
+BREACHES = "breaches"
+TELEMETRY_OUTCOMES = [WALL_TIME, EVENTS, BREACHES]
+
+
+def model_run_stats(runner, experiment):
+    """Work done in the last run of the model of an experiment, as reported
+    by the run_stats attribute of the model function"""
+    function = getattr(runner.msis[experiment.model_name], "function", None)
+    return dict(getattr(function, "run_stats", None) or {})
+
+
+class TelemetryCallback(DefaultCallback):
+    """DefaultCallback that also stores the telemetry columns
+
+    Pass the class as callback to perform_experiments. Experiments evaluated
+    without telemetry get NaN in these columns.
+    """
+
+    def __init__(self, uncertainties, levers, outcomes, nr_experiments, **kwargs):
+        names = {outcome.name for outcome in outcomes}
+        extra = [ScalarOutcome(name) for name in TELEMETRY_OUTCOMES if name not in names]
+        super().__init__(uncertainties, levers, list(outcomes) + extra, nr_experiments, **kwargs)
+        for outcome in extra:
+            self.results[outcome.name] = self._setup_outcomes_array((nr_experiments,), dtype=float)
+            self.results[outcome.name][:] = np.nan
+
+
+class Telemetry:
+    """Recorder of the runtime telemetry of one or more evaluator calls
+
+    Parameters
+    ----------
+    straggler_threshold : float, optional
+                          experiments whose wall time exceeds the median by
+                          more than this many robust standard deviations
+                          (1.4826 times the median absolute deviation) are
+                          flagged as stragglers
+    """
+
+    def __init__(self, straggler_threshold=5.0):
+        self.straggler_threshold = straggler_threshold
+        self.experiments = []
+        self.chunks = []
+        self.calls = []
+
+    def start_call(self):
+        self.calls.append([time.time(), np.nan])
+
+    def end_call(self):
+        self.calls[-1][1] = time.time()
+
+    def record_chunk(self, worker, chunk, stats, returned):
+        """Store the records of a chunk
+
+        Parameters
+        ----------
+        worker : int or str
+                 process id or MPI rank of the worker
+        chunk : list of Experiment instances
+        stats : dict
+                as collected by the worker: received, finished and a list
+                with start, end and the model run stats of every experiment
+        returned : float
+                   time at which the results arrived at the parent
+        """
+        if not self.calls:
+            self.start_call()
+        call = len(self.calls) - 1
+        self.chunks.append(
+            {
+                "call": call,
+                "worker": worker,
+                "n_experiments": len(chunk),
+                "received": stats["received"],
+                "finished": stats["finished"],
+                "returned": returned,
+            }
+        )
+        for experiment, record in zip(chunk, stats["experiments"]):
+            entry = {
+                "call": call,
+                "experiment_id": experiment.experiment_id,
+                "scenario": experiment.scenario.name,
+                "policy": experiment.policy.name,
+                "model": experiment.model_name,
+                "worker": worker,
+                "start": record["start"],
+                "end": record["end"],
+                WALL_TIME: record["end"] - record["start"],
+            }
+            entry.update(record["run_stats"])
+            self.experiments.append(entry)
+
+    @staticmethod
+    def columns(stats):
+        """Telemetry of the experiments of a chunk as outcome blocks"""
+        records = stats["experiments"]
+        return {
+            WALL_TIME: np.array([r["end"] - r["start"] for r in records]),
+            EVENTS: np.array([r["run_stats"].get(EVENTS, np.nan) for r in records], dtype=float),
+            BREACHES: np.array([r["run_stats"].get(BREACHES, np.nan) for r in records], dtype=float),
+        }
+
+    def experiments_frame(self):
+        """One row per experiment, times relative to the start of the first
+        call"""
+        frame = pd.DataFrame(self.experiments)
+        if not frame.empty:
+            origin = self.calls[0][0]
+            frame["start"] -= origin
+            frame["end"] -= origin
+        return frame
+
+    def timeline(self):
+        """Busy, ipc and idle intervals of every worker
+
+        Busy intervals are the experiments, ipc intervals run from the end of
+        a chunk on the worker until its results arrived at the parent (or
+        the worker received its next chunk, if that came first), overhead is
+        the time between the experiments of a chunk, and all other time of a
+        worker within an evaluator call is idle.
+
+        Returns
+        -------
+        DataFrame
+            with columns worker, call, kind, start, end and duration, times
+            relative to the start of the first call
+        """
+        rows = []
+        if not self.chunks:
+            return pd.DataFrame(columns=["worker", "call", "kind", "start", "end", "duration"])
+        chunks = pd.DataFrame(self.chunks).sort_values("received")
+        experiments = pd.DataFrame(self.experiments)
+        origin = self.calls[0][0]
+
+        for (worker, call), worker_chunks in chunks.groupby(["worker", "call"]):
+            call_start, call_end = self.calls[call]
+            if np.isnan(call_end):
+                call_end = worker_chunks["returned"].max()
+            intervals = []
+            runs = experiments[(experiments["worker"] == worker) & (experiments["call"] == call)]
+            intervals += [("busy", start, end) for start, end in zip(runs["start"], runs["end"])]
+            next_received = list(worker_chunks["received"].iloc[1:]) + [np.inf]
+            for finished, returned, received in zip(
+                worker_chunks["finished"], worker_chunks["returned"], next_received
+            ):
+                intervals.append(("ipc", finished, min(returned, received)))
+            intervals.sort(key=lambda interval: interval[1])
+
+            spans = list(zip(worker_chunks["received"], worker_chunks["finished"]))
+
+            def gap(start):
+                # time between the experiments of a chunk is spent on the chunk itself
+                inside = any(received <= start < finished for received, finished in spans)
+                return "overhead" if inside else "idle"
+
+            cursor = call_start
+            for kind, start, end in intervals:
+                if start > cursor:
+                    rows.append((worker, call, gap(cursor), cursor, start))
+                rows.append((worker, call, kind, start, end))
+                cursor = max(cursor, end)
+            if call_end > cursor:
+                rows.append((worker, call, "idle", cursor, call_end))
+
+        timeline = pd.DataFrame(rows, columns=["worker", "call", "kind", "start", "end"])
+        timeline["start"] -= origin
+        timeline["end"] -= origin
+        timeline["duration"] = timeline["end"] - timeline["start"]
+        return timeline
+
+    def stragglers(self, experiments=None):
+        """The experiments whose wall time is far above the median, with
+        their ratio to the median"""
+        if experiments is None:
+            experiments = self.experiments_frame()
+        if experiments.empty:
+            return experiments
+        wall_time = experiments[WALL_TIME]
+        median = wall_time.median()
+        spread = 1.4826 * (wall_time - median).abs().median()
+        flagged = experiments[wall_time > median + self.straggler_threshold * max(spread, 1e-9)].copy()
+        flagged["ratio to median"] = flagged[WALL_TIME] / median
+        return flagged.sort_values(WALL_TIME, ascending=False)
+
+    def worker_summary(self, timeline=None):
+        """Seconds busy, overhead, ipc and idle, and the utilization, per
+        worker"""
+        if timeline is None:
+            timeline = self.timeline()
+        table = timeline.pivot_table(
+            index="worker", columns="kind", values="duration", aggfunc="sum", fill_value=0.0
+        )
+        table = table.reindex(columns=["busy", "overhead", "ipc", "idle"], fill_value=0.0)
+        table["utilization"] = table["busy"] / table.sum(axis=1)
+        return table
+
+    def summary(self):
+        """Summary statistics of all recorded calls
+
+        Returns
+        -------
+        dict
+        """
+        experiments = self.experiments_frame()
+        timeline = self.timeline()
+        workers = self.worker_summary(timeline)
+        stragglers = self.stragglers(experiments)
+        totals = workers[["busy", "overhead", "ipc", "idle"]].sum()
+        wall_time = experiments[WALL_TIME]
+        summary = {
+            "n_experiments": len(experiments),
+            "n_chunks": len(self.chunks),
+            "n_workers": len(workers),
+            "elapsed": float(sum(end - start for start, end in self.calls if not np.isnan(end))),
+            "mean_wall_time": float(wall_time.mean()),
+            "median_wall_time": float(wall_time.median()),
+            "max_wall_time": float(wall_time.max()),
+            "utilization": float(totals["busy"] / totals.sum()),
+            "overhead_share": float(totals["overhead"] / totals.sum()),
+            "ipc_share": float(totals["ipc"] / totals.sum()),
+            "idle_share": float(totals["idle"] / totals.sum()),
+            "n_stragglers": len(stragglers),
+            "straggler_share_of_time": float(stragglers[WALL_TIME].sum() / wall_time.sum()),
+        }
+        for name in (EVENTS, BREACHES):
+            if name in experiments and experiments[name].nunique() > 1:
+                summary[f"wall_time_correlation_{name.replace(' ', '_')}"] = float(
+                    wall_time.corr(experiments[name])
+                )
+        return summary
+
+    def save(self, directory):
+        """Write the telemetry files to directory"""
+        if not self.experiments:
+            _logger.info("no telemetry recorded")
+            return
+        os.makedirs(directory, exist_ok=True)
+        experiments = self.experiments_frame()
+        timeline = self.timeline()
+        experiments.to_csv(os.path.join(directory, "experiments.csv"), index=False)
+        timeline.to_csv(os.path.join(directory, "timeline.csv"), index=False)
+        self.worker_summary(timeline).to_csv(os.path.join(directory, "workers.csv"))
+        self.stragglers(experiments).to_csv(os.path.join(directory, "stragglers.csv"), index=False)
+        summary = self.summary()
+        with open(os.path.join(directory, "summary.json"), "w") as fh:
+            json.dump(summary, fh, indent=1)
+        _logger.info(
+            f"telemetry of {summary['n_experiments']} experiments written to {directory}: "
+            f"utilization {summary['utilization']:.0%}, ipc {summary['ipc_share']:.0%}, "
+            f"idle {summary['idle_share']:.0%}, {summary['n_stragglers']} stragglers"
+        )
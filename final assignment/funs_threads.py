@@ -0,0 +1,161 @@
+"""
+Thread-based evaluation of the dike model.
+
+Worker processes each hold a full copy of the model, have to be started and
+have every experiment and result pickled. When a run is dominated by NumPy
+work that releases the GIL, threads avoid all of that. ThreadPoolEvaluator
+runs the experiments on a pool of threads within the driver process:
+
+* all threads share the model function, so the DikeNetwork, its network and
+  its hydrological data are loaded once and only read,
+* every thread has its own copy of the workbench Model (which stores the
+  outcomes of its last run) and its own ExperimentRunner, and the
+  DikeNetwork works on a private copy of the network in every run, which
+  serves as the scratch buffers of the thread,
+* experiments are handed out in cost-balanced chunks as in ChunkedEvaluator,
+  and the results are handed to the callback on the calling thread.
+
+Whether threads are faster than processes depends on how much of a run
+holds the GIL; dike_model_benchmark_evaluators.py measures the throughput of
+both for the workloads of problem formulations 7 and 8.
+"""
+import concurrent.futures
+import copy
+import os
+import threading
+import time
+
+from ema_workbench.em_framework.evaluators import BaseEvaluator
+from ema_workbench.em_framework.experiment_runner import ExperimentRunner
+from ema_workbench.em_framework.model import AbstractModel
+from ema_workbench.em_framework.points import experiment_generator
+from ema_workbench.em_framework.util import NamedObjectMap
+from ema_workbench.util import EMAError, ema_logging
+
+from funs_dispatch import CostModel, plan_chunks, run_chunk_with_telemetry, unpack_chunk
+from funs_telemetry import Telemetry
+
+_logger = ema_logging.get_module_logger(__name__)
+
+
+def thread_copy(model):
+    """Copy of a workbench model that shares the model function"""
+    return copy.deepcopy(model, {id(model.function): model.function})
+
+
+class ThreadPoolEvaluator(BaseEvaluator):
+    """Evaluator that runs experiments on a pool of threads
+
+    Parameters
+    ----------
+    msis : collection of models
+           models with a Python function, the function has to be safe to
+           call from several threads at once
+    n_threads : int, optional
+                defaults to the number of cores
+    chunks_per_worker : int, optional
+    max_chunksize : int, optional
+    cost_model : CostModel instance, optional
+    telemetry : Telemetry instance, optional
+                see ChunkedEvaluator, the workers are identified by the name
+                of their thread
+    """
+
+    def __init__(
+        self,
+        msis,
+        n_threads=None,
+        chunks_per_worker=4,
+        max_chunksize=200,
+        cost_model=None,
+        telemetry=None,
+        **kwargs,
+    ):
+        super().__init__(msis, **kwargs)
+        for msi in self._msis:
+            if getattr(msi, "function", None) is None:
+                raise EMAError(f"model {msi.name} has no Python function to run on a thread")
+
+        # n_processes as in the other evaluators, so code that sizes work on
+        # the number of workers can use this evaluator as well
+        self.n_processes = n_threads if n_threads is not None else os.cpu_count()
+        self.chunks_per_worker = chunks_per_worker
+        self.max_chunksize = max_chunksize
+        self.cost_model = cost_model if cost_model is not None else CostModel()
+        self.telemetry = telemetry
+        self._executor = None
+        self._local = threading.local()
+        self._runners = []
+        self._lock = threading.Lock()
+
+    def initialize(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.n_processes, thread_name_prefix="evaluator"
+        )
+        _logger.info(f"thread pool started with {self.n_processes} threads")
+        return self
+
+    def finalize(self):
+        self._executor.shutdown(wait=True)
+        for runner in self._runners:
+            # a runner cleans up its own models after a failed run
+            if runner.msis is not None:
+                runner.cleanup()
+        self._runners = []
+
+    def _runner(self):
+        """The ExperimentRunner of the current thread"""
+        runner = getattr(self._local, "runner", None)
+        if runner is None:
+            msis = NamedObjectMap(AbstractModel)
+            msis.extend([thread_copy(msi) for msi in self._msis])
+            runner = self._local.runner = ExperimentRunner(msis)
+            with self._lock:
+                self._runners.append(runner)
+        return runner
+
+    def _run(self, chunk, telemetry):
+        runner = self._runner()
+        try:
+            result = run_chunk_with_telemetry(runner, chunk, telemetry)
+        except (Exception, EMAError):
+            # the runner has dropped its models, the next chunk on this thread gets a new one
+            self._local.runner = None
+            with self._lock:
+                self._runners.remove(runner)
+            raise
+        return threading.current_thread().name, result
+
+    def evaluate_experiments(self, scenarios, policies, callback, combine="factorial"):
+        experiments = list(experiment_generator(scenarios, self._msis, policies, combine=combine))
+        costs = self.cost_model.predict(experiments)
+        chunks = [
+            [experiments[i] for i in indices]
+            for indices in plan_chunks(costs, self.n_processes, self.chunks_per_worker, self.max_chunksize)
+        ]
+
+        telemetry = self.telemetry is not None
+        if telemetry:
+            self.telemetry.start_call()
+
+        futures = {self._executor.submit(self._run, chunk, telemetry): chunk for chunk in chunks}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                chunk = futures[future]
+                try:
+                    thread, (blocks, times, memory, stats) = future.result()
+                except (Exception, EMAError) as e:
+                    # EMAError is not an Exception, a failed model run raises it
+                    raise EMAError("experiment failed") from e
+                self.cost_model.update(chunk, times)
+                if telemetry:
+                    self.telemetry.record_chunk(thread, chunk, stats, time.time())
+                    blocks.update(Telemetry.columns(stats))
+                unpack_chunk(chunk, blocks, callback)
+        finally:
+            for future in futures:
+                future.cancel()
+
+        if telemetry:
+            self.telemetry.end_call()
+        _logger.debug(f"{len(experiments)} experiments in {len(chunks)} chunks on {self.n_processes} threads")
@@ -2,12 +2,14 @@ from ema_workbench import (
     Model,
     CategoricalParameter,
     ArrayOutcome,
+    Constant,
     ScalarOutcome,
     IntegerParameter,
     RealParameter,
 )
 from dike_model_function import DikeNetwork  # @UnresolvedImport
 
+import copy
 import numpy as np
 
 
@@ -502,5 +504,16 @@ def get_model_for_problem_formulation(problem_formulation_id):
     return dike_model, function.planning_steps
 
 
+def with_fidelity(dike_model, fidelity):
+    """Copy of a dike model that runs at one of the fidelity levels of DikeNetwork ('high', 'medium' or 'low').
+
+    The copy shares the sampled flood events of the original model, so results at different fidelity levels
+    remain comparable. The fidelity is passed on to DikeNetwork as the timestep constant.
+    """
+    dike_model = copy.deepcopy(dike_model)
+    dike_model.constants = [Constant("timestep", fidelity)]
+    return dike_model
+
+
 if __name__ == "__main__":
     get_model_for_problem_formulation(3)
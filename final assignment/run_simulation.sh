@@ -2,11 +2,16 @@
 
 #SBATCH --job-name="mbdm_dc"
 #SBATCH --time=02:30:00
-#SBATCH --ntasks=1
-#SBATCH --cpus-per-task=48
+# One MPI rank per CPU, the ranks may be spread over several nodes. Rank 0 runs the driver, the other ranks
+# evaluate the experiments (see funs_mpi.py).
+#SBATCH --ntasks=48
+#SBATCH --cpus-per-task=1
 #SBATCH --partition=compute
 #SBATCH --mem-per-cpu=2GB
 #SBATCH --account=education-tpm-msc-epa
+# Ask SLURM for a signal 5 minutes before the wall time, so the drivers can write a checkpoint and
+# exit cleanly. Submit the job again with --resume to continue the campaign.
+#SBATCH --signal=USR1@300
 
 module load 2023r1
 module load openmpi
@@ -18,4 +23,4 @@ module load py-pip
 
 pip install --user --upgrade ema_workbench
 
-srun python dike_model_optimization_project_1.py > simulation.log
+srun python dike_model_optimization_project_final.py --mpi > simulation.log